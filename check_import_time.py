@@ -0,0 +1,98 @@
+"""
+Checks that the command line entry points of the utilities start quickly.
+
+Every entry point is run the way a short command would run it, e.g. with --help, under "python -X importtime".
+The check fails if an entry point imports any of the heavy client libraries, which must only be imported by the
+functions that use them, or if its imports take longer than the budget.
+
+This is how you execute this script, from the root of the repository, with Python 3.7 or better:
+
+python check_import_time.py [budget in milliseconds]
+"""
+
+from __future__ import print_function
+
+import os
+import re
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Entry points and the arguments that make them return right away.
+ENTRY_POINTS = [
+    ('resource-inventory/resource-inventory.py', ['--help']),
+    ('resource-inventory/merge-inventory.py', ['--help']),
+    ('resource-inventory/query-inventory.py', ['--help']),
+    ('resource-inventory/diff-inventory.py', ['--help']),
+    ('resource-inventory/benchmark.py', ['--help']),
+    ('project-lock-down/project_setup.py', ['--help']),
+    ('project-lock-down/fleet.py', ['--help']),
+    ('project-lock-down/incidents.py', ['--help']),
+    ('project-lock-down/audit_rules.py', ['--help']),
+]
+
+HEAVY_MODULES = ['googleapiclient', 'oauth2client', 'httplib2', 'google.cloud', 'pyarrow', 'yaml', 'pymysql']
+
+DEFAULT_BUDGET_MS = 100
+
+
+def measure_imports(args, cwd=ROOT):
+    """
+    :param args: the arguments to run python with, e.g. ['resource-inventory.py', '--help']
+    :param cwd: the directory to run python in
+    :return: tuple of (total import time in milliseconds, list of the modules imported)
+    """
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    process = subprocess.Popen([sys.executable, '-X', 'importtime'] + args, cwd=cwd, env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, stderr = process.communicate()
+
+    total_us = 0
+    modules = []
+    for line in stderr.decode('utf-8', 'replace').splitlines():
+        # e.g. "import time:       171 |        931 |   argparse", nested imports indented by two more spaces.
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)', line)
+        if match is None:
+            continue
+
+        modules.append(match.group(4))
+        if len(match.group(3)) == 1:
+            total_us += int(match.group(2))
+
+    return total_us / 1000.0, modules
+
+
+def main():
+    budget_ms = float(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_BUDGET_MS
+
+    # Modules the interpreter imports on its own, which no entry point can avoid.
+    baseline_ms, _ = measure_imports(['-c', 'pass'])
+
+    failures = []
+    for script, args in ENTRY_POINTS:
+        total_ms, modules = measure_imports([os.path.basename(script)] + args,
+                                            os.path.join(ROOT, os.path.dirname(script)))
+        total_ms -= baseline_ms
+
+        heavy = sorted(set(heavy_module for module in modules
+                           for heavy_module in HEAVY_MODULES
+                           if module == heavy_module or module.startswith(heavy_module + '.')))
+
+        status = 'ok'
+        if heavy:
+            status = 'FAILED: imports {}'.format(', '.join(heavy))
+        elif total_ms > budget_ms:
+            status = 'FAILED: over the budget of {:.0f} ms'.format(budget_ms)
+
+        if status != 'ok':
+            failures.append(script)
+
+        print('{:<45} {:>7.1f} ms  {}'.format(script, total_ms, status))
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
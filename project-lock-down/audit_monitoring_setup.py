@@ -1,7 +1,10 @@
 from utils import *
 from parameters import *
-from datetime import datetime
-import time
+import incidents
+from multiprocessing.pool import ThreadPool
+
+# The number of seconds to wait for a new log-based metric to become available before creating its alert policy.
+METRIC_READINESS_TIMEOUT = 300
 
 
 def enable_audit_monitoring():
@@ -21,7 +24,104 @@ def enable_audit_monitoring():
     __enable_data_access_logging()
     __enable_log_streaming()
     __create_audit_alerts()
-    __get_incidents_history()
+    incidents.get_incidents_history()
+
+
+def plan_audit_monitoring_changes(state):
+    """
+    Compares the current state of audit logging and monitoring against the desired state defined by this script
+    and lists the changes required to reconcile them. Metrics, channels and alert policies that already exist
+    are left untouched rather than duplicated.
+
+    :param state: the current state as read by lock_down_state.read_current_state()
+
+    :return: list of (description, function) tuples; calling the functions in order applies the changes.
+    """
+
+    changes = []
+
+    if not __is_data_access_logging_enabled(state['project_iam']):
+        changes.append(('Enable data access audit logs for project {}'.format(PROJECT_ID),
+                        __enable_data_access_logging))
+
+    if state['dataset'] is None:
+        changes.append(('Create BigQuery dataset {}'.format(LOGS_SINK_DATASET_ID), __create_logs_dataset))
+
+    sinks = [sink for sink in state['sinks'] or [] if sink['name'] == LOGS_SINK_NAME]
+    if not sinks:
+        changes.append(('Create log sink {}'.format(LOGS_SINK_NAME), __create_logs_sink))
+    else:
+        service_account = sinks[0]['writerIdentity'].replace('serviceAccount:', '')
+        if state['dataset'] is None or \
+                __access_entries(state['dataset'].get('access')) != \
+                __access_entries(__dataset_roles(service_account)['access']):
+            changes.append(('Set access rights of BigQuery dataset {}'.format(LOGS_SINK_DATASET_ID),
+                            lambda: __set_dataset_access(service_account)))
+
+    existing_metrics = set(metric['name'] for metric in state['metrics'] or [])
+    new_metrics = [metric for metric in audit_metrics() if metric['name'] not in existing_metrics]
+    for metric in new_metrics:
+        changes.append(('Create log-based metric {}'.format(metric['name']),
+                        lambda metric=metric: __create_log_metric(metric)))
+
+    # The alert policies need the name of the notification channel, which is only known once it exists.
+    channel = {'name': __find_notification_channel(state['channels'])}
+    if channel['name'] is None:
+        def create_channel():
+            channel['name'] = __create_notification_channel()
+
+        changes.append(('Create email notification channel for {}'.format(AUDITORS_GROUP), create_channel))
+
+    existing_policies = set(policy['displayName'] for policy in state['alert_policies'] or [])
+    new_policies = [metric for metric in audit_metrics() if metric['policy_name'] not in existing_policies]
+    if new_policies:
+        changes.append(('Create alert policies {}'.format(', '.join('"{}"'.format(metric['policy_name'])
+                                                                    for metric in new_policies)),
+                        lambda: __create_alert_policies(new_policies, channel['name'])))
+
+    return changes
+
+
+def __is_data_access_logging_enabled(iam_policy):
+    """
+    Checks whether the project IAM policy turns on all the audit log types for all services.
+
+    :param iam_policy: the project IAM policy as returned by "gcloud projects get-iam-policy"
+
+    :return: True if ADMIN_READ, DATA_WRITE and DATA_READ logs are on for allServices.
+    """
+    for audit_config in (iam_policy or {}).get('auditConfigs', []):
+        if audit_config['service'] == 'allServices':
+            log_types = set(config['logType'] for config in audit_config.get('auditLogConfigs', []))
+            return log_types >= {'ADMIN_READ', 'DATA_WRITE', 'DATA_READ'}
+
+    return False
+
+
+def __access_entries(access):
+    """
+    Converts a list of dataset access entries into a comparable form, ignoring their order.
+
+    :param access: e.g. [{'role': 'READER', 'groupByEmail': 'a@acme.com'}]
+
+    :return: e.g. {('READER', 'a@acme.com')}
+    """
+    return set((entry['role'], entry.get('userByEmail', entry.get('groupByEmail'))) for entry in access or [])
+
+
+def __find_notification_channel(channels):
+    """
+    Finds the email notification channel that notifies AUDITORS_GROUP among existing channels.
+
+    :param channels: the channels as returned by "gcloud alpha monitoring channels list"
+
+    :return: the notification channel name, or None if there is no such channel.
+    """
+    for channel in channels or []:
+        if channel['type'] == 'email' and channel.get('labels', {}).get('email_address') == AUDITORS_GROUP:
+            return channel['name']
+
+    return None
 
 
 def __enable_data_access_logging():
@@ -68,6 +168,16 @@ def __enable_log_streaming():
     """
     Creates a stream of Stackdriver log exports into a BigQuery dataset.
 
+    :return: None
+    """
+    __create_logs_dataset()
+    __create_logs_sink()
+
+
+def __create_logs_dataset():
+    """
+    Enables BigQuery service for the project and creates the BigQuery dataset to store the logs.
+
     :return: None
     """
     # Enable BigQuery service for the project:
@@ -75,9 +185,16 @@ def __enable_log_streaming():
 
     # Create the BigQuery dataset to store the logs:
     # For details refer to https://cloud.google.com/bigquery/docs/datasets#bigquery-create-dataset-cli
-    run_command('bq mk --data_location {} --description \"Cloud logging export.\" {}'
-                .format(LOGS_LOCATION, LOGS_SINK_DATASET_ID), 'already exists')
+    run_command('bq mk --data_location {} --description \"Cloud logging export.\" {}:{}'
+                .format(LOGS_LOCATION, PROJECT_ID, LOGS_SINK_DATASET_ID), 'already exists')
+
+
+def __create_logs_sink():
+    """
+    Sets up a log sink to the BigQuery dataset and grants its service account write access to the dataset.
 
+    :return: None
+    """
     # Set up a log sink to the above-created BigQuery dataset:
     output_message = run_command('gcloud logging sinks create {} {} --project {} \
                         --log-filter=\'resource.type=\"gcs_bucket\" OR resource.type=\"project\"\''
@@ -105,7 +222,26 @@ def __set_dataset_access(service_account):
 
     assert service_account, 'service_account cannot be blank!'
 
-    dataset_roles = {
+    dataset_roles = __dataset_roles(service_account)
+
+    save_JSON (dataset_roles, 'tmp_ds_roles.json')
+
+    # Use the temp json file to overwrite existing policies with above-defined roles.
+    run_command('bq update --source=tmp_ds_roles.json {}:{}'.format(PROJECT_ID, LOGS_SINK_DATASET_ID) )
+
+    # When done, remove the temp file.
+    run_command('rm tmp_ds_roles.json')
+
+
+def __dataset_roles(service_account):
+    """
+    Defines the access rights against the BigQuery dataset where Stackdriver logs are streamed to.
+
+    :param service_account: The service account streaming Stackdriver logs into BiqQuery
+
+    :return: the dataset access as expected by "bq update --source"
+    """
+    return {
         "access": [
             {
                 "role": "WRITER",
@@ -126,14 +262,6 @@ def __set_dataset_access(service_account):
         ]
     }
 
-    save_JSON (dataset_roles, 'tmp_ds_roles.json')
-
-    # Use the temp json file to overwrite existing policies with above-defined roles.
-    run_command('bq update --source=tmp_ds_roles.json {}'.format(LOGS_SINK_DATASET_ID) )
-
-    # When done, remove the temp file.
-    run_command('rm tmp_ds_roles.json')
-
 
 def __create_audit_alerts():
     """
@@ -150,52 +278,127 @@ def __create_audit_alerts():
     :return: None
     """
 
-    # Create a log-based metric to count all calls to SetIamPolicy:
-    metric1_name = "iam-policy-change"
-    run_command('gcloud logging metrics create {} --description="Count of IAM policy changes."  --project={}  --log-filter="\
-        resource.type=project AND \
-        protoPayload.serviceName=cloudresourcemanager.googleapis.com AND \
-        protoPayload.methodName=SetIamPolicy"'.format(metric1_name, PROJECT_ID))
-
-    # Create a log-based metric to count all calls to setIamPermissions or storage.objects.update on GCS buckets:
-    metric2_name = "bucket-permission-change"
-    run_command('gcloud logging metrics create {} --description="Count of GCS permission changes."  --project={}  --log-filter="\
-            resource.type=gcs_bucket AND \
-            protoPayload.serviceName=storage.googleapis.com AND \
-            (protoPayload.methodName=storage.setIamPermissions OR protoPayload.methodName=storage.objects.update)"'
-                .format(metric2_name, PROJECT_ID))
-
-    # Create a log-based metric to count unexpected accesses to the data bucket:
-    metric3_name = "unexpected-bucket-access-{}".format(DATA_BUCKET_ID)
-    logFilter = 'resource.type=gcs_bucket AND \
-            logName=projects/{}/logs/cloudaudit.googleapis.com%2Fdata_access AND \
-            protoPayload.resourceName=projects/_/buckets/{} AND \
-            protoPayload.authenticationInfo.principalEmail!=({})'\
-            .format(PROJECT_ID, DATA_BUCKET_ID, WHITELIST_USERS)
-
-    run_command('gcloud logging metrics create {} \
-           --description=\"Count of unexpected data access to {}.\"  \
-           --project={} --log-filter=\"{}\"'.format(metric3_name, DATA_BUCKET_ID, PROJECT_ID, logFilter))
+    for metric in audit_metrics():
+        __create_log_metric(metric)
 
     # Create an email notification channel. Refer to https://cloud.google.com/monitoring/support/notification-options
     notification_channel_name = __create_notification_channel()
 
-    # There is a lag between when log-based metrics are created and when they become available in Stackdriver.
-    # 30 seconds should work, but you may have to adjust it.
-    time.sleep(30)
+    # Create an alert based on each metric:
+    __create_alert_policies(audit_metrics(), notification_channel_name)
+
+
+def __create_alert_policies(metrics, notification_channel_name):
+    """
+    Creates the alert policies based on the provided log-based metrics, in parallel.
+
+    There is a lag between when log-based metrics are created and when they become available in Stackdriver.
+    Each alert policy is created as soon as the descriptor of its own metric is available.
+
+    :param metrics: the metrics, as defined by audit_metrics(), to create the alert policies for
+
+    :param notification_channel_name: the notification channel to be associated with the alert policies
+
+    :return: None
+    """
+
+    def create_alert_policy(metric):
+        wait_for(lambda: __is_metric_available(metric['name']),
+                 'log-based metric {} to become available'.format(metric['name']), METRIC_READINESS_TIMEOUT)
+        __create_alert_policy(metric['resource_type'], metric['name'], notification_channel_name,
+                              metric['policy_name'], metric['policy_desc'])
+
+    if not metrics:
+        return
+
+    pool = ThreadPool(len(metrics))
+    try:
+        pool.map(create_alert_policy, metrics)
+    finally:
+        pool.close()
+
+
+def __is_metric_available(metric_name):
+    """
+    Checks whether the descriptor of a log-based metric is available in Stackdriver.
+    Refer to: https://cloud.google.com/monitoring/api/ref_v3/rest/v3/projects.metricDescriptors/get
+
+    :param metric_name: the name of the log-based metric
+
+    :return: True if the descriptor of logging.googleapis.com/user/[metric_name] exists.
+    """
+    return try_command('curl --silent --fail -H "Authorization: Bearer $(gcloud auth print-access-token)" '
+                       'https://monitoring.googleapis.com/v3/projects/{}/metricDescriptors/logging.googleapis.com/user/{}'
+                       .format(PROJECT_ID, metric_name)) is not None
+
+
+def audit_metrics():
+    """
+    Defines the log-based metrics that count "offensive" actions, alongside the alert policies built on them:
+    1. IAM policies are altered
+    2. bucket permissions are altered
+    3. anyone other than the named users accesses the data bucket
+
+    The same log filters drive the in-process rule engine in audit_rules.py, and offence_type names the offence
+    as the incidents history in BigQuery does.
 
-    # Create an alert based on metric 1:
-    __create_alert_policy ("global", metric1_name, notification_channel_name, "IAM Policy Change Alert",
-                           "This policy ensures the designated user/group is notified when IAM policies are altered.")
+    :return: list of dictionaries, one per metric.
+    """
+    return [
+        {
+            # Count all calls to SetIamPolicy:
+            'name': 'iam-policy-change',
+            'description': 'Count of IAM policy changes.',
+            'log_filter': 'resource.type=project AND '
+                          'protoPayload.serviceName=cloudresourcemanager.googleapis.com AND '
+                          'protoPayload.methodName=SetIamPolicy',
+            'resource_type': 'global',
+            'offence_type': 'IAM Policy Tampering',
+            'policy_name': 'IAM Policy Change Alert',
+            'policy_desc': 'This policy ensures the designated user/group is notified when IAM policies are altered.'
+        },
+        {
+            # Count all calls to setIamPermissions or storage.objects.update on GCS buckets:
+            'name': 'bucket-permission-change',
+            'description': 'Count of GCS permission changes.',
+            'log_filter': 'resource.type=gcs_bucket AND '
+                          'protoPayload.serviceName=storage.googleapis.com AND '
+                          '(protoPayload.methodName=storage.setIamPermissions OR '
+                          'protoPayload.methodName=storage.objects.update)',
+            'resource_type': 'gcs_bucket',
+            'offence_type': 'Bucket Permission Tampering',
+            'policy_name': 'Bucket Permission Change Alert',
+            'policy_desc': 'This policy ensures the designated user/group is notified when '
+                           'bucket/object permissions are altered.'
+        },
+        {
+            # Count unexpected accesses to the data bucket:
+            'name': 'unexpected-bucket-access-{}'.format(DATA_BUCKET_ID),
+            'description': 'Count of unexpected data access to {}.'.format(DATA_BUCKET_ID),
+            'log_filter': 'resource.type=gcs_bucket AND '
+                          'logName=projects/{}/logs/cloudaudit.googleapis.com%2Fdata_access AND '
+                          'protoPayload.resourceName=projects/_/buckets/{} AND '
+                          'protoPayload.authenticationInfo.principalEmail!=({})'
+                          .format(PROJECT_ID, DATA_BUCKET_ID, WHITELIST_USERS),
+            'resource_type': 'gcs_bucket',
+            'offence_type': 'Unexpected Bucket Access',
+            'policy_name': 'Unexpected Bucket Access Alert',
+            'policy_desc': 'This policy ensures the designated user/group is notified when data bucket is '
+                           'accessed by an unexpected user.'
+        }
+    ]
 
-    # Create an alert based on metric 2:
-    __create_alert_policy("gcs_bucket", metric2_name, notification_channel_name, "Bucket Permission Change Alert",
-                      "This policy ensures the designated user/group is notified when bucket/object permissions are altered.")
 
-    # Create an alert based on metric 3:
-    __create_alert_policy ("gcs_bucket", metric3_name, notification_channel_name, "Unexpected Bucket Access Alert",
-                           "This policy ensures the designated user/group is notified when data bucket is \
-                           accessed by an unexpected user.")
+def __create_log_metric(metric):
+    """
+    Creates a log-based metric. Refer to: https://cloud.google.com/sdk/gcloud/reference/logging/metrics/create
+
+    :param metric: one of the metrics defined by audit_metrics()
+
+    :return: None
+    """
+    run_command('gcloud logging metrics create {} --description="{}" --project={} --log-filter="{}"'
+                .format(metric['name'], metric['description'], PROJECT_ID, metric['log_filter']))
 
 
 def __create_alert_policy (resource_type, metric_name, notification_channel_name, policy_name, policy_desc):
@@ -244,12 +447,16 @@ def __create_alert_policy (resource_type, metric_name, notification_channel_name
         ]
     }
 
-    save_JSON(policy, 'tmp_alert_policy.json')
+    # Alert policies are created in parallel, so each one needs its own temp file.
+    _tempFile = 'tmp_alert_policy_{}.json'.format(metric_name)
 
-    output_message = run_command('gcloud alpha monitoring policies create --policy-from-file tmp_alert_policy.json')
+    save_JSON(policy, _tempFile)
+
+    output_message = run_command('gcloud alpha monitoring policies create --policy-from-file {} '
+                                 '--project={}'.format(_tempFile, PROJECT_ID))
 
     # When done, remove the temp file.
-    run_command('rm tmp_alert_policy.json')
+    run_command('rm {}'.format(_tempFile))
 
 
 def __create_notification_channel():
@@ -272,7 +479,8 @@ def __create_notification_channel():
         save_JSON(channel, 'tmp_notification_channel.json')
 
         output_message = run_command(
-            'gcloud alpha monitoring channels create --channel-content-from-file tmp_notification_channel.json')
+            'gcloud alpha monitoring channels create --channel-content-from-file tmp_notification_channel.json '
+            '--project={}'.format(PROJECT_ID))
         channel_name = __find_notification_channel_name_in_message(output_message)
 
         # When done, remove the temp file.
@@ -281,50 +489,6 @@ def __create_notification_channel():
         return channel_name
 
 
-def __get_incidents_history(date='*'):
-    """
-    Builds a query against the logs in BigQuery.
-    Unless a specific date is specified, the entire history is scanned.
-
-    :param date: date of interest in YYYYMMDD format for e.g:  20180611
-
-    :return: None
-    """
-    assert (date == '*' or datetime.strptime(date, "%Y%m%d") ), "date must be of format YYYYMMDD!"
-
-    # Prepare the IN clause from WHITELIST_USERS. For e.g:
-    # Convert: "user1@google.com AND user2@google.com" to "'user1@google.com', 'user2@google.com'"
-    IN_clause = map(lambda x: x.replace(' ', ''), WHITELIST_USERS.split('AND'))
-    IN_clause = map(lambda x: '\'{}\''.format(x), IN_clause)
-    IN_clause = ','.join(IN_clause)
-
-    query1 = 'SELECT timestamp, resource.labels.project_id as project, protopayload_auditlog.authenticationInfo.principalEmail as offender, \
-    \'IAM Policy Tampering\' as offenceType FROM `{}.{}.cloudaudit_googleapis_com_activity_{}` \
-    WHERE resource.type = "project" AND protopayload_auditlog.serviceName = "cloudresourcemanager.googleapis.com" \
-    AND protopayload_auditlog.methodName = "SetIamPolicy"'.format(PROJECT_ID, LOGS_SINK_DATASET_ID, date)
-
-    query2 = 'SELECT timestamp, resource.labels.project_id as project, protopayload_auditlog.authenticationInfo.principalEmail as offender, \
-    \'Bucket Permission Tampering\' as offenceType FROM `{}.{}.cloudaudit_googleapis_com_activity_{}` \
-    WHERE resource.type = "gcs_bucket" AND protopayload_auditlog.serviceName = "storage.googleapis.com" \
-    AND(protopayload_auditlog.methodName = "storage.setIamPermissions" OR protopayload_auditlog.methodName = "storage.objects.update")'.\
-        format(PROJECT_ID, LOGS_SINK_DATASET_ID, date)
-
-    query3 = 'SELECT timestamp, resource.labels.project_id as project, protoPayload_auditlog.authenticationInfo.principalEmail as offender, \
-    \'Unexpected Bucket Access\' as offenceType FROM `{}.{}.cloudaudit_googleapis_com_data_access_{}` \
-    WHERE resource.type = \'gcs_bucket\' AND(protoPayload_auditlog.resourceName LIKE \'%{}\' OR \
-    protoPayload_auditlog.resourceName LIKE \'%{}\') AND protoPayload_auditlog.authenticationInfo.principalEmail \
-    NOT IN({})'.format(PROJECT_ID, LOGS_SINK_DATASET_ID, date, LOGS_BUCKET_ID, DATA_BUCKET_ID, IN_clause)
-
-    final_query = '{} UNION DISTINCT {} UNION DISTINCT {} ORDER BY timestamp DESC'.format(query1, query2, query3)
-
-    save_string(final_query, 'tmp_query.sql')
-
-    run_command('bq query --use_legacy_sql=false < tmp_query.sql')
-
-    # When done, remove the temp file.
-    run_command('rm tmp_query.sql')
-
-
 def __find_service_account_in_message(message):
         """
         The command "gcloud logging sinks create", communicates a service account Id as part of its message.
@@ -361,4 +525,4 @@ def __find_notification_channel_name_in_message(message):
         :return: the notification channel Id to be used for defining a stack driver alert
         """
         channel_name = [t for t in message.split() if t.startswith('[projects')]
-        return channel_name[0].translate(None, '[].')
\ No newline at end of file
+        return channel_name[0].strip('[].')
\ No newline at end of file
@@ -0,0 +1,450 @@
+"""
+An in-process alternative to the log-based metrics and alert policies created by audit_monitoring_setup.py.
+
+The log filters of audit_monitoring_setup.audit_metrics() are compiled once into Python predicates, and audit log
+entries are run through them in micro-batches as they arrive, from a Pub/Sub log sink or a local replay of newline
+delimited JSON log entries. Incidents come out within seconds, without waiting for log-based metrics to catch up.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from utils import *
+from parameters import *
+import audit_monitoring_setup
+import json
+import random
+import re
+import sys
+import time
+
+# Log entries are evaluated in batches of at most this many entries, or whatever arrived in this many seconds.
+BATCH_SIZE = 1000
+BATCH_SECONDS = 1.0
+
+_EMPTY = {}
+
+
+def compile_filter(log_filter):
+    """
+    Compiles a filter of the Cloud Logging query language into a predicate on log entries.
+
+    Supported: comparisons of a field path with =, != and : (has substring), e.g. resource.type=gcs_bucket;
+    a list of values to compare with in parentheses, e.g. principalEmail!=(a@acme.com AND b@acme.com);
+    AND, OR, NOT, juxtaposition as AND, and parentheses. As in Cloud Logging, OR binds tighter than AND.
+    Refer to: https://cloud.google.com/logging/docs/view/advanced-queries
+
+    :param log_filter: the filter, e.g. 'resource.type=project AND protoPayload.methodName=SetIamPolicy'
+    :return: function of a log entry, i.e. a dictionary as in the JSON of a LogEntry, to bool
+    """
+    tokens = __tokenize(log_filter)
+    position, predicate = __parse_and(tokens, 0)
+    if position != len(tokens):
+        raise ValueError('unexpected "{}" in log filter: {}'.format(tokens[position], log_filter))
+
+    return predicate
+
+
+def compile_rules():
+    """
+    :return: list of (metric, predicate) for every metric of audit_monitoring_setup.audit_metrics()
+    """
+    return [(metric, compile_filter(metric['log_filter'])) for metric in audit_monitoring_setup.audit_metrics()]
+
+
+def evaluate(rules, entries):
+    """
+    Runs a batch of log entries through the rules.
+    :param rules: as returned by compile_rules()
+    :param entries: list of log entries
+    :return: list of incidents, one per entry and rule it matches, with the same columns as the incidents history
+    """
+    incidents = []
+    for metric, predicate in rules:
+        for entry in entries:
+            if predicate(entry):
+                proto_payload = entry.get('protoPayload', _EMPTY)
+                incidents.append({'timestamp': entry.get('timestamp'),
+                                  'project': entry.get('resource', _EMPTY).get('labels', _EMPTY).get('project_id'),
+                                  'offender': proto_payload.get('authenticationInfo', _EMPTY).get('principalEmail'),
+                                  'offenceType': metric['offence_type'],
+                                  'methodName': proto_payload.get('methodName'),
+                                  'resourceName': proto_payload.get('resourceName'),
+                                  'insertId': entry.get('insertId')})
+
+    incidents.sort(key=lambda incident: incident['timestamp'])
+    return incidents
+
+
+def micro_batches(entries, batch_size=BATCH_SIZE, batch_seconds=BATCH_SECONDS):
+    """
+    Groups a stream of log entries into batches of at most batch_size entries, and at most batch_seconds old.
+    :param entries: iterable of log entries, or of None whenever no entry arrived for a while
+    :return: generator of lists of log entries
+    """
+    batch = []
+    batch_start = time.time()
+    for entry in entries:
+        if entry is not None:
+            if not batch:
+                batch_start = time.time()
+            batch.append(entry)
+
+        if len(batch) >= batch_size or (batch and time.time() - batch_start >= batch_seconds):
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def run(rules, entries, on_incidents):
+    """
+    Evaluates a stream of log entries in micro-batches.
+    :param on_incidents: function called with the list of incidents found in every batch that has any
+    :return: tuple of (number of entries, number of incidents)
+    """
+    entry_count = 0
+    incident_count = 0
+    for batch in micro_batches(entries):
+        incidents = evaluate(rules, batch)
+        entry_count += len(batch)
+        incident_count += len(incidents)
+        if incidents:
+            on_incidents(incidents)
+
+    return entry_count, incident_count
+
+
+def read_log_entries(input_file_names):
+    """
+    Replays log entries from newline delimited JSON files, e.g. as written by "gcloud logging read --format=json"
+    once flattened to one entry per line, or by a Cloud Storage log sink.
+    :return: generator of log entries
+    """
+    for input_file_name in input_file_names:
+        with open(input_file_name) as input_file:
+            for line in input_file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def pull_log_entries(subscription_id=AUDIT_LOGS_SUBSCRIPTION_ID, poll_seconds=BATCH_SECONDS):
+    """
+    Streams log entries from the Pub/Sub subscription of the log sink created by create_pubsub_sink().
+    Messages are acknowledged as soon as they are received.
+    :return: generator of log entries, and of None whenever nothing arrived for poll_seconds
+    """
+    from google.cloud import pubsub_v1
+
+    try:
+        import queue
+    except ImportError:
+        import Queue as queue
+
+    received = queue.Queue()
+
+    def callback(message):
+        received.put(json.loads(message.data.decode('utf-8')))
+        message.ack()
+
+    subscriber = pubsub_v1.SubscriberClient()
+    future = subscriber.subscribe(subscriber.subscription_path(PROJECT_ID, subscription_id), callback=callback)
+
+    try:
+        while True:
+            try:
+                yield received.get(timeout=poll_seconds)
+            except queue.Empty:
+                yield None
+    finally:
+        future.cancel()
+
+
+def create_pubsub_sink():
+    """
+    Routes the audit logs that any of the rules may match to a Pub/Sub topic, and subscribes to it.
+    Refer to: https://cloud.google.com/logging/docs/export/configure_export_v2
+
+    :return: None
+    """
+    log_filter = ' OR '.join('({})'.format(metric['log_filter']) for metric in audit_monitoring_setup.audit_metrics())
+
+    run_command('gcloud pubsub topics create {} --project={}'.format(AUDIT_LOGS_TOPIC_ID, PROJECT_ID), 'already exists')
+    run_command('gcloud logging sinks create {} pubsub.googleapis.com/projects/{}/topics/{} --log-filter="{}" '
+                '--project={}'.format(AUDIT_LOGS_PUBSUB_SINK_NAME, PROJECT_ID, AUDIT_LOGS_TOPIC_ID,
+                                      log_filter.replace('"', '\\"'), PROJECT_ID), 'already exists')
+
+    # The sink writes as its own service account, which must be allowed to publish to the topic:
+    writer_identity = run_command('gcloud logging sinks describe {} --project={} --format="value(writerIdentity)"'
+                                  .format(AUDIT_LOGS_PUBSUB_SINK_NAME, PROJECT_ID)).strip()
+    run_command('gcloud pubsub topics add-iam-policy-binding {} --member={} --role=roles/pubsub.publisher --project={}'
+                .format(AUDIT_LOGS_TOPIC_ID, writer_identity, PROJECT_ID))
+
+    run_command('gcloud pubsub subscriptions create {} --topic={} --project={}'
+                .format(AUDIT_LOGS_SUBSCRIPTION_ID, AUDIT_LOGS_TOPIC_ID, PROJECT_ID), 'already exists')
+
+
+def synthetic_log_entries(count, incident_rate=0.01):
+    """
+    Generates audit log entries for benchmarking: mostly harmless reads and writes, and incident_rate of them
+    matching one of the rules.
+    :return: list of log entries
+    """
+    rng = random.Random(0)
+    whitelisted = [user.strip() for user in WHITELIST_USERS.split('AND')]
+
+    def entry(resource_type, log, service, method, resource_name, principal):
+        return {'insertId': '{:016x}'.format(rng.getrandbits(64)),
+                'logName': 'projects/{}/logs/cloudaudit.googleapis.com%2F{}'.format(PROJECT_ID, log),
+                'resource': {'type': resource_type, 'labels': {'project_id': PROJECT_ID}},
+                'timestamp': '2019-01-31T10:{:02d}:{:02d}.{:06d}Z'.format(rng.randrange(60), rng.randrange(60),
+                                                                          rng.randrange(1000000)),
+                'protoPayload': {'@type': 'type.googleapis.com/google.cloud.audit.AuditLog',
+                                 'serviceName': service, 'methodName': method, 'resourceName': resource_name,
+                                 'authenticationInfo': {'principalEmail': principal}}}
+
+    data_bucket = 'projects/_/buckets/{}'.format(DATA_BUCKET_ID)
+    harmless = [
+        lambda: entry('gcs_bucket', 'data_access', 'storage.googleapis.com', 'storage.objects.get',
+                      data_bucket + '/objects/scan-{}.dcm'.format(rng.randrange(10000)), rng.choice(whitelisted)),
+        lambda: entry('gcs_bucket', 'data_access', 'storage.googleapis.com', 'storage.objects.get',
+                      'projects/_/buckets/{}/objects/log'.format(LOGS_BUCKET_ID), 'someone@acme.com'),
+        lambda: entry('gcs_bucket', 'activity', 'storage.googleapis.com', 'storage.objects.create',
+                      data_bucket + '/objects/scan.dcm', rng.choice(whitelisted)),
+        lambda: entry('project', 'activity', 'cloudresourcemanager.googleapis.com', 'GetIamPolicy',
+                      'projects/{}'.format(PROJECT_ID), 'auditor@acme.com'),
+        lambda: entry('bigquery_dataset', 'data_access', 'bigquery.googleapis.com', 'jobservice.query',
+                      'projects/{}/datasets/cloudlogs'.format(PROJECT_ID), 'analyst@acme.com'),
+    ]
+    offensive = [
+        lambda: entry('project', 'activity', 'cloudresourcemanager.googleapis.com', 'SetIamPolicy',
+                      'projects/{}'.format(PROJECT_ID), 'intruder@acme.com'),
+        lambda: entry('gcs_bucket', 'activity', 'storage.googleapis.com', 'storage.setIamPermissions',
+                      data_bucket, 'intruder@acme.com'),
+        lambda: entry('gcs_bucket', 'data_access', 'storage.googleapis.com', 'storage.objects.get',
+                      data_bucket, 'intruder@acme.com'),
+    ]
+
+    return [rng.choice(offensive)() if rng.random() < incident_rate else rng.choice(harmless)()
+            for _ in range(count)]
+
+
+def benchmark(count):
+    """
+    Measures how many log entries per second the rules are evaluated against, on synthetic log entries.
+    :param count: the number of log entries
+    :return: None
+    """
+    print('generating {} synthetic log entries...'.format(count))
+    entries = synthetic_log_entries(count)
+
+    start_time = time.time()
+    rules = compile_rules()
+    compile_seconds = time.time() - start_time
+
+    start_time = time.time()
+    entry_count, incident_count = run(rules, iter(entries), lambda incidents: None)
+    seconds = time.time() - start_time
+
+    print('compiled {} rules in {:.1f} ms'.format(len(rules), compile_seconds * 1000))
+    print('evaluated {} entries in {:.2f} s, {:.0f} entries/s, {} incidents'
+          .format(entry_count, seconds, entry_count / seconds, incident_count))
+
+
+def print_incidents(incidents):
+    for incident in incidents:
+        print(json.dumps(incident))
+    sys.stdout.flush()
+
+
+def usage():
+    print('\nusage: python audit_rules.py replay [log entries .json file] ...\n'
+          '       python audit_rules.py sink\n'
+          '       python audit_rules.py pull\n'
+          '       python audit_rules.py benchmark [number of log entries]\n')
+
+
+def main():
+    """
+    This is how you execute this script:
+
+    python audit_rules.py replay [log entries .json file] ...
+        runs the log entries in the files, one JSON log entry per line, through the rules.
+
+    python audit_rules.py sink
+        creates a log sink that routes the audit logs to a Pub/Sub topic, and a subscription to it.
+
+    python audit_rules.py pull
+        runs the audit logs through the rules as they arrive on the subscription, until interrupted.
+
+    python audit_rules.py benchmark [number of log entries]
+        measures the throughput of the rules on synthetic log entries.
+
+    Every incident is printed as a line of JSON, with the same columns as the incidents history in BigQuery.
+    """
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+
+    if command == 'replay' and len(sys.argv) > 2:
+        entry_count, incident_count = run(compile_rules(), read_log_entries(sys.argv[2:]), print_incidents)
+        sys.stderr.write('{} incidents among {} log entries.\n'.format(incident_count, entry_count))
+    elif command == 'sink' and len(sys.argv) == 2:
+        create_pubsub_sink()
+    elif command == 'pull' and len(sys.argv) == 2:
+        try:
+            run(compile_rules(), pull_log_entries(), print_incidents)
+        except KeyboardInterrupt:
+            pass
+    elif command == 'benchmark' and len(sys.argv) <= 3:
+        benchmark(int(sys.argv[2]) if len(sys.argv) == 3 else 1000000)
+    else:
+        usage()
+
+
+def __tokenize(log_filter):
+    """
+    Splits a filter into (, ), AND, OR, NOT, comparisons as (path, operator, value) and bare values.
+    A comparison whose value is a list in parentheses comes out as (path, operator, None) followed by "(".
+    """
+    tokens = []
+    for token in re.findall(r'"(?:[^"\\]|\\.)*"|[()]|[^\s()"]+(?:"(?:[^"\\]|\\.)*")?', log_filter):
+        match = re.match(r'^([A-Za-z_@][\w@.]*)(!=|=|:)(.*)$', token)
+        if match is not None:
+            path, operator, value = match.groups()
+            tokens.append((path, operator, __unquote(value) if value else None))
+        elif token in ('(', ')', 'AND', 'OR', 'NOT'):
+            tokens.append(token)
+        else:
+            tokens.append(('', None, __unquote(token)))
+
+    return tokens
+
+
+def __unquote(value):
+    return json.loads(value) if value.startswith('"') else value
+
+
+def __parse_and(tokens, position):
+    position, predicate = __parse_or(tokens, position)
+    predicates = [predicate]
+    while position < len(tokens) and tokens[position] != ')' and tokens[position] != 'OR':
+        if tokens[position] == 'AND':
+            position += 1
+        position, predicate = __parse_or(tokens, position)
+        predicates.append(predicate)
+
+    return position, __all_of(predicates)
+
+
+def __parse_or(tokens, position):
+    position, predicate = __parse_not(tokens, position)
+    predicates = [predicate]
+    while position < len(tokens) and tokens[position] == 'OR':
+        position, predicate = __parse_not(tokens, position + 1)
+        predicates.append(predicate)
+
+    return position, __any_of(predicates)
+
+
+def __parse_not(tokens, position):
+    if position >= len(tokens):
+        raise ValueError('log filter ends unexpectedly')
+
+    token = tokens[position]
+    if token == 'NOT':
+        position, predicate = __parse_not(tokens, position + 1)
+        return position, lambda entry: not predicate(entry)
+
+    if token == '(':
+        position, predicate = __parse_and(tokens, position + 1)
+        return __expect(tokens, position, ')'), predicate
+
+    if not isinstance(token, tuple) or token[1] is None:
+        raise ValueError('expected a comparison in log filter, found "{}"'.format(token))
+
+    path, operator, value = token
+    if value is not None:
+        return position + 1, __comparison(path, operator, value)
+
+    # A list of values, e.g. principalEmail!=(a AND b), compares the field with each of them.
+    position = __expect(tokens, position + 1, '(')
+    values, connectives = [], []
+    while True:
+        if not isinstance(tokens[position], tuple) or tokens[position][1] is not None:
+            raise ValueError('expected a value in log filter, found "{}"'.format(tokens[position]))
+        values.append(tokens[position][2])
+        position += 1
+        if tokens[position] in ('AND', 'OR'):
+            connectives.append(tokens[position])
+            position += 1
+        else:
+            break
+
+    position = __expect(tokens, position, ')')
+    predicates = [__comparison(path, operator, value) for value in values]
+    if connectives and all(connective == 'OR' for connective in connectives):
+        return position, __any_of(predicates)
+
+    return position, __all_of(predicates)
+
+
+def __expect(tokens, position, token):
+    if position >= len(tokens) or tokens[position] != token:
+        raise ValueError('expected "{}" in log filter'.format(token))
+
+    return position + 1
+
+
+def __all_of(predicates):
+    if len(predicates) == 1:
+        return predicates[0]
+
+    def all_of(entry):
+        for predicate in predicates:
+            if not predicate(entry):
+                return False
+        return True
+
+    return all_of
+
+
+def __any_of(predicates):
+    if len(predicates) == 1:
+        return predicates[0]
+
+    def any_of(entry):
+        for predicate in predicates:
+            if predicate(entry):
+                return True
+        return False
+
+    return any_of
+
+
+def __field(keys):
+    """
+    :return: function of a log entry to the value at the path of keys, e.g. ['resource', 'type'] for
+    entry['resource']['type'], or None if any of them is missing
+    """
+    if len(keys) == 1:
+        key = keys[0]
+        return lambda entry: entry.get(key)
+
+    parent, key = __field(keys[:-1]), keys[-1]
+    return lambda entry: (parent(entry) or _EMPTY).get(key)
+
+
+def __comparison(path, operator, value):
+    field = __field(path.split('.'))
+
+    if operator == '=':
+        return lambda entry: field(entry) == value
+    elif operator == '!=':
+        return lambda entry: field(entry) != value
+    else:
+        return lambda entry: value in (field(entry) or '')
+
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,7 @@
 
 from utils import *
 from parameters import *
+from lock_down_state import normalize_bindings
 
 
 def create_logs_bucket():
@@ -49,6 +50,47 @@ def create_data_bucket():
     __set_data_bucket_access()
 
 
+def plan_bucket_changes(state):
+    """
+    Compares the current state of the buckets against the desired state defined by this script
+    and lists the changes required to reconcile them.
+
+    :param state: the current state as read by lock_down_state.read_current_state()
+
+    :return: list of (description, function) tuples; calling the functions in order applies the changes.
+    """
+
+    changes = []
+
+    if state['logs_bucket_iam'] is None:
+        changes.append(('Create logs bucket gs://{}'.format(LOGS_BUCKET_ID), create_logs_bucket))
+    else:
+        if normalize_bindings(state['logs_bucket_iam'].get('bindings')) != \
+                normalize_bindings(__logs_bucket_policy()['bindings']):
+            changes.append(('Set IAM policy of gs://{}'.format(LOGS_BUCKET_ID), __set_log_bucket_access))
+
+        if (state['logs_bucket_life_cycle'] or {}).get('rule') != __logs_life_cycle()['lifecycle']['rule']:
+            changes.append(('Set life cycle of gs://{}'.format(LOGS_BUCKET_ID), __set_log_life_cycle))
+
+    if state['data_bucket_iam'] is None:
+        changes.append(('Create data bucket gs://{}'.format(DATA_BUCKET_ID), create_data_bucket))
+    else:
+        if (state['data_bucket_logging'] or {}).get('logBucket') != LOGS_BUCKET_ID:
+            changes.append(('Turn on access logging for gs://{}'.format(DATA_BUCKET_ID),
+                            lambda: run_command('gsutil logging set on -b gs://{} gs://{}'
+                                                .format(LOGS_BUCKET_ID, DATA_BUCKET_ID))))
+
+        if not state['data_bucket_versioning']:
+            changes.append(('Turn on versioning for gs://{}'.format(DATA_BUCKET_ID),
+                            lambda: run_command('gsutil versioning set on gs://{}'.format(DATA_BUCKET_ID))))
+
+        if normalize_bindings(state['data_bucket_iam'].get('bindings')) != \
+                normalize_bindings(__data_bucket_policy()['bindings']):
+            changes.append(('Set IAM policy of gs://{}'.format(DATA_BUCKET_ID), __set_data_bucket_access))
+
+    return changes
+
+
 def __set_log_bucket_access():
     """
     Creates a temp json file to define the IAM roles according to best practices
@@ -58,7 +100,62 @@ def __set_log_bucket_access():
     :return: None
     """
 
-    iam_binding = {
+    iam_binding = __logs_bucket_policy()
+
+    save_JSON(iam_binding, 'tmp_iam_binding.json')
+    run_command('gsutil iam set tmp_iam_binding.json gs://{}'.format(LOGS_BUCKET_ID) )
+
+    # When done, remove the temp file.
+    run_command('rm tmp_iam_binding.json')
+
+
+def __set_log_life_cycle():
+    """
+    Creates a temp JSON file to define Time to Live (TTL) policy for the logs
+    and uses that to set the lifecycle for the log files.
+
+    :return: None
+    """
+
+    iam_binding = __logs_life_cycle()
+
+    save_JSON(iam_binding, 'tmp_ttl.json')
+
+    # Use the temp json file to set TTL policy for the logs bucket
+    run_command( 'gsutil lifecycle set tmp_ttl.json gs://{}'.format(LOGS_BUCKET_ID) )
+
+    # When done, remove the temp file.
+    run_command('rm tmp_ttl.json')
+
+
+def __set_data_bucket_access():
+    """
+    Creates a temp json file to define IAM roles according to best practices
+    and uses the JSON file to set the access rights against the data bucket.
+    Note: For details refer to https://cloud.google.com/storage/docs/access-control/iam-roles
+
+    :return: None
+    """
+
+    iam_binding = __data_bucket_policy()
+
+    save_JSON(iam_binding, 'tmp_iam_binding.json')
+
+    # Use the temp json file to overwrite existing legacy policies with above-defined roles.
+    run_command('gsutil iam set tmp_iam_binding.json gs://{}'.format(DATA_BUCKET_ID))
+
+    # When done, remove the temp file.
+    run_command('rm tmp_iam_binding.json')
+
+
+def __logs_bucket_policy():
+    """
+    Defines the IAM roles for the log bucket according to best practices.
+
+    :return: the IAM policy as expected by "gsutil iam set"
+    """
+
+    return {
         "bindings": [
             {
                 # Grant admin access to AUDITORS_GROUP:
@@ -82,22 +179,15 @@ def __set_log_bucket_access():
         ]
     }
 
-    save_JSON(iam_binding, 'tmp_iam_binding.json')
-    run_command('gsutil iam set tmp_iam_binding.json gs://{}'.format(LOGS_BUCKET_ID) )
 
-    # When done, remove the temp file.
-    run_command('rm tmp_iam_binding.json')
-
-
-def __set_log_life_cycle():
+def __logs_life_cycle():
     """
-    Creates a temp JSON file to define Time to Live (TTL) policy for the logs
-    and uses that to set the lifecycle for the log files.
+    Defines Time to Live (TTL) policy for the logs.
 
-    :return: None
+    :return: the life cycle configuration as expected by "gsutil lifecycle set"
     """
 
-    iam_binding = {
+    return {
         "lifecycle": {
             "rule": [
                 {
@@ -108,25 +198,15 @@ def __set_log_life_cycle():
         }
     }
 
-    save_JSON(iam_binding, 'tmp_ttl.json')
-
-    # Use the temp json file to set TTL policy for the logs bucket
-    run_command( 'gsutil lifecycle set tmp_ttl.json gs://{}'.format(LOGS_BUCKET_ID) )
-
-    # When done, remove the temp file.
-    run_command('rm tmp_ttl.json')
-
 
-def __set_data_bucket_access():
+def __data_bucket_policy():
     """
-    Creates a temp json file to define IAM roles according to best practices
-    and uses the JSON file to set the access rights against the data bucket.
-    Note: For details refer to https://cloud.google.com/storage/docs/access-control/iam-roles
+    Defines the IAM roles for the data bucket according to best practices.
 
-    :return: None
+    :return: the IAM policy as expected by "gsutil iam set"
     """
 
-    iam_binding = {
+    return {
         "bindings": [
             {
                 "members": [
@@ -148,11 +228,3 @@ def __set_data_bucket_access():
             }
         ]
     }
-
-    save_JSON(iam_binding, 'tmp_iam_binding.json')
-
-    # Use the temp json file to overwrite existing legacy policies with above-defined roles.
-    run_command('gsutil iam set tmp_iam_binding.json gs://{}'.format(DATA_BUCKET_ID))
-
-    # When done, remove the temp file.
-    run_command('rm tmp_iam_binding.json')
@@ -0,0 +1,174 @@
+from utils import *
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+import csv
+import os
+import subprocess
+import sys
+import time
+
+# Values of these parameters are numbers; every other parameter read from a CSV file is a string.
+NUMERIC_PARAMETERS = ['LOGS_TTL', 'INCIDENTS_QUERY_MAX_BYTES']
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def read_parameter_sets(parameters_file):
+    """
+    Reads one set of parameters per project from a CSV or YAML file.
+
+    A CSV file has a header row naming the parameters, e.g:
+        PROJECT_ID,CONTENT_TYPE,WHITELIST_USERS
+        project-a,genomics,user1@acme.com AND user2@acme.com
+
+    A YAML file is a list of mappings with the same keys, e.g:
+        - PROJECT_ID: project-a
+          CONTENT_TYPE: genomics
+
+    Any parameter from parameters.py marked with "CHANGE ME!" can be specified; the ones left out keep
+    their value from parameters.py. Parameters derived from PROJECT_ID (groups, buckets, etc.) are derived per project.
+
+    :param parameters_file: path to the .csv, .yaml or .yml file
+
+    :return: list of dictionaries, one per project.
+    """
+    if parameters_file.endswith('.csv'):
+        with open(parameters_file) as csv_file:
+            parameter_sets = [dict((key, value) for key, value in row.items() if value) for row in csv.DictReader(csv_file)]
+
+        for parameter_set in parameter_sets:
+            for key in NUMERIC_PARAMETERS:
+                if key in parameter_set:
+                    parameter_set[key] = int(parameter_set[key])
+    else:
+        import yaml
+        with open(parameters_file) as yaml_file:
+            parameter_sets = yaml.safe_load(yaml_file) or []
+
+    for parameter_set in parameter_sets:
+        assert parameter_set.get('PROJECT_ID'), 'every project must specify PROJECT_ID!'
+
+    project_ids = [parameter_set['PROJECT_ID'] for parameter_set in parameter_sets]
+    assert len(project_ids) == len(set(project_ids)), 'every project must be listed only once!'
+
+    return parameter_sets
+
+
+def lock_down(parameter_set, mode, run_dir, account):
+    """
+    Runs project_setup.py for a single project in a separate process.
+
+    Each project gets its own working directory holding its parameters, its temp files and its log,
+    so concurrent runs never share the tmp_*.json files project_setup.py creates in its working directory.
+    Each project also gets its own gcloud configuration, named fleet-[PROJECT_ID], which its process uses through
+    CLOUDSDK_ACTIVE_CONFIG_NAME; so concurrent runs never set the account or project of each other's configuration,
+    and the configuration active in your shell stays as it is.
+
+    :param parameter_set: the parameters of the project
+    :param mode: "plan" or "apply", as accepted by project_setup.py
+    :param run_dir: the directory where the working directories of all projects are created
+    :param account: the account to use, unless the parameters of the project specify ACCOUNT
+
+    :return: a dictionary describing the outcome for the project.
+    """
+    project_id = parameter_set['PROJECT_ID']
+    work_dir = os.path.join(run_dir, project_id)
+    os.makedirs(work_dir)
+
+    config_name = 'fleet-{}'.format(project_id)
+    parameter_set = dict(parameter_set, CONFIG_NAME=config_name)
+
+    parameters_path = os.path.join(work_dir, 'parameters.json')
+    save_pretty_JSON(parameter_set, parameters_path)
+
+    env = dict(os.environ)
+    env['LOCK_DOWN_PARAMETERS'] = parameters_path
+    env['CLOUDSDK_ACTIVE_CONFIG_NAME'] = config_name
+    run_command('gcloud config configurations create {} --no-activate'.format(config_name), 'already exists',
+                chatty=False)
+    account = parameter_set.get('ACCOUNT', account)
+    if account:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(['gcloud', 'config', 'set', 'account', account], env=env, stdout=devnull,
+                            stderr=subprocess.STDOUT)
+    env['PYTHONPATH'] = os.pathsep.join([SCRIPT_DIR, os.path.dirname(SCRIPT_DIR), env.get('PYTHONPATH', '')])
+
+    log_path = os.path.join(work_dir, 'output.log')
+    print('>>>{} {}...'.format(mode, project_id))
+
+    start = time.time()
+    with open(log_path, 'w') as log_file:
+        return_code = subprocess.call([sys.executable, os.path.join(SCRIPT_DIR, 'project_setup.py'), mode],
+                                      cwd=work_dir, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+
+    with open(log_path) as log_file:
+        output = log_file.read()
+
+    result = {
+        'project_id': project_id,
+        'succeeded': return_code == 0 and 'Execution interrupted' not in output,
+        'planned_changes': [line.replace('>>>planned: ', '') for line in output.splitlines()
+                            if line.startswith('>>>planned: ')],
+        'seconds': round(time.time() - start, 1),
+        'log': log_path
+    }
+    print('>>>{} {} in {} seconds.'.format(project_id, 'succeeded' if result['succeeded'] else 'FAILED',
+                                            result['seconds']))
+
+    return result
+
+
+def usage():
+    print('\nusage: python fleet.py [projects .csv/.yaml file] [plan | apply] [max concurrent projects]\n')
+
+
+def main():
+    """
+    This is how you execute this script:
+
+    python fleet.py [projects .csv/.yaml file] [plan | apply] [max concurrent projects]
+
+    [projects .csv/.yaml file]: One set of parameters per project; see read_parameter_sets().
+
+    [plan | apply]: The mode project_setup.py runs in for every project.
+
+    [max concurrent projects]: The global limit on the number of projects locked down at the same time.
+    Keep it low enough for the commands of all concurrent projects to stay within your API quota.
+
+    It runs project_setup.py for every project, writes a consolidated report of the outcomes into
+    fleet_report.json and prints a summary. All the files of a run are kept under fleet-runs/[run time]/.
+    """
+
+    if len(sys.argv) != 4 or sys.argv[2] not in ('plan', 'apply'):
+        usage()
+        return
+
+    parameter_sets = read_parameter_sets(sys.argv[1])
+    mode = sys.argv[2]
+    concurrency = int(sys.argv[3])
+
+    run_dir = os.path.abspath(os.path.join('fleet-runs', datetime.now().strftime('%Y%m%d-%H%M%S')))
+    os.makedirs(run_dir)
+
+    # The account of the configuration active in your shell, for the projects that don't specify ACCOUNT:
+    account = try_command('gcloud config get-value account')
+
+    pool = ThreadPool(concurrency)
+    try:
+        results = pool.map(lambda parameter_set: lock_down(parameter_set, mode, run_dir, account), parameter_sets,
+                           chunksize=1)
+    finally:
+        pool.close()
+
+    report_path = os.path.join(run_dir, 'fleet_report.json')
+    save_pretty_JSON({'mode': mode, 'projects': results}, report_path)
+
+    failed = [result['project_id'] for result in results if not result['succeeded']]
+    print('{} of {} projects succeeded; report saved to {}'.format(len(results) - len(failed), len(results),
+                                                                   report_path))
+    if failed:
+        print('Failed projects: {}'.format(', '.join(failed)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,433 @@
+from utils import *
+from parameters import *
+from datetime import datetime
+import functools
+import os
+import sys
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+
+def get_incidents_history(start_date=None, end_date=None, max_bytes=INCIDENTS_QUERY_MAX_BYTES):
+    """
+    Queries the history of "offensive" actions from the audit logs exported to BigQuery and prints it.
+
+    The audit logs are exported into one table per day, e.g. cloudaudit_googleapis_com_activity_20180611.
+    Only the tables of the days within the date range are scanned; unless a date range is specified,
+    the entire history is scanned.
+
+    :param start_date: first day of interest in YYYYMMDD format for e.g: 20180611
+
+    :param end_date: last day of interest in YYYYMMDD format for e.g: 20180630
+
+    :param max_bytes: the most bytes the query may scan. If the dry run estimates more, the query is not run.
+
+    :return: list of incidents, in reverse chronological order. Each incident has timestamp, project,
+    offender and offenceType fields.
+    """
+    for date in (start_date, end_date):
+        assert (date is None or datetime.strptime(date, "%Y%m%d")), "date must be of format YYYYMMDD!"
+
+    table_suffix_condition = '_TABLE_SUFFIX BETWEEN "{}" AND "{}"'.format(start_date or '0', end_date or '99999999')
+
+    job = __run_query('{} ORDER BY timestamp DESC'.format(__incidents_query(table_suffix_condition)), max_bytes)
+
+    incidents = list(job.result())
+    for incident in incidents:
+        print('{}  {}  {}  {}'.format(incident['timestamp'], incident['project'], incident['offender'],
+                                      incident['offenceType']))
+
+    return incidents
+
+
+def analyze_exported_logs(input_paths):
+    """
+    Finds the history of "offensive" actions in audit logs exported out of BigQuery or Cloud Logging, locally and
+    without any BigQuery scan costs.
+
+    The logs are read in record batches with pyarrow, and each batch is classified with vectorized compute functions
+    rather than row by row, into the same incidents as get_incidents_history(). Only the columns the classification
+    needs are read, so tens of GB of Parquet take minutes on one machine.
+
+    :param input_paths: files or directories of exported audit logs, either Parquet, e.g. from "bq extract
+    --destination_format=PARQUET", or newline delimited JSON LogEntries, e.g. from a Cloud Storage log sink.
+    The format is told by the content of each file, so a directory may hold either or both.
+
+    :return: pyarrow Table of incidents, in reverse chronological order, with timestamp, project, offender and
+    offenceType columns.
+    """
+    import pyarrow
+    import pyarrow.dataset
+
+    paths_by_format = {'parquet': [], 'json': []}
+    for path in __files_in(input_paths):
+        paths_by_format[__file_format(path)].append(path)
+
+    incidents = []
+    for file_format in ('parquet', 'json'):
+        if not paths_by_format[file_format]:
+            continue
+
+        dataset = pyarrow.dataset.dataset(paths_by_format[file_format], format=file_format)
+        # Row groups of other resource types are skipped based on their statistics, without being read.
+        resource_filter = pyarrow.dataset.field('resource', 'type').isin(['project', 'gcs_bucket'])
+        for batch in dataset.to_batches(columns=__audit_log_columns(dataset.schema), filter=resource_filter):
+            incidents.append(__classify_audit_logs(batch))
+
+    if not incidents:
+        return pyarrow.Table.from_pydict({'timestamp': [], 'project': [], 'offender': [], 'offenceType': []})
+
+    return pyarrow.concat_tables(incidents).sort_by([('timestamp', 'descending')])
+
+
+def materialize_incidents(max_bytes=INCIDENTS_QUERY_MAX_BYTES):
+    """
+    Keeps the INCIDENTS_TABLE_ID table up to date with the history of "offensive" actions.
+
+    The first time, the entire history is written into the table. From then on, only the tables of
+    yesterday and today are scanned, and the incidents of those two days in the table are replaced with them.
+    Querying INCIDENTS_TABLE_ID then costs a fraction of querying the audit logs.
+
+    :param max_bytes: the most bytes the query may scan. If the dry run estimates more, the query is not run.
+
+    :return: None
+    """
+    from google.cloud import bigquery
+    from google.cloud.exceptions import NotFound
+
+    client = bigquery.Client(project=PROJECT_ID)
+    table_ref = client.dataset(LOGS_SINK_DATASET_ID).table(INCIDENTS_TABLE_ID)
+
+    try:
+        client.get_table(table_ref)
+    except NotFound:
+        __run_query(__incidents_query('TRUE'), max_bytes, table_ref, bigquery.WriteDisposition.WRITE_TRUNCATE)
+    else:
+        __run_query(__incremental_incidents_query(), max_bytes)
+
+    print('{}:{} holds {} incidents.'.format(LOGS_SINK_DATASET_ID, INCIDENTS_TABLE_ID,
+                                             client.get_table(table_ref).num_rows))
+
+
+def schedule_incidents_materialization(schedule='every 1 hours'):
+    """
+    Creates a BigQuery scheduled query that keeps the last two days of the INCIDENTS_TABLE_ID table up to date.
+    Refer to: https://cloud.google.com/bigquery/docs/scheduling-queries
+
+    :param schedule: how often the scheduled query runs. Refer to:
+    https://cloud.google.com/appengine/docs/flexible/python/scheduling-jobs-with-cron-yaml#the_schedule_format
+
+    :return: None
+    """
+    # The scheduled query only refreshes the last two days of the table, so populate it with the entire history first:
+    materialize_incidents()
+
+    # The query writes into the table itself, so it has no destination table.
+    params = {
+        'query': __incremental_incidents_query()
+    }
+
+    run_command('bq mk --transfer_config --project_id={} --display_name={} '
+                '--data_source=scheduled_query --schedule={} --params={}'
+                .format(PROJECT_ID, quote('Materialize {}'.format(INCIDENTS_TABLE_ID)),
+                        quote(schedule), quote(json.dumps(params))))
+
+
+def estimate_bytes_scanned(query):
+    """
+    Estimates the number of bytes the query would scan by doing a dry run.
+    Refer to: https://cloud.google.com/bigquery/docs/dry-run-queries
+
+    :param query: a standard SQL query
+
+    :return: the number of bytes the query would scan
+    """
+    from google.cloud import bigquery
+
+    job_config = bigquery.QueryJobConfig()
+    job_config.dry_run = True
+    job_config.use_query_cache = False
+
+    return bigquery.Client(project=PROJECT_ID).query(query, job_config=job_config).total_bytes_processed
+
+
+def __run_query(query, max_bytes, destination=None, write_disposition=None):
+    """
+    Runs the query unless the dry run estimates that it would scan more than max_bytes.
+    The query is also billed at most max_bytes, in case the estimate falls short.
+    Once the query completes, the bytes it processed and the slot time it consumed are printed.
+
+    :param query: a standard SQL query
+
+    :param max_bytes: the most bytes the query may scan
+
+    :param destination: the table the results are written to, if any
+
+    :param write_disposition: how the results are written to the destination table
+
+    :return: the completed query job
+    """
+    from google.cloud import bigquery
+
+    bytes_scanned = estimate_bytes_scanned(query)
+    if bytes_scanned > max_bytes:
+        raise Exception('The query would scan {} bytes, more than the {} bytes allowed. '
+                        'Narrow down the date range or raise the limit.'.format(bytes_scanned, max_bytes))
+
+    job_config = bigquery.QueryJobConfig()
+    job_config.maximum_bytes_billed = max_bytes
+    if destination is not None:
+        job_config.destination = destination
+        job_config.write_disposition = write_disposition
+
+    job = bigquery.Client(project=PROJECT_ID).query(query, job_config=job_config)
+    job.result()  # Waits for the query to complete.
+
+    print('Query processed {} bytes, billed {} bytes and consumed {} slot milliseconds.'
+          .format(job.total_bytes_processed, job.total_bytes_billed, job.slot_millis))
+
+    return job
+
+
+def __incremental_incidents_query():
+    """
+    Builds a multi-statement query that replaces the incidents of yesterday and today in the INCIDENTS_TABLE_ID table
+    with those in the audit log tables of the same days, in one transaction.
+
+    Comparing timestamps against the latest incident in the table would skip the audit logs that arrive late, and
+    a second incident with the same timestamp as the latest one. Re-writing both days instead picks up anything
+    logged since the last run, however late, as long as it's within those days; yesterday is included to cover
+    the incidents logged just before midnight. The audit log tables are split by the UTC date of timestamp, so
+    the incidents deleted are exactly those the tables of the two days hold.
+
+    :return: the query
+    """
+    table_suffix_condition = '_TABLE_SUFFIX >= FORMAT_DATE("%Y%m%d", DATE_SUB(CURRENT_DATE(), INTERVAL 1 DAY))'
+    table = '`{}.{}.{}`'.format(PROJECT_ID, LOGS_SINK_DATASET_ID, INCIDENTS_TABLE_ID)
+
+    return 'BEGIN TRANSACTION; ' \
+           'DELETE FROM {0} WHERE timestamp >= TIMESTAMP(DATE_SUB(CURRENT_DATE(), INTERVAL 1 DAY)); ' \
+           'INSERT INTO {0} (timestamp, project, offender, offenceType) {1}; ' \
+           'COMMIT TRANSACTION;'.format(table, __incidents_query(table_suffix_condition))
+
+
+def __whitelist_users():
+    # Convert: "user1@google.com AND user2@google.com" to ['user1@google.com', 'user2@google.com']
+    return [user.replace(' ', '') for user in WHITELIST_USERS.split('AND')]
+
+
+def __files_in(input_paths):
+    """
+    Lists the files among the input paths, and in the directories among them, recursively.
+    Like pyarrow does, files whose names start with . or _, e.g. _SUCCESS, are left out.
+
+    :param input_paths: files or directories
+
+    :return: list of file paths
+    """
+    files = []
+    for path in input_paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+
+        for directory, _, names in sorted(os.walk(path)):
+            files.extend(os.path.join(directory, name) for name in sorted(names) if not name.startswith(('.', '_')))
+
+    return files
+
+
+def __file_format(path):
+    """
+    :return: 'parquet' if the file starts with the Parquet magic number PAR1, 'json' otherwise.
+    """
+    with open(path, 'rb') as input_file:
+        return 'parquet' if input_file.read(4) == b'PAR1' else 'json'
+
+
+def __audit_log_columns(schema):
+    """
+    Projects the few fields the classification needs out of the nested audit logs.
+    Exports of BigQuery tables name the payload protopayload_auditlog, exports of Cloud Logging name it protoPayload.
+
+    :param schema: the pyarrow schema of the exported audit logs
+
+    :return: dictionary of column name to pyarrow dataset expression
+    """
+    import pyarrow
+    import pyarrow.dataset
+
+    payload = 'protopayload_auditlog' if 'protopayload_auditlog' in schema.names else 'protoPayload'
+
+    def column(*path):
+        field_type = schema
+        for name in path:
+            if not hasattr(field_type, 'get_field_index') or field_type.get_field_index(name) < 0:
+                # e.g. no entry of a JSON export has a resourceName
+                return pyarrow.dataset.scalar(pyarrow.scalar(None, pyarrow.string()))
+            field_type = field_type.field(name).type
+
+        return pyarrow.dataset.field(*path)
+
+    return {'timestamp': column('timestamp'),
+            'logName': column('logName'),
+            'resource_type': column('resource', 'type'),
+            'project': column('resource', 'labels', 'project_id'),
+            'serviceName': column(payload, 'serviceName'),
+            'methodName': column(payload, 'methodName'),
+            'resourceName': column(payload, 'resourceName'),
+            'offender': column(payload, 'authenticationInfo', 'principalEmail')}
+
+
+def __classify_audit_logs(batch):
+    """
+    Vectorized counterpart of __incidents_query(): the rows of the batch are classified into the three offenceTypes
+    with boolean masks, and a row belongs to at most one of them.
+
+    :param batch: pyarrow RecordBatch with the columns of __audit_log_columns()
+
+    :return: pyarrow Table of the incidents in the batch, with timestamp, project, offender and offenceType columns
+    """
+    import pyarrow
+    import pyarrow.compute as compute
+
+    def column(name):
+        return batch.column(batch.schema.get_field_index(name))
+
+    resource_type = column('resource_type')
+    service_name = column('serviceName')
+    method_name = column('methodName')
+    log_name = column('logName')
+    activity = compute.ends_with(log_name, 'activity')
+    data_access = compute.ends_with(log_name, 'data_access')
+
+    def all_of(*masks):
+        return functools.reduce(compute.and_kleene, masks)
+
+    resource_name = column('resourceName')
+    offender = column('offender')
+
+    masks = [
+        ('IAM Policy Tampering',
+         all_of(activity, compute.equal(resource_type, 'project'),
+                compute.equal(service_name, 'cloudresourcemanager.googleapis.com'),
+                compute.equal(method_name, 'SetIamPolicy'))),
+        ('Bucket Permission Tampering',
+         all_of(activity, compute.equal(resource_type, 'gcs_bucket'),
+                compute.equal(service_name, 'storage.googleapis.com'),
+                compute.is_in(method_name, value_set=pyarrow.array(['storage.setIamPermissions',
+                                                                     'storage.objects.update'])))),
+        # Like NOT IN in SQL, an access without a principalEmail is not an offence.
+        ('Unexpected Bucket Access',
+         all_of(data_access, compute.equal(resource_type, 'gcs_bucket'),
+                compute.or_kleene(compute.ends_with(resource_name, LOGS_BUCKET_ID),
+                                  compute.ends_with(resource_name, DATA_BUCKET_ID)),
+                compute.is_valid(offender),
+                compute.invert(compute.is_in(offender, value_set=pyarrow.array(__whitelist_users())))))]
+
+    # e.g. JSON timestamps are parsed into seconds without a time zone; unify them, so batches of both formats concat.
+    timestamp = column('timestamp')
+    if timestamp.type != pyarrow.timestamp('us', tz='UTC'):
+        timestamp = compute.cast(timestamp, pyarrow.timestamp('us', tz='UTC'))
+
+    table = pyarrow.Table.from_arrays([timestamp, column('project'), column('offender')],
+                                      names=['timestamp', 'project', 'offender'])
+
+    incidents = []
+    for offence_type, mask in masks:
+        offences = table.filter(compute.fill_null(mask, False))
+        incidents.append(offences.append_column('offenceType',
+                                                pyarrow.array([offence_type] * offences.num_rows, pyarrow.string())))
+
+    return pyarrow.concat_tables(incidents)
+
+
+def __incidents_query(table_suffix_condition):
+    """
+    Builds a query for the "offensive" actions among the audit logs in BigQuery.
+
+    Each audit log table is scanned once: IAM policy and bucket permission tampering both come from the activity logs,
+    so the rows of the activity logs are classified by offenceType with a CASE expression; unexpected bucket access
+    comes from the data access logs. A row belongs to at most one offenceType, so the two parts never overlap
+    and are combined with UNION ALL, without the cost of de-duping them.
+
+    :param table_suffix_condition: a condition on _TABLE_SUFFIX, i.e. the date part of the daily audit log tables,
+    which limits the tables the query scans.
+
+    :return: the query, without any particular order
+    """
+
+    # Prepare the IN clause from WHITELIST_USERS. For e.g:
+    # Convert: "user1@google.com AND user2@google.com" to "'user1@google.com', 'user2@google.com'"
+    IN_clause = map(lambda x: '\'{}\''.format(x), __whitelist_users())
+    IN_clause = ','.join(IN_clause)
+
+    activity_query = 'SELECT * FROM (SELECT timestamp, resource.labels.project_id as project, \
+    protopayload_auditlog.authenticationInfo.principalEmail as offender, \
+    CASE \
+        WHEN resource.type = "project" AND protopayload_auditlog.serviceName = "cloudresourcemanager.googleapis.com" \
+            AND protopayload_auditlog.methodName = "SetIamPolicy" \
+        THEN \'IAM Policy Tampering\' \
+        WHEN resource.type = "gcs_bucket" AND protopayload_auditlog.serviceName = "storage.googleapis.com" \
+            AND (protopayload_auditlog.methodName = "storage.setIamPermissions" \
+                OR protopayload_auditlog.methodName = "storage.objects.update") \
+        THEN \'Bucket Permission Tampering\' \
+    END as offenceType \
+    FROM `{}.{}.cloudaudit_googleapis_com_activity_*` \
+    WHERE {} AND resource.type IN ("project", "gcs_bucket")) \
+    WHERE offenceType IS NOT NULL'.format(PROJECT_ID, LOGS_SINK_DATASET_ID, table_suffix_condition)
+
+    data_access_query = 'SELECT timestamp, resource.labels.project_id as project, protoPayload_auditlog.authenticationInfo.principalEmail as offender, \
+    \'Unexpected Bucket Access\' as offenceType FROM `{}.{}.cloudaudit_googleapis_com_data_access_*` \
+    WHERE {} AND resource.type = \'gcs_bucket\' AND(protoPayload_auditlog.resourceName LIKE \'%{}\' OR \
+    protoPayload_auditlog.resourceName LIKE \'%{}\') AND protoPayload_auditlog.authenticationInfo.principalEmail \
+    NOT IN({})'.format(PROJECT_ID, LOGS_SINK_DATASET_ID, table_suffix_condition, LOGS_BUCKET_ID, DATA_BUCKET_ID, IN_clause)
+
+    return '{} UNION ALL {}'.format(activity_query, data_access_query)
+
+
+def usage():
+    print('\nusage: python incidents.py history [start date YYYYMMDD] [end date YYYYMMDD]\n'
+          '       python incidents.py local [exported audit logs file or directory] ...\n'
+          '       python incidents.py materialize\n'
+          '       python incidents.py schedule\n')
+
+
+def main():
+    """
+    This is how you execute this script:
+
+    python incidents.py history [start date YYYYMMDD] [end date YYYYMMDD]
+        prints the history of "offensive" actions between the two dates, both optional.
+
+    python incidents.py local [exported audit logs file or directory] ...
+        prints the history of "offensive" actions in audit logs exported to local Parquet or JSON files.
+
+    python incidents.py materialize
+        refreshes the "offensive" actions of yesterday and today in the INCIDENTS_TABLE_ID table.
+
+    python incidents.py schedule
+        creates a BigQuery scheduled query that does the same as "materialize" every hour.
+    """
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+
+    if command == 'history' and len(sys.argv) <= 4:
+        get_incidents_history(*sys.argv[2:])
+    elif command == 'local' and len(sys.argv) > 2:
+        incidents = analyze_exported_logs(sys.argv[2:]).to_pylist()
+        for incident in incidents:
+            print('{}  {}  {}  {}'.format(incident['timestamp'], incident['project'], incident['offender'],
+                                          incident['offenceType']))
+    elif command == 'materialize' and len(sys.argv) == 2:
+        materialize_incidents()
+    elif command == 'schedule' and len(sys.argv) == 2:
+        schedule_incidents_materialization()
+    else:
+        usage()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+from utils import *
+from parameters import *
+from multiprocessing.pool import ThreadPool
+import re
+import subprocess
+
+# What the read commands report when the resource they read doesn't exist, e.g.
+# "BucketNotFoundException: 404 gs://hipaa-sample-project-logs bucket does not exist." or
+# "BigQuery error in show operation: Not found: Dataset hipaa-sample-project:cloudlogs"
+NOT_FOUND_PATTERN = re.compile(r'NOT_FOUND|NotFound|Not found|\b404\b')
+
+# gcloud reports a project that doesn't exist as one the account may not access:
+# "User [janedoe@acme.com] does not have permission to access projects instance [...] (or it may not exist)"
+PROJECT_NOT_FOUND_PATTERN = re.compile(r'NOT_FOUND|or it may not exist')
+
+
+class StateReadError(Exception):
+    """
+    Raised when the current state of a resource can't be read for any reason other than the resource not existing,
+    e.g. an expired credential, a missing permission or a transient error. Planning is aborted rather than
+    mistaking the resource for missing and re-creating it.
+    """
+
+    def __init__(self, message):
+        super(StateReadError, self).__init__(message)
+        self.message = message
+
+
+def read_current_state():
+    """
+    Reads the current state of all the resources managed by this script in one bulk pass.
+    The read-only commands are independent of each other, so they are issued concurrently.
+
+    Any resource that doesn't exist is reported as None. If the project doesn't exist, neither does anything in it,
+    and only the project is read.
+
+    :raises StateReadError: if any resource can't be read, e.g. for lack of permission.
+
+    :return: a dictionary describing the project, its IAM policy, the buckets,
+    the logs dataset, the log sinks, the log-based metrics, the notification channels and the alert policies.
+    """
+
+    print('>>>reading current state of project {}...'.format(PROJECT_ID))
+
+    project = __read('gcloud projects describe {} --format=json'.format(PROJECT_ID), json.loads,
+                     PROJECT_NOT_FOUND_PATTERN)
+
+    reads = {
+        'project_iam': ('gcloud projects get-iam-policy {} --format=json'.format(PROJECT_ID), json.loads),
+        'logs_bucket_iam': ('gsutil iam get gs://{}'.format(LOGS_BUCKET_ID), json.loads),
+        'logs_bucket_life_cycle': ('gsutil lifecycle get gs://{}'.format(LOGS_BUCKET_ID), __parse_configuration),
+        'data_bucket_iam': ('gsutil iam get gs://{}'.format(DATA_BUCKET_ID), json.loads),
+        'data_bucket_logging': ('gsutil logging get gs://{}'.format(DATA_BUCKET_ID), __parse_configuration),
+        'data_bucket_versioning': ('gsutil versioning get gs://{}'.format(DATA_BUCKET_ID), __parse_versioning),
+        'dataset': ('bq --format=json show {}:{}'.format(PROJECT_ID, LOGS_SINK_DATASET_ID), json.loads),
+        'sinks': ('gcloud logging sinks list --project={} --format=json'.format(PROJECT_ID), json.loads),
+        'metrics': ('gcloud logging metrics list --project={} --format=json'.format(PROJECT_ID), json.loads),
+        'channels': ('gcloud alpha monitoring channels list --project={} --format=json'.format(PROJECT_ID),
+                     json.loads),
+        'alert_policies': ('gcloud alpha monitoring policies list --project={} --format=json'.format(PROJECT_ID),
+                           json.loads),
+    }
+
+    if project is None:
+        state = dict((key, None) for key in reads)
+        state['project'] = None
+        return state
+
+    def read(key):
+        try:
+            return __read(*reads[key])
+        except StateReadError as e:
+            return e
+
+    keys = list(reads.keys())
+    pool = ThreadPool(len(keys))
+    try:
+        values = pool.map(read, keys)
+    finally:
+        pool.close()
+
+    errors = [value.message for value in values if isinstance(value, StateReadError)]
+    if errors:
+        raise StateReadError('Couldn\'t read the current state of project {}; nothing was planned:\n{}'
+                             .format(PROJECT_ID, '\n'.join(errors)))
+
+    state = dict(zip(keys, values))
+    state['project'] = project
+    return state
+
+
+def normalize_bindings(bindings):
+    """
+    Converts a list of IAM bindings into a comparable form, ignoring the order of bindings and members.
+
+    :param bindings: e.g. [{'role': 'roles/owner', 'members': ['group:b', 'group:a']}]
+
+    :return: e.g. {'roles/owner': ('group:a', 'group:b')}
+    """
+    normalized = {}
+    for binding in bindings or []:
+        members = set(normalized.get(binding['role'], ())) | set(binding.get('members', []))
+        normalized[binding['role']] = tuple(sorted(members))
+
+    return normalized
+
+
+def __read(cmd, parse, not_found_pattern=NOT_FOUND_PATTERN):
+    """
+    Runs a read-only command and parses its output.
+
+    :param not_found_pattern: what the command reports when the resource doesn't exist
+
+    :return: the parsed output, or None if the command reported that the resource doesn't exist.
+
+    :raises StateReadError: if the command failed for any other reason, or its output couldn't be parsed.
+    """
+    process = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, close_fds=True)
+    output, error = [message.decode('utf-8', 'replace').strip() for message in process.communicate()]
+
+    if process.returncode != 0:
+        if not_found_pattern.search(error) or not_found_pattern.search(output):
+            return None
+        raise StateReadError('"{}" failed: {}'.format(cmd, error or output))
+
+    try:
+        return parse(output)
+    except ValueError:
+        raise StateReadError('"{}" returned unexpected output: {}'.format(cmd, output))
+
+
+def __parse_configuration(message):
+    """
+    Parses the output of "gsutil lifecycle get" or "gsutil logging get", which is either JSON or, for a bucket
+    without any, e.g. "gs://hipaa-sample-project-logs/ has no lifecycle configuration."
+
+    :return: the configuration, or None if there isn't any.
+    """
+    if re.search(r'has no \w+ configuration', message):
+        return None
+
+    return json.loads(message)
+
+
+def __parse_versioning(message):
+    """
+    Parses the output of "gsutil versioning get", e.g. "gs://hipaa-sample-project-bio-medical-data: Enabled"
+
+    :return: True if versioning is enabled, False otherwise.
+    """
+    return message.strip().endswith('Enabled')
@@ -16,6 +16,41 @@ CONTENT_TYPE="bio-medical"                # CHANGE ME! This is a placeholder, ch
 
 WHITELIST_USERS = "user1@acme.com AND user2@acme.com" # CHANGE ME! This is a placeholder, whitelist users for access to the main GCS bucket: DATA_BUCKET_ID
 
+INCIDENTS_QUERY_MAX_BYTES=10*1024**3      # CHANGE ME! This is the most bytes a query for the history of "offensive" actions may scan; queries estimated
+                                          # to scan more are not run. Refer to https://cloud.google.com/bigquery/pricing to translate it into costs.
+
+# In fleet mode (see fleet.py), any of the above is overridden per project by the JSON file named in LOCK_DOWN_PARAMETERS:
+def __override_parameters(parameters):
+    """
+    Overrides the parameters defined above with those in the JSON file named in LOCK_DOWN_PARAMETERS, if any.
+    The imports are local, so that they don't leak into the modules that import * from this one.
+
+    :param parameters: the globals of this module
+
+    :return: None
+
+    Note: If the file names a parameter that isn't defined above, e.g. a misspelled one, an exception is raised
+    rather than the parameter being ignored.
+    """
+    import json
+    import os
+
+    if not os.environ.get('LOCK_DOWN_PARAMETERS'):
+        return
+
+    with open(os.environ['LOCK_DOWN_PARAMETERS']) as parameters_file:
+        overrides = json.load(parameters_file)
+
+    unknown = sorted(key for key in overrides if key.startswith('_') or key not in parameters)
+    if unknown:
+        raise Exception('{} overrides unknown parameters: {}'.format(os.environ['LOCK_DOWN_PARAMETERS'],
+                                                                     ', '.join(unknown)))
+
+    parameters.update(overrides)
+
+
+__override_parameters(globals())
+
 # YOU SHOULD NOT CHANGE THE following. They are defined based on best practices: 
 OWNERS_GROUP='{}-owners@{}'.format(PROJECT_ID, DOMAIN)            # Given the placeholder values above, it resolves to hipaa-sample-project-owners@google.com
 AUDITORS_GROUP='{}-auditors@{}'.format(PROJECT_ID, DOMAIN)        # Given the placeholder values above, it resolves to hipaa-sample-project-auditors@google.com
@@ -29,3 +64,8 @@ DATA_BUCKET_ID='{}-{}-data'.format(PROJECT_ID, CONTENT_TYPE )     # Given the pl
 LOGS_SINK_NAME="audit-logs-to-bigquery"
 LOGS_SINK_DATASET_ID="cloudlogs"
 LOGS_SINK_DESTINATION='bigquery.googleapis.com/projects/{}/datasets/{}'.format(PROJECT_ID, LOGS_SINK_DATASET_ID)
+INCIDENTS_TABLE_ID="incidents"
+
+AUDIT_LOGS_TOPIC_ID="audit-logs"                                  # The Pub/Sub topic audit logs are routed to for audit_rules.py
+AUDIT_LOGS_SUBSCRIPTION_ID="audit-rules"
+AUDIT_LOGS_PUBSUB_SINK_NAME="audit-logs-to-pubsub"
@@ -3,24 +3,32 @@ from parameters import *
 
 import bucket_setup
 import audit_monitoring_setup
-import yaml
+import lock_down_state
+import os
+import sys
 
 
-def create_project():
+def create_project(must_be_new=False):
     """
     Creates a gcloud config (optional), creates a project mapped to the billing account
     and organization and sets the project as the default in the gcloud config.
 
+    :param must_be_new: when True, fail if a project with the same Id already exists, rather than carry on with it.
+
     :return: None
     """
 
-    # First create a gcloud config and set the account (optional):
-    run_command('gcloud config configurations create {} --activate'.format(CONFIG_NAME), 'already exists')
+    # First create a gcloud config and set the account (optional).
+    # In fleet mode, the config is selected for this process by CLOUDSDK_ACTIVE_CONFIG_NAME, and isn't activated
+    # for everyone else; see fleet.py.
+    activate = '--no-activate' if os.environ.get('CLOUDSDK_ACTIVE_CONFIG_NAME') else '--activate'
+    run_command('gcloud config configurations create {} {}'.format(CONFIG_NAME, activate), 'already exists')
     run_command('gcloud config set account {}'.format(ACCOUNT))
 
     # Then create the project:
     # Note: You must set up your project against an organization.
-    run_command('gcloud projects create --organization={} {}'.format(ORGANIZATION_ID, PROJECT_ID), 'try an alternative ID')
+    run_command('gcloud projects create --organization={} {}'.format(ORGANIZATION_ID, PROJECT_ID),
+                '' if must_be_new else 'try an alternative ID')
     run_command('gcloud projects describe {}'.format(PROJECT_ID))
 
     # Set the appropriate billing account for this project:
@@ -42,6 +50,7 @@ def set_project_access():
 
     :return: None
     """
+    import yaml
 
     # Add a policy binding to make OWNERS_GROUP an owner of the project:
     run_command('gcloud projects add-iam-policy-binding {} --member="group:{}" --role="roles/owner"'
@@ -58,6 +67,67 @@ def set_project_access():
                             .format(PROJECT_ID, member, binding['role']))
 
 
+def plan_project_changes(state):
+    """
+    Compares the current state of the project against the desired state defined by this script
+    and lists the changes required to reconcile them.
+
+    :param state: the current state as read by lock_down_state.read_current_state()
+
+    :return: list of (description, function) tuples; calling the functions in order applies the changes.
+    """
+
+    changes = []
+
+    if state['project'] is None:
+        # gcloud can't tell a project that doesn't exist from one ACCOUNT may not access, so the project must turn
+        # out to be new; otherwise its billing account would be changed.
+        changes.append(('Create project {}'.format(PROJECT_ID), lambda: create_project(must_be_new=True)))
+
+    # Only the bindings this script manages are compared: OWNERS_GROUP must be the only owner, and ACCOUNT must not
+    # have any direct rights. Others, e.g. those of the service agents that GCP adds on its own, are left out.
+    bindings = lock_down_state.normalize_bindings((state['project_iam'] or {}).get('bindings'))
+    if bindings.get('roles/owner') != ('group:{}'.format(OWNERS_GROUP),) or \
+            any('user:{}'.format(ACCOUNT) in members for members in bindings.values()):
+        changes.append(('Make {} the only owner of project {}'.format(OWNERS_GROUP, PROJECT_ID), set_project_access))
+
+    return changes
+
+
+def plan():
+    """
+    Reads the current state of all managed resources in one bulk pass and diffs it against
+    the desired state defined by parameters.py.
+
+    :return: list of (description, function) tuples; calling the functions in order applies the changes.
+    """
+    state = lock_down_state.read_current_state()
+
+    return plan_project_changes(state) + \
+        bucket_setup.plan_bucket_changes(state) + \
+        audit_monitoring_setup.plan_audit_monitoring_changes(state)
+
+
+def apply_changes(changes):
+    """
+    Applies the changes listed by plan(), in order.
+
+    :param changes: list of (description, function) tuples
+
+    :return: None
+    """
+    for description, change in changes:
+        print('>>>applying: {}'.format(description))
+        change()
+
+
+def usage():
+    print('\nusage: python project_setup.py [plan | apply]\n\n'
+          '  (no mode)  run every step of the script, creating or overwriting all resources\n'
+          '  plan       list the changes required to reach the desired state, without making any\n'
+          '  apply      make only the changes required to reach the desired state\n')
+
+
 def main():
     """
     This is the main function which:
@@ -68,27 +138,46 @@ def main():
      5) uses those metrics to define alerts that fire off notifications when "offensive" actions are detected.
      6) define BigQuery queries that can retrieve the history of "offensive" actions.
 
+    When run with "plan" or "apply", it reads the current state of the project first and only lists
+    or makes the changes required to reach the desired state; a re-run against a locked-down project is a no-op.
+
     Note: This script assumes ACCOUNT is already authenticated with Google Cloud SDK.
     If that is not the case, run "gcloud auth login" before starting!!!
     """
+    mode = sys.argv[1] if len(sys.argv) == 2 else None
+    if len(sys.argv) > 2 or mode not in (None, 'plan', 'apply'):
+        usage()
+        return
+
     try:
-        # Step 1: Create the project:
-        create_project()
+        if mode is not None:
+            changes = plan()
+            for description, _ in changes:
+                print('>>>planned: {}'.format(description))
+
+            if not changes:
+                print('Nothing to change; project {} is already locked down.'.format(PROJECT_ID))
+            elif mode == 'apply':
+                apply_changes(changes)
+
+        else:
+            # Step 1: Create the project:
+            create_project()
 
-        # Step 2: Adjust project rights
-        set_project_access()
+            # Step 2: Adjust project rights
+            set_project_access()
 
-        # Step 3: Create GCS bucket for logs
-        bucket_setup.create_logs_bucket()
+            # Step 3: Create GCS bucket for logs
+            bucket_setup.create_logs_bucket()
 
-        # Step 4: Create GCS bucket for ingested data
-        bucket_setup.create_data_bucket()
+            # Step 4: Create GCS bucket for ingested data
+            bucket_setup.create_data_bucket()
 
-        # Step 5: Enable auditing and monitoring for the project
-        audit_monitoring_setup.enable_audit_monitoring()
+            # Step 5: Enable auditing and monitoring for the project
+            audit_monitoring_setup.enable_audit_monitoring()
 
     except Exception as e:
-        print('Execution interrupted with message: "{}"'.format(e.message))
+        print('Execution interrupted with message: "{}"'.format(getattr(e, 'message', e)))
     else:
         print('Finished the script successfully!')
 
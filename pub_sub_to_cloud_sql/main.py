@@ -4,7 +4,15 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 import base64
+import calendar
+import collections
+import contextlib
+import datetime
+import hashlib
+import json
 import logging
+import time
+import zlib
 import pymysql
 from pymysql.err import OperationalError
 
@@ -22,9 +30,124 @@ TABLE_NAME = 'TABLE NAME GOES HERE'
 # Note: this is treated as an optional attribute.
 HANDLE_ATTRIBUTE_KEY = 'ATTRIBUTE KEY GOES HERE'
 
+# Values of compressible columns longer than this many bytes are compressed
+# with zlib at this level, and stored in a BLOB column instead.
+COMPRESSION_THRESHOLD_BYTES = 1000
+COMPRESSION_LEVEL = 6
+
+
+def compressible(value):
+    """
+    The type of columns whose values may be too long to store as text, e.g.
+    'data': ('data', compressible). Such a column, say data, comes with a
+    second one named data_compressed, of type MEDIUMBLOB. Values of up to
+    COMPRESSION_THRESHOLD_BYTES are stored in the first column as-is, and longer
+    ones are compressed into the second. Use read_messages() to read them back.
+
+    :param value: the value of the column, as a string.
+    :return: tuple of (the value or None, the compressed value or None)
+    """
+    encoded = value.encode('utf-8')
+    if len(encoded) <= COMPRESSION_THRESHOLD_BYTES:
+      return value, None
+
+    compressed = zlib.compress(encoded, COMPRESSION_LEVEL)
+    compression_stats['values'] += 1
+    compression_stats['bytes'] += len(encoded)
+    compression_stats['compressed_bytes'] += len(compressed)
+    logging.info('Compressed a value of {} bytes into {} bytes, a ratio of '
+                 '{:.1f}'.format(len(encoded), len(compressed),
+                                 len(encoded) / len(compressed)))
+    return None, compressed
+
+
+# CHANGE ME: route messages to tables by their attributes. A message goes to the
+# first route whose 'match' attributes it has, with the same values; a route
+# without 'match' takes all the messages that reach it. 'columns' maps every
+# column of the table, besides time, to (source, type) where source is one of:
+#   'data'             the data of the message as-is
+#   'attributes'       all the attributes of the message
+#   'attributes.KEY'   the value of the attribute KEY
+#   'data.PATH'        a field of the JSON data of the message, e.g.
+#                      'data.order.items.0.sku'
+#   'handle'           the value of the HANDLE_ATTRIBUTE_KEY attribute
+# and type is a function that converts the value, e.g. int, float or str, or
+# compressible for values of any size; see compressible() below.
+# Messages with a handle replace the older ones with the same handle in the
+# column mapped to 'handle', if any.
+# Each route, i.e. each table, buffers up to 'max_rows' messages, counting
+# those that replaced a buffered message with the same handle, or the messages
+# of up to 'max_seconds', before they are written in one statement. Buffers are
+# checked at the end of every invocation of on_message(), whatever route its
+# message took, so a buffer is written no later than the first invocation
+# after its 'max_seconds'. Beware that a buffered message is already
+# acknowledged to Pub/Sub, and is lost if the function instance is shut down
+# before its buffer is flushed, e.g. when no other message arrives before the
+# instance is recycled; the default of 1 row writes every message right away.
+# A route with 'partitioned' set to True manages its table itself: the table is
+# created, if it doesn't exist, with one partition per day of time and indexes
+# on time and the handle column, and partitions for the days ahead are added
+# and old partitions dropped by on_schedule() only, never while persisting
+# messages; see create_partitioned_table() below.
+# The default route persists every message into TABLE_NAME, as shown below.
+ROUTES = [
+    {
+        # 'match': {'type': 'order'},
+        'table': TABLE_NAME,
+        'columns': {
+            # For messages of any size, make these compressible; see
+            # compressible() below.
+            'data': ('data', str),
+            'attributes': ('attributes', str),
+            'handle': ('handle', str),
+        },
+        'max_rows': 1,
+        'max_seconds': 0,
+        'partitioned': False,
+    },
+]
+
+# on_schedule() keeps partitions for this many days ahead in partitioned tables,
+# and the messages of this many days; None keeps them forever.
+PARTITION_DAYS_AHEAD = 7
+RETENTION_DAYS = 90
+
+# Pub/Sub delivers messages at least once, so the same message may arrive more
+# than once. Each function instance remembers the handles of the messages it
+# persisted recently, along with a hash of their content, and skips the exact
+# duplicates without going to the database.
+# CHANGE ME: size the cache to the number of distinct handles an instance sees
+# within the TTL; each entry takes roughly 200 bytes.
+DEDUPE_CACHE_SIZE = 10000
+DEDUPE_CACHE_TTL_SECONDS = 600
+
+# handle -> (payload hash, time persisted), least recently used first
+recent_handles = collections.OrderedDict()
+dedupe_stats = {'hits': 0, 'misses': 0}
+
+# table -> rows buffered for it; see ROUTES
+write_buffers = {}
+
+# Partitioned tables this instance made sure exist; see ROUTES
+managed_tables = set()
+
+# Totals of the values compressed by this instance; see compressible()
+compression_stats = {'values': 0, 'bytes': 0, 'compressed_bytes': 0}
+
+# Totals of this instance, and the milliseconds spent in each stage of the
+# message at hand; both are logged once per message, see __log_metrics()
+counters = {'messages': 0, 'cold_connects': 0, 'reconnects': 0,
+            'statements': 0, 'rows': 0}
+stage_timings = collections.OrderedDict()
+
 # Create SQL connection globally to enable reuse
 # PyMySQL does not include support for connection pooling
 mysql_conn = None
+mysql_conn_last_used = 0
+
+# The connection is checked, and reconnected if need be, before it's used
+# after this many idle seconds; see __get_cursor()
+PING_AFTER_IDLE_SECONDS = 30
 
 
 def on_message(pub_sub_message, context):
@@ -37,34 +160,53 @@ def on_message(pub_sub_message, context):
     :return: none
     """
 
+    start_time = time.time()
+    stage_timings.clear()
+    counters['messages'] += 1
+
     data = ''
     attributes = {}
-    if 'data' in pub_sub_message:
-        data = base64.b64decode(pub_sub_message['data']).decode('utf-8')
-    else:
-        logging.info('Didn\'t find data in the message!')
+    with __timed('decode'):
+      if 'data' in pub_sub_message:
+          data = base64.b64decode(pub_sub_message['data']).decode('utf-8')
+      else:
+          logging.info('Didn\'t find data in the message!')
 
-    if 'attributes' in pub_sub_message:
-      attributes = pub_sub_message['attributes']
-    else:
-      logging.info('Didn\'t find attributes in the message!')
+      if 'attributes' in pub_sub_message:
+        attributes = pub_sub_message['attributes']
+      else:
+        logging.info('Didn\'t find attributes in the message!')
 
-    persist_message(data, attributes)
+    try:
+      persist_message(data, attributes)
+      flush_buffers(force=False)
+    finally:
+      __log_metrics(context, start_time)
 
 
 def persist_message(data, attributes):
     """
     After the Pub/Sub message is separated into data vs. attributes, this
-    function persists it as-is in a Cloud SQL table with the following schema:
+    function persists it into the table of the first route in ROUTES that
+    matches its attributes. By default, it persists the message as-is in a
+    Cloud SQL table with the following schema:
 
     time TIMESTAMP,
     data varchar(1000),
     attributes varchar(1000),
     handle varchar(1000)
 
+    To accept data and attributes longer than that, make them compressible in
+    the default route, and add a data_compressed and an attributes_compressed
+    column of type MEDIUMBLOB to the table.
+
     If an attribute with the key as specified by HANDLE_ATTRIBUTE_KEY is found 
     among attributes of the Pub/Sub message, its value is used to de-dupe the
-    persisted messages.
+    persisted messages. A message whose handle and content are the same as
+    those of a message this instance persisted in the last
+    DEDUPE_CACHE_TTL_SECONDS is a redelivery, and is skipped altogether.
+
+    The message is only buffered; call flush_buffers() to write it.
 
     :param data (string): The 'data' part of the pub/sub message after it's
     decoded into utf-8 string.
@@ -73,33 +215,482 @@ def persist_message(data, attributes):
     :return: none
     """
 
-    if HANDLE_ATTRIBUTE_KEY in attributes:
-      # If an older message with the same handle exists,
-      # drop it before persisting the new message.
-      sql_command = 'DELETE FROM {} WHERE handle="{}";'.format(
-          TABLE_NAME, attributes[HANDLE_ATTRIBUTE_KEY])
-      execute_command(sql_command)
-
-      sql_command = 'INSERT INTO {} (time, data, attributes, handle) ' \
-                    'VALUES ( NOW(), "{}", "{}", "{}")'.format(
-          TABLE_NAME,
-          data,
-          str(attributes),
-          attributes[HANDLE_ATTRIBUTE_KEY])
-      execute_command(sql_command)
-
+    handle = attributes.get(HANDLE_ATTRIBUTE_KEY)
+    payload_hash = None
+    if handle is not None:
+      with __timed('dedupe'):
+        payload_hash = __payload_hash(data, attributes)
+        duplicate = __is_recent_duplicate(handle, payload_hash)
+      if duplicate:
+        return
     else:
-      sql_command = 'INSERT INTO {} (time, data, attributes) ' \
-                    'VALUES ( NOW(), "{}", "{}")'.format(
-          TABLE_NAME,
-          data,
-          str(attributes))
-
       logging.warning('Missing handle attribute: "{}" in the message! '
                       'Handle attribute is not mandatory, '
                       'but when available is used to de-dupe messages.'.format(
                           HANDLE_ATTRIBUTE_KEY))
+
+    route = __route_of(attributes)
+    if route is None:
+      logging.warning('No route matches the attributes {} of the message! '
+                      'The message is dropped.'.format(attributes))
+      return
+
+    buffer = write_buffers.setdefault(
+        route['table'], {'route': route, 'rows': collections.OrderedDict(),
+                         'arrivals': 0, 'since': time.time()})
+    if not buffer['rows']:
+      buffer['since'] = time.time()
+    buffer['arrivals'] += 1
+
+    # Within a buffer, a message replaces the one before it with the same
+    # handle, just as it would in the table.
+    key = handle if handle is not None else object()
+    buffer['rows'].pop(key, None)
+    buffer['rows'][key] = (handle, payload_hash,
+                           __row(route, data, attributes, handle))
+
+
+def flush_buffers(force=True):
+    """
+    Writes the rows buffered for each route into its table, in one DELETE of
+    the older messages with the same handles and one multi-row INSERT.
+
+    :param force: when False, only the buffers that received 'max_rows'
+    messages, or whose oldest message is 'max_seconds' old, are flushed.
+    :return: none
+    """
+    for table, buffer in write_buffers.items():
+      route = buffer['route']
+      rows = buffer['rows']
+      if not rows or not (
+          force or buffer['arrivals'] >= route.get('max_rows', 1) or
+          time.time() - buffer['since'] >= route.get('max_seconds', 0)):
+        continue
+
+      if route.get('partitioned') and table not in managed_tables:
+        create_partitioned_table(route)
+        managed_tables.add(table)
+
+      columns = __column_names(route)
+      handle_column = __handle_column(route)
+      handles = [handle for handle, _, _ in rows.values()
+                 if handle is not None]
+
+      if handle_column is not None and handles:
+        # If older messages with the same handles exist,
+        # drop them before persisting the new messages.
+        execute_command('DELETE FROM {} WHERE {} IN ({})'.format(
+            table, handle_column, ', '.join(['%s'] * len(handles))), handles)
+
+      execute_command('INSERT INTO {} (time, {}) VALUES (%s, {})'.format(
+          table, ', '.join(columns), ', '.join(['%s'] * len(columns))),
+          [row for _, _, row in rows.values()], many=True)
+
+      for handle, payload_hash, _ in rows.values():
+        if handle is not None:
+          __remember_handle(handle, payload_hash)
+
+      rows.clear()
+      buffer['arrivals'] = 0
+
+
+def on_schedule(event, context):
+    """
+    Background Cloud Function to be triggered by Cloud Scheduler, through a
+    Pub/Sub topic, e.g. once a day. It adds partitions for the days ahead to
+    the partitioned tables of ROUTES, and drops the partitions of the days
+    older than RETENTION_DAYS, each in a single statement rather than a DELETE
+    of its rows.
+
+    :param event (dict): The Pub/Sub message sent by Cloud Scheduler; unused.
+    :param context (google.cloud.functions.Context): The Cloud Functions event metadata.
+    :return: none
+    """
+    for route in ROUTES:
+      if route.get('partitioned'):
+        create_partitioned_table(route)
+        maintain_partitions(route['table'], RETENTION_DAYS)
+
+
+def create_partitioned_table(route):
+    """
+    Creates the table of a route, unless it exists, partitioned by range of
+    time with one partition per day up to PARTITION_DAYS_AHEAD days ahead. It
+    doesn't touch the partitions of an existing table, since concurrent
+    function instances would race to add the same ones; on_schedule() does
+    that. Messages past the last day land in pmax until then. For the default
+    route, the table is:
+
+    CREATE TABLE TABLE_NAME (
+        time TIMESTAMP NOT NULL,
+        data TEXT,
+        attributes TEXT,
+        handle varchar(1000),
+        INDEX (time),
+        INDEX (handle(255))
+    ) PARTITION BY RANGE (UNIX_TIMESTAMP(time)) (
+        PARTITION p20191001 VALUES LESS THAN (1569974400),
+        ...
+        PARTITION pmax VALUES LESS THAN MAXVALUE
+    );
+
+    Reads of a range of time are pruned to the partitions of its days. The
+    DELETE of older messages with the same handle has no time predicate, since
+    they may be of any age, so it probes the handle index of every partition,
+    i.e. about RETENTION_DAYS index lookups per flush; that depends on the
+    number of days kept, not on the number of rows. Refer to:
+    https://dev.mysql.com/doc/refman/5.7/en/partitioning-range.html
+
+    :param route: a route of ROUTES
+    :return: none
+    """
+    definitions = ['time TIMESTAMP NOT NULL']
+    for column, (source, column_type) in route['columns'].items():
+      definitions.append('{} {}'.format(column, __sql_type(source, column_type)))
+      if column_type is compressible:
+        definitions.append('{}_compressed MEDIUMBLOB'.format(column))
+
+    definitions.append('INDEX (time)')
+    if __handle_column(route) is not None:
+      definitions.append('INDEX ({}(255))'.format(__handle_column(route)))
+
+    today = datetime.datetime.utcnow().date()
+    partitions = [__partition_definition(today + datetime.timedelta(days=days))
+                  for days in range(PARTITION_DAYS_AHEAD + 1)]
+
+    execute_command('CREATE TABLE IF NOT EXISTS {} ({}) PARTITION BY RANGE '
+                    '(UNIX_TIMESTAMP(time)) ({}, PARTITION pmax VALUES LESS '
+                    'THAN MAXVALUE)'.format(route['table'],
+                                            ', '.join(definitions),
+                                            ', '.join(partitions)))
+
+
+def maintain_partitions(table, retention_days=RETENTION_DAYS):
+    """
+    Adds the partitions for the next PARTITION_DAYS_AHEAD days that a table
+    created by create_partitioned_table() doesn't have yet, by splitting them
+    off its pmax partition, and drops its partitions of the days older than
+    retention_days. A change that another run of on_schedule() made first
+    fails with a duplicate or unknown partition, and is skipped.
+
+    :param table: the name of the table
+    :param retention_days: the number of days to keep, or None to keep all
+    :return: none
+    """
+    partitions = __fetch_all(
+        'SELECT PARTITION_NAME AS name, PARTITION_DESCRIPTION AS bound '
+        'FROM information_schema.PARTITIONS WHERE TABLE_SCHEMA = DATABASE() '
+        'AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL', [table])
+    names = set(partition['name'] for partition in partitions)
+
+    today = datetime.datetime.utcnow().date()
+    new_partitions = [__partition_definition(day) for day in
+                      (today + datetime.timedelta(days=days)
+                       for days in range(PARTITION_DAYS_AHEAD + 1))
+                      if day.strftime('p%Y%m%d') not in names]
+    if new_partitions:
+      __alter_partitions('ALTER TABLE {} REORGANIZE PARTITION pmax INTO ({}, '
+                         'PARTITION pmax VALUES LESS THAN MAXVALUE)'.format(
+                             table, ', '.join(new_partitions)))
+
+    if retention_days is not None:
+      cutoff = __unix_time(today - datetime.timedelta(days=retention_days))
+      expired = sorted(partition['name'] for partition in partitions
+                       if partition['name'] != 'pmax' and
+                       int(partition['bound']) <= cutoff)
+      if expired and __alter_partitions('ALTER TABLE {} DROP PARTITION {}'
+                                        .format(table, ', '.join(expired))):
+        logging.info('Dropped {} partitions of {} older than {} days: {}'
+                     .format(len(expired), table, retention_days,
+                             ', '.join(expired)))
+
+
+def __alter_partitions(sql_command):
+    """
+    Executes an ALTER TABLE of partitions, unless another run of on_schedule()
+    already made the same change, i.e. MySQL reports a duplicate partition name
+    (1517) or a partition to drop that doesn't exist (1507).
+
+    :return: True if the change was made by this call, False otherwise.
+    """
+    try:
       execute_command(sql_command)
+    except OperationalError as e:
+      if e.args[0] not in (1507, 1517):
+        raise
+      logging.info('Skipped {}: {}'.format(sql_command, e.args[1]))
+      return False
+
+    return True
+
+
+def __partition_definition(day):
+    """
+    :return: the definition of the partition of a day, e.g. PARTITION p20191001
+    VALUES LESS THAN (1569974400), i.e. the start of the next day.
+    """
+    return 'PARTITION {} VALUES LESS THAN ({})'.format(
+        day.strftime('p%Y%m%d'),
+        __unix_time(day + datetime.timedelta(days=1)))
+
+
+def __unix_time(day):
+    # UNIX_TIMESTAMP(time) in a session of time zone +00:00; see mysql_config
+    return calendar.timegm(day.timetuple())
+
+
+def __sql_type(source, column_type):
+    """
+    :return: the SQL type of a column of a route, given its source and type.
+    """
+    if column_type is compressible or source == 'handle':
+      return 'varchar(1000)'
+
+    return {int: 'BIGINT', float: 'DOUBLE', bool: 'BOOLEAN'}.get(column_type,
+                                                                 'TEXT')
+
+
+def __handle_column(route):
+    """
+    :return: the column of the route mapped to 'handle', or None.
+    """
+    return next((column for column, (source, _) in route['columns'].items()
+                 if source == 'handle'), None)
+
+
+def __route_of(attributes):
+    """
+    :return: the first route in ROUTES whose 'match' attributes are among the
+    attributes of the message, or None.
+    """
+    for route in ROUTES:
+      if all(attributes.get(key) == value
+             for key, value in route.get('match', {}).items()):
+        return route
+
+    return None
+
+
+def __row(route, data, attributes, handle):
+    """
+    Extracts the values of the columns of the route from the message.
+
+    :return: tuple of the time the message arrived, followed by the value of
+    each column, in the order of __column_names().
+    """
+    json_data = None
+    row = [datetime.datetime.utcnow()]
+    for column, (source, column_type) in route['columns'].items():
+      if source == 'data':
+        value = data
+      elif source == 'attributes':
+        value = str(attributes)
+      elif source == 'handle':
+        value = handle
+      elif source.startswith('attributes.'):
+        value = attributes.get(source[len('attributes.'):])
+      elif source.startswith('data.'):
+        if json_data is None:
+          try:
+            json_data = json.loads(data)
+          except ValueError:
+            json_data = {}
+        value = __json_field(json_data, source[len('data.'):].split('.'))
+      else:
+        raise ValueError('Unknown source "{}" for column {} of table {}!'
+                         .format(source, column, route['table']))
+
+      if column_type is compressible:
+        row.extend(compressible(str(value)) if value is not None
+                   else (None, None))
+        continue
+
+      if value is not None:
+        try:
+          value = column_type(value)
+        except (TypeError, ValueError):
+          logging.warning('Couldn\'t convert "{}" to {} for column {} of '
+                          'table {}!'.format(value, column_type.__name__,
+                                             column, route['table']))
+          value = None
+
+      row.append(value)
+
+    return tuple(row)
+
+
+def __column_names(route):
+    """
+    :return: the columns of the route's table, besides time, in the order of
+    the values of __row(), with the second column of every compressible one.
+    """
+    names = []
+    for column, (_, column_type) in route['columns'].items():
+      names.append(column)
+      if column_type is compressible:
+        names.append(column + '_compressed')
+
+    return names
+
+
+def __json_field(json_data, path):
+    """
+    :return: the field at the path, e.g. ['order', 'items', '0', 'sku'], of
+    the JSON data, or None if there is no such field.
+    """
+    for key in path:
+      if isinstance(json_data, dict):
+        json_data = json_data.get(key)
+      elif isinstance(json_data, list) and key.isdigit() and \
+          int(key) < len(json_data):
+        json_data = json_data[int(key)]
+      else:
+        return None
+
+    return json_data
+
+
+@contextlib.contextmanager
+def __timed(stage):
+    """
+    Adds the milliseconds spent in the with block to the stage of the message
+    at hand, e.g. with __timed('execute'): ...
+    """
+    start_time = time.time()
+    try:
+      yield
+    finally:
+      stage_timings[stage] = stage_timings.get(stage, 0) + \
+          (time.time() - start_time) * 1000
+
+
+def __log_metrics(context, start_time):
+    """
+    Prints the timings of the message at hand and the totals of this instance
+    as one line of JSON, which Cloud Logging turns into the jsonPayload of a
+    log entry. Refer to: https://cloud.google.com/logging/docs/structured-logging
+    For example, jsonPayload.timings_ms.connect > 100 finds the messages that
+    waited on a connection to Cloud SQL.
+    """
+    print(json.dumps({
+        'severity': 'INFO',
+        'message': 'Processed message {}'.format(
+            getattr(context, 'event_id', '')),
+        'timings_ms': dict((stage, round(milliseconds, 3))
+                           for stage, milliseconds in stage_timings.items()),
+        'total_ms': round((time.time() - start_time) * 1000, 3),
+        'counters': dict(
+            counters,
+            dedupe_hits=dedupe_stats['hits'],
+            dedupe_misses=dedupe_stats['misses'],
+            dedupe_cache_size=len(recent_handles),
+            compressed_values=compression_stats['values'],
+            compressed_bytes_in=compression_stats['bytes'],
+            compressed_bytes_out=compression_stats['compressed_bytes']),
+    }))
+
+
+def __payload_hash(data, attributes):
+    """
+    :return: a digest of the data and attributes of a message, regardless of
+    the order of its attributes.
+    """
+    payload = repr((data, sorted(attributes.items())))
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def __is_recent_duplicate(handle, payload_hash):
+    """
+    Looks the message up among the ones recently persisted by this instance,
+    and counts the hits and misses of the lookups.
+
+    :return: True if a message with the same handle and content was persisted
+    less than DEDUPE_CACHE_TTL_SECONDS ago.
+    """
+    entry = recent_handles.get(handle)
+    hit = entry is not None and entry[0] == payload_hash and \
+        time.time() - entry[1] < DEDUPE_CACHE_TTL_SECONDS
+
+    if hit:
+      dedupe_stats['hits'] += 1
+      recent_handles.move_to_end(handle)
+    else:
+      dedupe_stats['misses'] += 1
+
+    logging.debug('Dedupe cache {} for handle "{}" (hits: {}, misses: {}, '
+                  'size: {})'.format('hit' if hit else 'miss', handle,
+                                     dedupe_stats['hits'],
+                                     dedupe_stats['misses'],
+                                     len(recent_handles)))
+    return hit
+
+
+def __remember_handle(handle, payload_hash):
+    """
+    Records a message that was just persisted, evicting the least recently
+    used handles beyond DEDUPE_CACHE_SIZE.
+    """
+    recent_handles[handle] = (payload_hash, time.time())
+    recent_handles.move_to_end(handle)
+    while len(recent_handles) > DEDUPE_CACHE_SIZE:
+      recent_handles.popitem(last=False)
+
+
+def read_messages(sql_query, args=None):
+    """
+    Runs a query on the tables the messages are persisted in, and decompresses
+    the values of compressible columns; see compressible(). For example:
+
+    read_messages('SELECT * FROM messages WHERE handle = %s', ['Hello'])
+
+    :param sql_query: a SELECT query, with %s placeholders for args, if any.
+    :param args: the values of the placeholders.
+    :return: list of rows, each a dictionary of column to value. The second
+    column of every compressible one is left out, and its value, if any, is
+    decompressed into the first.
+    """
+    rows = __fetch_all(sql_query, args)
+
+    for row in rows:
+      for column in [column for column in row if column.endswith('_compressed')]:
+        compressed = row.pop(column)
+        if compressed is not None:
+          row[column[:-len('_compressed')]] = \
+              zlib.decompress(compressed).decode('utf-8')
+
+    return rows
+
+
+def __fetch_all(sql_query, args=None):
+    """
+    :return: the rows of a query, as a list of dictionaries of column to value.
+    """
+    __connect()
+
+    with __get_cursor() as cursor:
+      cursor.execute(sql_query, args)
+      return cursor.fetchall()
+
+
+def __connect():
+    """
+    Initializes the global my sql connection, unless it's already there.
+    """
+    global mysql_conn, mysql_conn_last_used
+
+    # Initialize connections lazily, in case SQL access isn't needed for this
+    # GCF instance. Doing so minimizes the number of active SQL connections,
+    # which helps keep your GCF instances under SQL connection limits.
+    if not mysql_conn:
+      counters['cold_connects'] += 1
+      mysql_conn_last_used = time.time()
+      try:
+        mysql_conn = pymysql.connect(**mysql_config)
+      except OperationalError:
+        # If production settings fail, use local development ones
+        # cannot import from future:  mysql_config['unix_socket'] = f'/cloudsql/{CONNECTION_NAME}'
+        mysql_config['unix_socket'] = '/cloudsql/{}'.format(CONNECTION_NAME)
+        mysql_conn = pymysql.connect(**mysql_config)
 
 
 def __get_cursor():
@@ -107,14 +698,21 @@ def __get_cursor():
     Helper function to get a cursor.
     
     Note: PyMySQL does NOT automatically reconnect,
-    so we must reconnect explicitly using ping().
+    so we must reconnect explicitly using ping(). Getting a cursor doesn't
+    touch the server, so a connection that was idle for longer than
+    PING_AFTER_IDLE_SECONDS, which Cloud SQL may have closed in the meantime,
+    is pinged first; a reconnect shows as a new server thread Id.
     """
+    global mysql_conn_last_used
 
-    try:
-        return mysql_conn.cursor()
-    except OperationalError:
-        mysql_conn.ping(reconnect=True)
-        return mysql_conn.cursor()
+    if time.time() - mysql_conn_last_used > PING_AFTER_IDLE_SECONDS:
+      thread_id = mysql_conn.thread_id()
+      mysql_conn.ping(reconnect=True)
+      if mysql_conn.thread_id() != thread_id:
+        counters['reconnects'] += 1
+
+    mysql_conn_last_used = time.time()
+    return mysql_conn.cursor()
 
 
 mysql_config = {
@@ -123,35 +721,36 @@ mysql_config = {
     'db': DB_NAME,
     'charset': 'utf8mb4',
     'cursorclass': pymysql.cursors.DictCursor,
+    # The time of the messages is set in UTC, rather than by NOW().
+    'init_command': "SET time_zone = '+00:00'",
     'autocommit': True
 }
 
 
-def execute_command(sql_command):
+def execute_command(sql_command, args=None, many=False):
     """
     Executes the SQL query it receives as a param using the global my sql
     connection.
 
     :param sql_command: self-explanatory
+    :param args: the values of the %s placeholders in the command, if any; a
+    list of tuples of values, one per row, when many is True.
+    :param many: when True, the command is an INSERT executed for every row in
+    args, which PyMySQL sends as a single multi-row INSERT.
     :return: none
     """
-    global mysql_conn
-
-    # Initialize connections lazily, in case SQL access isn't needed for this
-    # GCF instance. Doing so minimizes the number of active SQL connections,
-    # which helps keep your GCF instances under SQL connection limits.
-    if not mysql_conn:
-      try:
-        mysql_conn = pymysql.connect(**mysql_config)
-      except OperationalError:
-        # If production settings fail, use local development ones
-        # cannot import from future:  mysql_config['unix_socket'] = f'/cloudsql/{CONNECTION_NAME}'
-        mysql_config['unix_socket'] = '/cloudsql/{}'.format(CONNECTION_NAME)
-        mysql_conn = pymysql.connect(**mysql_config)
+    with __timed('connect'):
+      __connect()
+      cursor = __get_cursor()
 
     # Remember to close SQL resources declared while running this function.
     # Keep any declared in global scope (e.g. mysql_conn) for later reuse.
-    with __get_cursor() as cursor:
+    with cursor, __timed('execute'):
       logging.info(sql_command)
-      cursor.execute(sql_command)
+      if many:
+        cursor.executemany(sql_command, args)
+        counters['rows'] += len(args)
+      else:
+        cursor.execute(sql_command, args)
+      counters['statements'] += 1
       mysql_conn.commit()
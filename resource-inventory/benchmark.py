@@ -0,0 +1,134 @@
+# Copyright 2019 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import io
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import fake_gcp_server
+
+COLLECTOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resource-inventory.py')
+
+
+def run_collector(server, work_dir, inventory_format):
+    """
+    Runs resource-inventory.py against the fake server in a subprocess, so its memory is measured on its own.
+    :return: tuple of (seconds it took, number of projects in the inventory it saved)
+    """
+    output = os.path.join(work_dir, 'inventory' if inventory_format == 'parquet' else 'inventory.json')
+    env = dict(os.environ, INVENTORY_API_ENDPOINT='http://localhost:{}'.format(server.server_port))
+    cmd = [sys.executable, COLLECTOR, '', '--output', output, '--format', inventory_format,
+           '--journal', os.path.join(work_dir, 'journal.json')]
+
+    start_time = time.time()
+    with io.open(os.path.join(work_dir, 'collector.log'), 'wb') as log_file:
+        return_code = subprocess.call(cmd, env=env, stdout=log_file, stderr=subprocess.STDOUT,
+                                      cwd=os.path.dirname(COLLECTOR))
+    seconds = time.time() - start_time
+
+    if return_code != 0:
+        with io.open(os.path.join(work_dir, 'collector.log'), encoding='utf8', errors='replace') as log_file:
+            print(log_file.read()[-3000:])
+        raise Exception('resource-inventory.py failed with exit code {}'.format(return_code))
+
+    if inventory_format == 'parquet':
+        import pyarrow.parquet
+        projects = pyarrow.parquet.read_metadata(os.path.join(output, 'projects.parquet')).num_rows
+    else:
+        with io.open(output, encoding='utf8') as snapshot_file:
+            projects = sum(1 for line in snapshot_file if line.strip())
+
+    return seconds, projects
+
+
+def main():
+    """
+    This is how you execute this script:
+
+    python benchmark.py [--runs N] [--format json|parquet] [--report FILE]
+                        [--projects N] [--buckets N] [--bindings N] [--members N] [--apis N]
+                        [--latency-ms MS] [--error-rate RATE] [--page-size N]
+
+    It serves a synthetic organization of the given size from fake_gcp_server.py, inventories it with
+    resource-inventory.py the given number of times, and reports throughput and peak memory of the collector.
+    For example, 1000 projects of 10 buckets each, with 50ms of latency and 1% of requests rate limited:
+
+    python benchmark.py --projects 1000 --buckets 10 --latency-ms 50 --error-rate 0.01
+    """
+
+    parser = argparse.ArgumentParser(prog='python benchmark.py',
+                                     description='Benchmarks resource-inventory.py against a synthetic organization.')
+    parser.add_argument('--runs', type=int, default=1, help='number of times to run the collector')
+    parser.add_argument('--format', choices=['json', 'parquet'], default='json',
+                        help='the format the collector saves the inventory in')
+    parser.add_argument('--report', metavar='FILE', help='also save the results into a JSON file')
+    fake_gcp_server.add_org_arguments(parser)
+    args = parser.parse_args()
+
+    server = fake_gcp_server.start_server(args)
+    work_dir = tempfile.mkdtemp(prefix='inventory-benchmark-')
+
+    results = []
+    try:
+        for run in range(args.runs):
+            requests_before = sum(count for name, count in server.counts.items() if name != 'rate_limited')
+            seconds, projects = run_collector(server, work_dir, args.format)
+            requests = sum(count for name, count in server.counts.items() if name != 'rate_limited') - requests_before
+
+            results.append({'seconds': seconds, 'projects': projects, 'requests': requests})
+            print('run {}: {} projects in {:.1f} s, {:.1f} projects/s, {:.1f} requests/s'
+                  .format(run + 1, projects, seconds, projects / seconds, requests / seconds))
+
+            if projects != args.projects:
+                raise Exception('expected {} projects in the inventory, found {}'.format(args.projects, projects))
+    finally:
+        server.shutdown()
+        shutil.rmtree(work_dir)
+
+    # ru_maxrss is in kilobytes on Linux, and the largest of all the collector runs.
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+    if sys.platform == 'darwin':
+        peak_rss_mb /= 1024.0
+
+    best = min(results, key=lambda result: result['seconds'])
+    report = {'parameters': vars(args),
+              'runs': results,
+              'best_seconds': best['seconds'],
+              'projects_per_second': best['projects'] / best['seconds'],
+              'buckets_per_second': best['projects'] * args.buckets / best['seconds'],
+              'requests_per_second': best['requests'] / best['seconds'],
+              'rate_limited': server.counts['rate_limited'],
+              'peak_rss_mb': peak_rss_mb}
+
+    print('')
+    print('best of {} runs: {:.1f} s, {:.1f} projects/s, {:.1f} buckets/s, {:.1f} requests/s'
+          .format(args.runs, report['best_seconds'], report['projects_per_second'], report['buckets_per_second'],
+                  report['requests_per_second']))
+    print('rate limited requests: {}, peak RSS of the collector: {:.1f} MB'
+          .format(report['rate_limited'], report['peak_rss_mb']))
+
+    if args.report is not None:
+        with io.open(args.report, 'w', encoding='utf8') as report_file:
+            report_file.write(u'{}'.format(json.dumps(report, indent=4, sort_keys=True)))
+
+
+if __name__ == '__main__':
+    main()
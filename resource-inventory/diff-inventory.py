@@ -0,0 +1,103 @@
+# Copyright 2019 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import collections
+import io
+import json
+import os
+
+from inventory_diff import diff_snapshots
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        prog='python diff-inventory.py',
+        description='Lists the projects, buckets, IAM bindings and API that changed between two inventory snapshots.')
+    parser.add_argument('old_snapshot', metavar='[old snapshot]',
+                        help='the snapshot of the earlier inventory: a JSON file, or a directory saved with '
+                             '--format parquet')
+    parser.add_argument('new_snapshot', metavar='[new snapshot]',
+                        help='the snapshot of the later inventory, in the same format')
+    parser.add_argument('--output', metavar='FILE',
+                        help='save the changes into a newline delimited JSON file rather than printing them')
+
+    args = parser.parse_args()
+    if os.path.isdir(args.old_snapshot) != os.path.isdir(args.new_snapshot):
+        parser.error('both snapshots must be JSON files, or both directories saved with --format parquet')
+
+    return args
+
+
+def format_change(change):
+    """
+    :return: the change as a line of text, e.g.
+             + binding  my-project/my-bucket  roles/storage.admin  user:jane@acme.com
+    """
+    sign = {'added': '+', 'removed': '-', 'modified': '~'}[change['change']]
+    resource = change['project_id'] if change['bucket_name'] is None else \
+        '{}/{}'.format(change['project_id'], change['bucket_name'])
+
+    if change['resource'] == 'binding':
+        details = [change['role'], change['member']]
+    elif change['resource'] == 'api':
+        details = [change['name']]
+    elif change['resource'] == 'field':
+        details = [change['field'], '{} -> {}'.format(json.dumps(change['old']), json.dumps(change['new']))]
+    else:
+        details = []
+
+    return '  '.join(['{} {:<8}'.format(sign, change['resource']), resource] + details)
+
+
+def main():
+    """
+    This is how you execute this script:
+
+    python diff-inventory.py [old snapshot] [new snapshot] [--output FILE]
+
+    For example, to find out what changed since yesterday:
+
+    python resource-inventory.py [project filter] --output today.json
+    python diff-inventory.py yesterday.json today.json
+
+    or, with snapshots saved as Parquet:
+
+    python resource-inventory.py [project filter] --output today --format parquet
+    python diff-inventory.py yesterday today
+    """
+
+    args = parse_arguments()
+
+    counts = collections.Counter()
+
+    output_file = None if args.output is None else io.open(args.output, 'w', encoding='utf8')
+    try:
+        for change in diff_snapshots(args.old_snapshot, args.new_snapshot):
+            counts[(change['change'], change['resource'])] += 1
+
+            if output_file is None:
+                print(format_change(change))
+            else:
+                output_file.write(u'{}\n'.format(json.dumps(change)))
+    finally:
+        if output_file is not None:
+            output_file.close()
+
+    print('{} changes: {}'.format(sum(counts.values()), ', '.join(
+        '{} {} {}'.format(count, resource, change) for (change, resource), count in sorted(counts.items()))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+# Copyright 2019 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A local fake of the Google Cloud API that resource-inventory.py calls, serving a synthetic organization.
+
+resource-inventory.py sends its calls here when INVENTORY_API_ENDPOINT is set to the address of the server, and
+every API is served under its own name:
+
+GET  /cloudresourcemanager/v1/projects                          paginated
+POST /cloudresourcemanager/v1/projects/[project Id]:getIamPolicy
+GET  /serviceusage/v1/projects/[project Id]/services
+GET  /storage/b?project=[project Id]
+GET  /storage/b/[bucket]/iam
+GET  /stats                                                     counts of the requests served so far
+
+Every response can be delayed, and a share of them answered with 429 to exercise retries.
+"""
+
+import argparse
+import collections
+import json
+import random
+import re
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+ROLES = ['roles/owner', 'roles/editor', 'roles/viewer', 'roles/browser', 'roles/iam.securityReviewer',
+         'roles/bigquery.dataViewer', 'roles/logging.viewer', 'roles/monitoring.viewer']
+
+BUCKET_ROLES = ['roles/storage.legacyBucketOwner', 'roles/storage.legacyBucketReader', 'roles/storage.objectViewer',
+                'roles/storage.objectAdmin', 'roles/storage.admin', 'roles/storage.objectCreator']
+
+APIS = ['bigquery-json.googleapis.com', 'storage-api.googleapis.com', 'storage-component.googleapis.com',
+        'logging.googleapis.com', 'monitoring.googleapis.com', 'pubsub.googleapis.com', 'compute.googleapis.com',
+        'container.googleapis.com', 'cloudfunctions.googleapis.com', 'sqladmin.googleapis.com',
+        'iam.googleapis.com', 'cloudresourcemanager.googleapis.com', 'serviceusage.googleapis.com',
+        'dataflow.googleapis.com', 'dataproc.googleapis.com', 'bigtableadmin.googleapis.com']
+
+
+class SyntheticOrg(object):
+    """
+    An organization generated on the fly, the same for the same parameters, so that it takes no memory however large.
+    """
+
+    def __init__(self, projects=100, buckets=5, bindings=5, members=3, apis=10, users=1000, seed=0):
+        self.projects = projects
+        self.buckets = buckets
+        self.bindings = bindings
+        self.members = members
+        self.apis = min(apis, len(APIS))
+        self.users = users
+        self.seed = seed
+
+    def project_id(self, index):
+        return 'synthetic-project-{:06d}'.format(index)
+
+    def project(self, index):
+        return {'projectNumber': str(100000000000 + index),
+                'projectId': self.project_id(index),
+                'lifecycleState': 'ACTIVE',
+                'name': 'Synthetic Project {}'.format(index),
+                'labels': {'env': ['dev', 'test', 'prod'][index % 3], 'team': 'team-{}'.format(index % 17)},
+                'createTime': '2019-01-01T00:00:00.000Z',
+                'parent': {'type': 'folder', 'id': str(1000 + index % 10)}}
+
+    def project_index(self, project_id):
+        match = re.match(r'synthetic-project-(\d+)$', project_id)
+        index = int(match.group(1)) if match else -1
+        return index if 0 <= index < self.projects else None
+
+    def project_bindings(self, index):
+        return self.__bindings(ROLES, 'project', index)
+
+    def bucket_name(self, index, bucket):
+        return '{}-bucket-{:03d}'.format(self.project_id(index), bucket)
+
+    def bucket(self, index, bucket):
+        name = self.bucket_name(index, bucket)
+        return {'kind': 'storage#bucket', 'id': name, 'name': name, 'projectNumber': str(100000000000 + index),
+                'storageClass': 'STANDARD', 'location': 'US', 'timeCreated': '2019-01-01T00:00:00.000Z',
+                'updated': '2019-01-01T00:00:00.000Z', 'labels': {'bucket': str(bucket)}}
+
+    def bucket_index(self, bucket_name):
+        match = re.match(r'(synthetic-project-\d+)-bucket-(\d+)$', bucket_name)
+        if match is None:
+            return None
+
+        index = self.project_index(match.group(1))
+        bucket = int(match.group(2))
+        return (index, bucket) if index is not None and bucket < self.buckets else None
+
+    def bucket_bindings(self, index, bucket):
+        # Like real buckets, the legacy roles are granted to the same convenience members on every bucket of a project.
+        bindings = [{'role': 'roles/storage.legacyBucketOwner',
+                     'members': ['projectEditor:{}'.format(self.project_id(index)),
+                                 'projectOwner:{}'.format(self.project_id(index))]},
+                    {'role': 'roles/storage.legacyBucketReader',
+                     'members': ['projectViewer:{}'.format(self.project_id(index))]}]
+
+        return (bindings + self.__bindings(BUCKET_ROLES[2:], 'bucket', index * 1000 + bucket))[:self.bindings]
+
+    def services(self, index):
+        apis = random.Random('{}-apis-{}'.format(self.seed, index)).sample(APIS, self.apis)
+        return [{'name': 'projects/{}/services/{}'.format(100000000000 + index, api),
+                 'config': {'name': api, 'title': api.split('.')[0].title()},
+                 'state': 'ENABLED'} for api in apis]
+
+    def __bindings(self, roles, kind, index):
+        rng = random.Random('{}-{}-{}'.format(self.seed, kind, index))
+        return [{'role': role,
+                 'members': ['user:user{:05d}@example.com'.format(rng.randrange(self.users))
+                             for _ in range(self.members)]}
+                for role in rng.sample(roles, min(self.bindings, len(roles)))]
+
+
+class FakeGcpServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, org, latency=0.0, error_rate=0.0, page_size=100):
+        HTTPServer.__init__(self, address, FakeGcpHandler)
+        self.org = org
+        self.latency = latency
+        self.error_rate = error_rate
+        self.page_size = page_size
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+
+class FakeGcpHandler(BaseHTTPRequestHandler):
+
+    ROUTES = [
+        ('GET', r'/cloudresourcemanager/v1/projects$', 'list_projects'),
+        ('POST', r'/cloudresourcemanager/v1/projects/([^/:]+):getIamPolicy$', 'get_project_iam_policy'),
+        ('GET', r'/serviceusage/v1/projects/([^/]+)/services$', 'list_services'),
+        ('GET', r'/storage/b$', 'list_buckets'),
+        ('GET', r'/storage/b/([^/]+)/iam$', 'get_bucket_iam_policy'),
+        ('GET', r'/stats$', 'stats'),
+    ]
+
+    def do_GET(self):
+        self.__route('GET')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        self.__route('POST')
+
+    def log_message(self, format, *args):
+        pass
+
+    def __route(self, method):
+        url = urlparse(self.path)
+        query = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+
+        for route_method, pattern, handler in self.ROUTES:
+            match = re.match(pattern, url.path)
+            if route_method == method and match:
+                if handler != 'stats':
+                    self.server.count(handler)
+                    self.__delay()
+                    if random.random() < self.server.error_rate:
+                        self.server.count('rate_limited')
+                        return self.__error(429, 'Quota exceeded for quota metric \'Read requests\'.',
+                                            'rateLimitExceeded')
+
+                return getattr(self, handler)(query, *match.groups())
+
+        self.__error(404, 'Not found: {} {}'.format(method, url.path), 'notFound')
+
+    def list_projects(self, query):
+        org = self.server.org
+        start = int(query.get('pageToken') or 0)
+        end = min(start + int(query.get('pageSize') or self.server.page_size), org.projects)
+
+        response = {'projects': [org.project(index) for index in range(start, end)]}
+        if end < org.projects:
+            response['nextPageToken'] = str(end)
+
+        self.__respond(response)
+
+    def get_project_iam_policy(self, query, project_id):
+        index = self.server.org.project_index(project_id)
+        if index is None:
+            return self.__error(403, 'The caller does not have permission', 'forbidden')
+
+        self.__respond({'version': 1, 'etag': 'BwWKmjvelug=', 'bindings': self.server.org.project_bindings(index)})
+
+    def list_services(self, query, project_id):
+        index = self.server.org.project_index(project_id)
+        if index is None:
+            return self.__error(403, 'The caller does not have permission', 'forbidden')
+
+        self.__respond({'services': self.server.org.services(index)})
+
+    def list_buckets(self, query):
+        index = self.server.org.project_index(query.get('project', ''))
+        if index is None:
+            return self.__error(403, 'The caller does not have permission', 'forbidden')
+
+        buckets = [self.server.org.bucket(index, bucket) for bucket in range(self.server.org.buckets)]
+        self.__respond({'kind': 'storage#buckets', 'items': buckets} if buckets else {'kind': 'storage#buckets'})
+
+    def get_bucket_iam_policy(self, query, bucket_name):
+        bucket = self.server.org.bucket_index(bucket_name)
+        if bucket is None:
+            return self.__error(404, 'Not Found', 'notFound')
+
+        self.__respond({'kind': 'storage#policy', 'resourceId': 'projects/_/buckets/{}'.format(bucket_name),
+                        'bindings': self.server.org.bucket_bindings(*bucket), 'etag': 'CAE='})
+
+    def stats(self, query):
+        with self.server.lock:
+            self.__respond(dict(self.server.counts))
+
+    def __delay(self):
+        if self.server.latency > 0:
+            # Latency varies by up to 50% either way, as it does in real life.
+            time.sleep(self.server.latency * random.uniform(0.5, 1.5))
+
+    def __error(self, code, message, reason):
+        self.__respond({'error': {'code': code, 'message': message,
+                                  'errors': [{'message': message, 'domain': 'global', 'reason': reason}]}}, code)
+
+    def __respond(self, response, code=200):
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def add_org_arguments(parser):
+    parser.add_argument('--projects', type=int, default=100, help='number of projects in the organization')
+    parser.add_argument('--buckets', type=int, default=5, help='number of buckets per project')
+    parser.add_argument('--bindings', type=int, default=5, help='number of IAM bindings per project and bucket')
+    parser.add_argument('--members', type=int, default=3, help='number of members per IAM binding')
+    parser.add_argument('--apis', type=int, default=10, help='number of enabled API per project')
+    parser.add_argument('--latency-ms', type=float, default=0, help='average latency of every response')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='share of the requests answered with 429, e.g. 0.01')
+    parser.add_argument('--page-size', type=int, default=100, help='number of projects per page of projects().list')
+
+
+def start_server(args, port=0):
+    """
+    Starts the fake server in a background thread.
+    :param args: the arguments added by add_org_arguments()
+    :param port: the port to listen on; any free port by default
+    :return: FakeGcpServer, whose address is http://localhost:[server.server_port]
+    """
+    org = SyntheticOrg(projects=args.projects, buckets=args.buckets, bindings=args.bindings,
+                       members=args.members, apis=args.apis)
+    server = FakeGcpServer(('localhost', port), org, latency=args.latency_ms / 1000.0,
+                           error_rate=args.error_rate, page_size=args.page_size)
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server
+
+
+def main():
+    """
+    This is how you execute this script:
+
+    python fake_gcp_server.py [--port PORT] [--projects N] [--buckets N] [--bindings N] [--members N] [--apis N]
+                              [--latency-ms MS] [--error-rate RATE] [--page-size N]
+
+    and then, in another shell:
+
+    INVENTORY_API_ENDPOINT=http://localhost:8080 python resource-inventory.py "" --output snapshot.json
+    """
+
+    parser = argparse.ArgumentParser(prog='python fake_gcp_server.py',
+                                     description='Serves a synthetic organization to resource-inventory.py.')
+    parser.add_argument('--port', type=int, default=8080)
+    add_org_arguments(parser)
+    args = parser.parse_args()
+
+    server = start_server(args, args.port)
+    print('serving {} projects at http://localhost:{}; press Ctrl+C to stop...'
+          .format(args.projects, server.server_port))
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+# Copyright 2019 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Reads the inventory from a Cloud Asset Inventory export rather than the API.
+
+An export of an organization, e.g.
+
+gcloud asset export --organization=[organization Id] --content-type=resource --output-path=gs://[bucket]/resource.json
+gcloud asset export --organization=[organization Id] --content-type=iam-policy --output-path=gs://[bucket]/iam.json
+
+holds every project, bucket and enabled service, and every IAM policy, as newline delimited JSON, one asset per line:
+
+{"name": "//storage.googleapis.com/my-bucket", "asset_type": "storage.googleapis.com/Bucket",
+ "resource": {"parent": "//cloudresourcemanager.googleapis.com/projects/123", "data": {...}}}
+{"name": "//storage.googleapis.com/my-bucket", "asset_type": "storage.googleapis.com/Bucket",
+ "iam_policy": {"bindings": [...]}}
+
+The files are read one line at a time, and the assets are put together into the same project dictionaries that
+resource-inventory.py collects from the API, so the rest of the script doesn't know the difference.
+"""
+
+import fnmatch
+import gzip
+import io
+import json
+
+from utils import key_value_pairs
+from inventory_snapshot import shard_of
+
+PROJECT = 'cloudresourcemanager.googleapis.com/Project'
+BUCKET = 'storage.googleapis.com/Bucket'
+SERVICE = 'serviceusage.googleapis.com/Service'
+
+PROJECT_PREFIX = '//cloudresourcemanager.googleapis.com/projects/'
+
+
+def read_asset_export(input_file_names, binding_table, project_filter='', shard=None):
+    """
+    Reads the projects, their buckets, enabled API and IAM policies from Cloud Asset Inventory export files.
+    :param input_file_names: local copies of the export files, resource and IAM policy alike; .gz files are unzipped
+    :param binding_table: the BindingTable the IAM bindings of the projects and buckets are interned in
+    :param project_filter: only projects that match this filter are read; see matches_filter()
+    :param shard: (i, N) to only read the i-th of N shards of the projects, or None
+    :return: list of project dictionaries, as collected by resource-inventory.py
+    """
+    projects = {}           # project number to project dictionary
+    buckets = {}            # bucket name to (project number, bucket dictionary)
+    api = {}                # project number to list of enabled API
+    policies = {}           # asset name to IAM bindings
+
+    for asset in __read_assets(input_file_names):
+        asset_type = asset.get('asset_type', asset.get('assetType'))
+        if asset_type not in (PROJECT, BUCKET, SERVICE):
+            continue
+
+        iam_policy = asset.get('iam_policy', asset.get('iamPolicy'))
+        if iam_policy is not None:
+            policies[asset['name']] = binding_table.policy(iam_policy.get('bindings', []))
+
+        resource = asset.get('resource')
+        if resource is None:
+            continue
+
+        data = resource.get('data', {})
+        if asset_type == PROJECT:
+            projects[data['projectNumber']] = data
+        elif asset_type == BUCKET:
+            buckets[data['name']] = (__project_number(resource.get('parent')), __bucket_dict(data))
+        elif data.get('state') == 'ENABLED':
+            api.setdefault(__project_number(resource.get('parent') or data.get('parent')), []).append(
+                __api_dict(data.get('config', {})))
+
+    collected = {}          # project number to the project dictionary collected for it
+    for project_number, project in projects.items():
+        if not matches_filter(project, project_filter):
+            continue
+
+        if shard is not None and shard_of(project['projectId'], shard[1]) != shard[0]:
+            continue
+
+        project_dict = dict(project)
+        if 'labels' in project_dict:
+            project_dict['labels'] = key_value_pairs(project_dict['labels'])
+
+        project_dict['iam_bindings'] = policies.get(PROJECT_PREFIX + project_number) or binding_table.policy([])
+        project_dict['enabled_api'] = api.get(project_number, [])
+        project_dict['buckets'] = []
+        collected[project_number] = project_dict
+
+    for bucket_name, (project_number, bucket_dict) in sorted(buckets.items()):
+        project_dict = collected.get(project_number)
+        if project_dict is None:
+            continue
+
+        bucket_dict['iam_bindings'] = policies.get('//storage.googleapis.com/' + bucket_name) or \
+            binding_table.policy([])
+        project_dict['buckets'].append(bucket_dict)
+
+    return sorted(collected.values(), key=lambda project_dict: project_dict['projectId'])
+
+
+def matches_filter(project, project_filter):
+    """
+    Matches a project against a filter of the same syntax as projects().list, e.g. "name:PROD* labels.env:prod".
+    Every term of the filter must match; values are compared case insensitively, and may use * as a wildcard.
+    Supported fields are name, id, lifecycleState, parent.type, parent.id and labels.[key].
+    :param project: the project, as in the resource data of its asset
+    :param project_filter: the filter; an empty filter matches every project
+    :return: bool
+    """
+    values = {'name': project.get('name'), 'id': project.get('projectId'),
+              'lifecycleState': project.get('lifecycleState'),
+              'parent.type': project.get('parent', {}).get('type'), 'parent.id': project.get('parent', {}).get('id')}
+    for key, value in project.get('labels', {}).items():
+        values['labels.{}'.format(key)] = value
+
+    for term in (project_filter or '').split():
+        field, _, pattern = term.partition(':')
+        if field not in values and not field.startswith('labels.'):
+            raise ValueError('unsupported field in project filter: {}'.format(field))
+
+        value = values.get(field)
+        if value is None or not fnmatch.fnmatchcase(value.lower(), pattern.lower()):
+            return False
+
+    return True
+
+
+def __read_assets(input_file_names):
+    for input_file_name in input_file_names:
+        if input_file_name.endswith('.gz'):
+            input_file = io.TextIOWrapper(gzip.open(input_file_name), encoding='utf8')
+        else:
+            input_file = io.open(input_file_name, encoding='utf8')
+
+        with input_file:
+            for line in input_file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def __project_number(parent):
+    # e.g. //cloudresourcemanager.googleapis.com/projects/123, or projects/123 for services
+    return (parent or '').rsplit('/', 1)[-1]
+
+
+def __bucket_dict(data):
+    bucket_dict = {'id': data['id'],
+                   'name': data['name'],
+                   'class': data.get('storageClass'),
+                   'location': data.get('location'),
+                   'created': data.get('timeCreated'),
+                   'updated': data.get('updated')}
+
+    if 'labels' in data:
+        bucket_dict['labels'] = key_value_pairs(data['labels'])
+
+    return bucket_dict
+
+
+def __api_dict(config):
+    api_dict = {}
+    for key in ('name', 'title', 'quota'):
+        if key in config:
+            api_dict[key] = config[key]
+
+    return api_dict
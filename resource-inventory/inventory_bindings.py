@@ -0,0 +1,176 @@
+# Copyright 2019 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A compact in-memory representation of IAM policies.
+
+The same roles, members, and whole bindings repeat across thousands of projects and buckets, e.g.
+roles/storage.legacyBucketOwner granted to the owners of a project on every one of its buckets. Rather than keeping
+a copy of the strings in every policy, a BindingTable keeps each of them once, under an integer Id, and a Policy
+only holds the Ids. Policies are turned back into the JSON shape returned by the API, bindings and members in their
+original order, when the inventory is written out.
+"""
+
+import json
+
+
+class Interner(object):
+    """
+    Assigns consecutive integer Ids to distinct values, and keeps a single copy of each value.
+    """
+
+    __slots__ = ('_ids', 'values')
+
+    def __init__(self):
+        self._ids = {}
+        self.values = []
+
+    def intern(self, value):
+        value_id = self._ids.get(value)
+        if value_id is None:
+            value_id = len(self.values)
+            self._ids[value] = value_id
+            self.values.append(value)
+
+        return value_id
+
+    def __len__(self):
+        return len(self.values)
+
+
+class Binding(object):
+    """
+    An IAM binding: a role, its members, and any other field of the binding, such as a condition.
+    Bindings are shared by all the policies that hold the same binding, and must not be modified.
+    """
+
+    __slots__ = ('role', 'members', 'extras')
+
+    def __init__(self, role, members, extras):
+        self.role = role            # Id of the role
+        self.members = members      # tuple of member Ids, in their original order
+        self.extras = extras        # Id of the other fields as a JSON string, or None
+
+
+class Policy(object):
+    """
+    The IAM bindings of a project or bucket.
+    """
+
+    __slots__ = ('table', 'bindings')
+
+    def __init__(self, table, bindings):
+        self.table = table
+        self.bindings = bindings    # tuple of Binding, in their original order
+
+    def to_json(self):
+        """
+        :return: the bindings in the shape returned by the API, i.e. [{'role': ..., 'members': [...]}, ...]
+        """
+        roles = self.table.roles.values
+        members = self.table.members.values
+        extras = self.table.extras.values
+
+        bindings = []
+        for binding in self.bindings:
+            binding_dict = {'role': roles[binding.role], 'members': [members[member] for member in binding.members]}
+            if binding.extras is not None:
+                binding_dict.update(json.loads(extras[binding.extras]))
+
+            bindings.append(binding_dict)
+
+        return bindings
+
+
+class BindingTable(object):
+    """
+    Interns the roles, members, and bindings of all the policies of an inventory.
+    """
+
+    def __init__(self):
+        self.roles = Interner()
+        self.members = Interner()
+        self.extras = Interner()
+        self._member_lists = {}
+        self._bindings = {}
+        self._policies = {}
+
+    def policy(self, bindings):
+        """
+        :param bindings: the bindings as returned by the API, i.e. [{'role': ..., 'members': [...]}, ...]
+        :return: Policy
+        """
+        compact_bindings = tuple(self._binding(binding) for binding in bindings)
+
+        # Identical policies, e.g. on buckets that inherit their project's defaults, share a single Policy.
+        policy = self._policies.get(compact_bindings)
+        if policy is None:
+            policy = self._policies[compact_bindings] = Policy(self, compact_bindings)
+
+        return policy
+
+    def _binding(self, binding):
+        role = self.roles.intern(binding['role'])
+
+        members = tuple(self.members.intern(member) for member in binding.get('members', []))
+        members = self._member_lists.setdefault(members, members)
+
+        other_fields = dict((key, value) for key, value in binding.items() if key not in ('role', 'members'))
+        extras = self.extras.intern(json.dumps(other_fields, sort_keys=True)) if other_fields else None
+
+        key = (role, members, extras)
+        compact_binding = self._bindings.get(key)
+        if compact_binding is None:
+            compact_binding = self._bindings[key] = Binding(role, members, extras)
+
+        return compact_binding
+
+    def compact_project(self, project_dict):
+        """
+        Replaces the IAM bindings of a project and its buckets with compact policies, in place.
+        IAM bindings that hold an error rather than bindings are kept as they are.
+        :param project_dict: the project dictionary, as collected by resource-inventory.py
+        :return: the project dictionary
+        """
+        if isinstance(project_dict.get('iam_bindings'), list):
+            project_dict['iam_bindings'] = self.policy(project_dict['iam_bindings'])
+
+        for bucket in project_dict.get('buckets', []):
+            if isinstance(bucket.get('iam_bindings'), list):
+                bucket['iam_bindings'] = self.policy(bucket['iam_bindings'])
+
+        return project_dict
+
+
+def expand_project(project_dict):
+    """
+    Turns the compact policies of a project and its buckets back into the JSON shape returned by the API.
+    :param project_dict: the project dictionary, with compact policies
+    :return: a copy of the project dictionary, ready to be serialized
+    """
+    project_dict = dict(project_dict)
+    if isinstance(project_dict.get('iam_bindings'), Policy):
+        project_dict['iam_bindings'] = project_dict['iam_bindings'].to_json()
+
+    if 'buckets' in project_dict:
+        project_dict['buckets'] = [expand_bucket(bucket) for bucket in project_dict['buckets']]
+
+    return project_dict
+
+
+def expand_bucket(bucket_dict):
+    if isinstance(bucket_dict.get('iam_bindings'), Policy):
+        bucket_dict = dict(bucket_dict, iam_bindings=bucket_dict['iam_bindings'].to_json())
+
+    return bucket_dict
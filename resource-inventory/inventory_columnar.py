@@ -0,0 +1,312 @@
+# Copyright 2019 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import os
+import shutil
+
+# The inventory flattened into normalized tables. For every table, its columns and their BigQuery types.
+# bucket_name is empty for rows that belong to the project itself rather than one of its buckets.
+TABLES = {
+    'projects': [('inventory_time', 'TIMESTAMP'), ('project_id', 'STRING'), ('project_number', 'STRING'),
+                 ('name', 'STRING'), ('lifecycle_state', 'STRING'), ('create_time', 'STRING'),
+                 ('parent_type', 'STRING'), ('parent_id', 'STRING')],
+    'bindings': [('inventory_time', 'TIMESTAMP'), ('project_id', 'STRING'), ('bucket_name', 'STRING'),
+                 ('role', 'STRING'), ('member', 'STRING')],
+    'buckets': [('inventory_time', 'TIMESTAMP'), ('project_id', 'STRING'), ('bucket_id', 'STRING'),
+                ('bucket_name', 'STRING'), ('storage_class', 'STRING'), ('location', 'STRING'),
+                ('created', 'STRING'), ('updated', 'STRING')],
+    'enabled_api': [('inventory_time', 'TIMESTAMP'), ('project_id', 'STRING'), ('name', 'STRING'),
+                    ('title', 'STRING')],
+    'labels': [('inventory_time', 'TIMESTAMP'), ('project_id', 'STRING'), ('bucket_name', 'STRING'),
+               ('key', 'STRING'), ('value', 'STRING')],
+    'errors': [('inventory_time', 'TIMESTAMP'), ('project_id', 'STRING'), ('bucket_name', 'STRING'),
+               ('source', 'STRING'), ('message', 'STRING')],
+}
+
+# Rows are sorted by project so that each row group covers a narrow range of projects, and filters on
+# project_id skip most row groups when reading the files.
+ROW_GROUP_SIZE = 64 * 1024
+
+# Where the Parquet files are kept on their way to BigQuery.
+PARQUET_DIRECTORY = 'tmp_parquet'
+
+
+def flatten_project(inventory_time, project):
+    """
+    Flattens the nested metadata about a project into rows of the normalized tables.
+    :param inventory_time: the timestamp of the inventory
+    :param project: the project dictionary, as collected by resource-inventory.py
+    :return: dictionary of table name to list of rows, each row a dictionary of column name to value
+    """
+    project_id = project['projectId']
+    common = {'inventory_time': inventory_time, 'project_id': project_id}
+    rows = dict((table_name, []) for table_name in TABLES)
+
+    parent = project.get('parent', {})
+    rows['projects'].append(dict(common, project_number=project.get('projectNumber'), name=project.get('name'),
+                                 lifecycle_state=project.get('lifecycleState'), create_time=project.get('createTime'),
+                                 parent_type=parent.get('type'), parent_id=parent.get('id')))
+
+    __flatten_resource(rows, common, None, project)
+
+    for api in project.get('enabled_api', []):
+        if 'error' in api:
+            __flatten_errors(rows, common, None, 'enabled_api', api['error'])
+        else:
+            rows['enabled_api'].append(dict(common, name=api.get('name'), title=api.get('title')))
+
+    for bucket in project.get('buckets', []):
+        if 'error' in bucket:
+            __flatten_errors(rows, common, None, 'buckets', bucket['error'])
+            continue
+
+        rows['buckets'].append(dict(common, bucket_id=bucket['id'], bucket_name=bucket['name'],
+                                    storage_class=bucket.get('class'), location=bucket.get('location'),
+                                    created=bucket.get('created'), updated=bucket.get('updated')))
+        __flatten_resource(rows, common, bucket['name'], bucket)
+
+    return rows
+
+
+def __flatten_resource(rows, common, bucket_name, resource):
+    """
+    Flattens the IAM bindings and labels of a project or bucket.
+    """
+    for label in resource.get('labels', []):
+        rows['labels'].append(dict(common, bucket_name=bucket_name, key=label['key'], value=label['value']))
+
+    iam_bindings = resource.get('iam_bindings', [])
+    if isinstance(iam_bindings, dict):
+        __flatten_errors(rows, common, bucket_name, 'iam_bindings', iam_bindings['error'])
+        return
+
+    for binding in iam_bindings:
+        for member in binding.get('members', []):
+            rows['bindings'].append(dict(common, bucket_name=bucket_name, role=binding['role'], member=member))
+
+
+def __flatten_errors(rows, common, bucket_name, source, messages):
+    for message in messages:
+        rows['errors'].append(dict(common, bucket_name=bucket_name, source=source, message=message))
+
+
+def save_parquet(inventory, output_dir):
+    """
+    Writes the inventory as one Parquet file per normalized table, with explicit schemas.
+    :param inventory: the inventory document, i.e. {'inventory_time': ..., 'projects': [...]}; projects may be any iterable
+    :param output_dir: the directory the files are written to; e.g. output_dir/bindings.parquet
+    :return: list of the written files
+    """
+    import pyarrow
+    import pyarrow.parquet
+
+    inventory_time = datetime.datetime.strptime(inventory['inventory_time'], '%Y-%m-%d %H:%M')
+
+    # Accumulate every table column by column rather than row by row.
+    columns = dict((table_name, dict((column, []) for column, _ in schema)) for table_name, schema in TABLES.items())
+    for project in inventory['projects']:
+        for table_name, rows in flatten_project(inventory_time, project).items():
+            for row in rows:
+                for column, values in columns[table_name].items():
+                    values.append(row.get(column))
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    file_names = []
+    for table_name, schema in sorted(TABLES.items()):
+        arrow_schema = pyarrow.schema([(column, __arrow_type(column_type)) for column, column_type in schema])
+        table = pyarrow.Table.from_pydict(columns[table_name], schema=arrow_schema).sort_by('project_id')
+
+        file_name = os.path.join(output_dir, '{}.parquet'.format(table_name))
+        pyarrow.parquet.write_table(table, file_name, row_group_size=ROW_GROUP_SIZE, compression='snappy')
+        file_names.append(file_name)
+
+    return file_names
+
+
+def read_parquet(input_dir, table_name, columns=None, filters=None):
+    """
+    Reads a normalized table from local Parquet files. Filters are pushed down to the files: row groups
+    whose statistics rule out a match are never read.
+    :param input_dir: the directory the files were written to by save_parquet()
+    :param table_name: one of TABLES, e.g. 'bindings'
+    :param columns: the columns to read; all columns by default
+    :param filters: e.g. [('member', '=', 'user:jane@acme.com')]
+    :return: pyarrow.Table
+    """
+    import pyarrow.parquet
+
+    return pyarrow.parquet.read_table(os.path.join(input_dir, '{}.parquet'.format(table_name)),
+                                      columns=columns, filters=filters)
+
+
+def read_projects(input_dir):
+    """
+    Reads the projects back out of the normalized tables written by save_parquet(), one project at a time. Every table
+    is sorted by project_id, so the tables are streamed side by side a row group at a time rather than read whole.
+    The projects are rebuilt in the shape collected by resource-inventory.py, as far as the tables keep it: fields
+    that aren't in any table, such as the other metadata of a bucket, are left out, and so are empty fields.
+    :param input_dir: the directory the files were written to by save_parquet()
+    :return: generator of project dictionaries, in order of projectId
+    """
+    tables = dict((table_name, __rows_by_project(os.path.join(input_dir, '{}.parquet'.format(table_name))))
+                  for table_name in TABLES if table_name != 'projects')
+    pending = dict((table_name, next(rows, None)) for table_name, rows in tables.items())
+
+    for project_id, (row,) in __rows_by_project(os.path.join(input_dir, 'projects.parquet')):
+        rows = {}
+        for table_name in tables:
+            if pending[table_name] is not None and pending[table_name][0] == project_id:
+                rows[table_name] = pending[table_name][1]
+                pending[table_name] = next(tables[table_name], None)
+            else:
+                rows[table_name] = []
+
+        yield __project(row, rows)
+
+
+def __rows_by_project(file_name):
+    """
+    :return: generator of (project_id, rows of the project) of a table sorted by project_id, each row a dictionary
+    """
+    import pyarrow.parquet
+
+    project_id, rows = None, []
+    for batch in pyarrow.parquet.ParquetFile(file_name).iter_batches():
+        for row in batch.to_pylist():
+            if rows and row['project_id'] != project_id:
+                yield project_id, rows
+                rows = []
+
+            project_id = row['project_id']
+            rows.append(row)
+
+    if rows:
+        yield project_id, rows
+
+
+def __project(row, rows):
+    """
+    The reverse of flatten_project().
+    :param row: the row of the project in the projects table
+    :param rows: dictionary of every other table name to the rows of the project in it
+    :return: the project dictionary
+    """
+    errors = {}
+    for error in rows['errors']:
+        errors.setdefault((error['bucket_name'], error['source']), []).append(error['message'])
+
+    project = __without_empty_fields({'projectId': row['project_id'], 'projectNumber': row['project_number'],
+                                      'name': row['name'], 'lifecycleState': row['lifecycle_state'],
+                                      'createTime': row['create_time'],
+                                      'parent': __without_empty_fields({'type': row['parent_type'],
+                                                                        'id': row['parent_id']})})
+    project.update(__resource(None, rows, errors))
+
+    project['enabled_api'] = [__without_empty_fields({'name': api['name'], 'title': api['title']})
+                              for api in rows['enabled_api']]
+    if (None, 'enabled_api') in errors:
+        project['enabled_api'].append({'error': errors[(None, 'enabled_api')]})
+
+    project['buckets'] = []
+    for bucket in rows['buckets']:
+        bucket_dict = __without_empty_fields({'id': bucket['bucket_id'], 'name': bucket['bucket_name'],
+                                              'class': bucket['storage_class'], 'location': bucket['location'],
+                                              'created': bucket['created'], 'updated': bucket['updated']})
+        bucket_dict.update(__resource(bucket['bucket_name'], rows, errors))
+        project['buckets'].append(bucket_dict)
+    if (None, 'buckets') in errors:
+        project['buckets'].append({'error': errors[(None, 'buckets')]})
+
+    return project
+
+
+def __resource(bucket_name, rows, errors):
+    """
+    :return: the labels and IAM bindings of the project, or of one of its buckets, as in the collected metadata
+    """
+    resource = {}
+
+    labels = [{'key': label['key'], 'value': label['value']} for label in rows['labels']
+              if label['bucket_name'] == bucket_name]
+    if labels:
+        resource['labels'] = labels
+
+    if (bucket_name, 'iam_bindings') in errors:
+        resource['iam_bindings'] = {'error': errors[(bucket_name, 'iam_bindings')]}
+        return resource
+
+    # Members of the same role are adjacent, in their original order, as flatten_project() wrote them.
+    resource['iam_bindings'] = []
+    for binding in rows['bindings']:
+        if binding['bucket_name'] != bucket_name:
+            continue
+
+        if not resource['iam_bindings'] or resource['iam_bindings'][-1]['role'] != binding['role']:
+            resource['iam_bindings'].append({'role': binding['role'], 'members': []})
+        resource['iam_bindings'][-1]['members'].append(binding['member'])
+
+    return resource
+
+
+def __without_empty_fields(fields):
+    return dict((key, value) for key, value in fields.items() if value is not None and value != {})
+
+
+def persist_parquet(inventory, dataset_id, table_id, output_dir):
+    """
+    Persists the inventory into one BigQuery table per normalized table, named [table_id]_[table name],
+    e.g. inventory_bindings. The Parquet files are loaded as they are, with explicit schemas.
+    :param inventory: the inventory document, i.e. {'inventory_time': ..., 'projects': [...]}
+    :param dataset_id: The Id of an EXISTING BigQuery dataset.
+    :param table_id: The prefix of the BigQuery tables. If tables don't exist, they will be created.
+    :param output_dir: a temporary directory for the Parquet files, deleted once they are loaded
+    :return: None
+    """
+    from google.cloud import bigquery
+
+    save_parquet(inventory, output_dir)
+
+    client = bigquery.Client()
+
+    dataset_ref = client.dataset(dataset_id)
+    dataset_location = client.get_dataset(dataset_ref).location
+
+    for table_name, schema in sorted(TABLES.items()):
+        table_ref = dataset_ref.table('{}_{}'.format(table_id, table_name))
+        job_config = bigquery.LoadJobConfig()
+        job_config.source_format = bigquery.SourceFormat.PARQUET
+        job_config.schema = [bigquery.SchemaField(column, column_type) for column, column_type in schema]
+        job_config.write_disposition = bigquery.WriteDisposition.WRITE_APPEND
+
+        with open(os.path.join(output_dir, '{}.parquet'.format(table_name)), 'rb') as source_file:
+            job = client.load_table_from_file(
+                source_file,
+                table_ref,
+                location=dataset_location,  # Must match the destination dataset location.
+                job_config=job_config)      # API request
+
+        job.result()  # Waits for table load to complete.
+
+        print('Loaded {} rows into {}:{}.'.format(job.output_rows, dataset_id, table_ref.table_id))
+
+    shutil.rmtree(output_dir)  # Delete temp Parquet files
+
+
+def __arrow_type(column_type):
+    import pyarrow
+
+    return pyarrow.timestamp('us') if column_type == 'TIMESTAMP' else pyarrow.string()
@@ -0,0 +1,232 @@
+# Copyright 2019 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Finds what changed between two inventory snapshots.
+
+The old snapshot is read once to index every project by a hash of its content and the offset of its line in the file.
+The new snapshot is then streamed one project at a time: projects with the same hash are unchanged and skipped,
+and only the old line of a changed project is read back, by its offset, to find out what changed. Memory is bounded
+by the number of projects, not by the size of the snapshots.
+
+Snapshots saved with --format parquet are directories of normalized tables, sorted by project. The projects of the two
+snapshots are read back side by side, in order of projectId, and matched up as they go.
+"""
+
+import hashlib
+import io
+import json
+import os
+
+from inventory_columnar import read_projects
+
+# The parts of a project and bucket compared on their own; every other field is compared as a whole.
+NESTED_FIELDS = ('iam_bindings', 'enabled_api', 'buckets')
+
+
+def index_snapshot(input_file_name):
+    """
+    :param input_file_name: the snapshot file
+    :return: dictionary of projectId to (content hash, offset of the line of the project in the file)
+    """
+    index = {}
+    for offset, line in __read_lines(input_file_name):
+        for project in json.loads(line.decode('utf-8'))['projects']:
+            index[project['projectId']] = (content_hash(project), offset)
+
+    return index
+
+
+def content_hash(project):
+    return hashlib.md5(json.dumps(project, sort_keys=True).encode('utf-8')).digest()
+
+
+def diff_snapshots(old_file_name, new_file_name):
+    """
+    Compares two snapshots, either both JSON files or both directories of Parquet files.
+    :param old_file_name: the snapshot of the earlier inventory
+    :param new_file_name: the snapshot of the later inventory
+    :return: generator of changes, each a dictionary such as
+             {'change': 'added', 'resource': 'binding', 'project_id': ..., 'bucket_name': ..., 'role': ..., 'member': ...}
+             where change is one of added, removed or modified and resource is one of project, bucket, binding, api
+             or field. bucket_name is None for changes at the project level.
+    :raises ValueError: if one snapshot is a JSON file and the other a Parquet directory; the tables don't keep
+            every field of the JSON, so those would all show up as changes.
+    """
+    if os.path.isdir(old_file_name) != os.path.isdir(new_file_name):
+        raise ValueError('cannot compare a JSON snapshot with a Parquet one; save both inventories with the same '
+                         '--format')
+
+    if os.path.isdir(old_file_name):
+        return __diff_parquet_snapshots(old_file_name, new_file_name)
+
+    return __diff_json_snapshots(old_file_name, new_file_name)
+
+
+def __diff_json_snapshots(old_file_name, new_file_name):
+    index = index_snapshot(old_file_name)
+
+    with io.open(old_file_name, 'rb') as old_file:
+        for _, line in __read_lines(new_file_name):
+            for new_project in json.loads(line.decode('utf-8'))['projects']:
+                project_id = new_project['projectId']
+                old_entry = index.pop(project_id, None)
+
+                if old_entry is None:
+                    yield __change('added', 'project', project_id)
+                elif old_entry[0] != content_hash(new_project):
+                    old_file.seek(old_entry[1])
+                    old_project = __find_project(old_file.readline(), project_id)
+                    for change in diff_projects(old_project, new_project):
+                        yield change
+
+    # Whatever is left of the old snapshot is gone from the new one.
+    for project_id in sorted(index):
+        yield __change('removed', 'project', project_id)
+
+
+def __diff_parquet_snapshots(old_dir, new_dir):
+    old_projects = read_projects(old_dir)
+    new_projects = read_projects(new_dir)
+    old_project = next(old_projects, None)
+    new_project = next(new_projects, None)
+
+    while old_project is not None or new_project is not None:
+        if new_project is None or (old_project is not None and old_project['projectId'] < new_project['projectId']):
+            yield __change('removed', 'project', old_project['projectId'])
+            old_project = next(old_projects, None)
+        elif old_project is None or new_project['projectId'] < old_project['projectId']:
+            yield __change('added', 'project', new_project['projectId'])
+            new_project = next(new_projects, None)
+        else:
+            if old_project != new_project:
+                for change in diff_projects(old_project, new_project):
+                    yield change
+            old_project = next(old_projects, None)
+            new_project = next(new_projects, None)
+
+
+def diff_projects(old_project, new_project):
+    """
+    Compares two versions of the same project.
+    :return: generator of changes, as in diff_snapshots()
+    """
+    project_id = new_project['projectId']
+
+    for change in __diff_resource(project_id, None, old_project, new_project):
+        yield change
+
+    # Errors listing the API or buckets of a project are reported as a change of field as well.
+    for field in ('enabled_api', 'buckets'):
+        old_errors = __list_errors(old_project.get(field, []))
+        new_errors = __list_errors(new_project.get(field, []))
+        if old_errors != new_errors:
+            yield __change('modified', 'field', project_id, field='{}.error'.format(field),
+                           old=old_errors, new=new_errors)
+
+    old_api = __api_names(old_project.get('enabled_api', []))
+    new_api = __api_names(new_project.get('enabled_api', []))
+    for name in sorted(new_api - old_api):
+        yield __change('added', 'api', project_id, name=name)
+    for name in sorted(old_api - new_api):
+        yield __change('removed', 'api', project_id, name=name)
+
+    old_buckets = __buckets_by_name(old_project.get('buckets', []))
+    new_buckets = __buckets_by_name(new_project.get('buckets', []))
+    for bucket_name in sorted(set(old_buckets) | set(new_buckets)):
+        if bucket_name not in old_buckets:
+            yield __change('added', 'bucket', project_id, bucket_name)
+        elif bucket_name not in new_buckets:
+            yield __change('removed', 'bucket', project_id, bucket_name)
+        else:
+            for change in __diff_resource(project_id, bucket_name, old_buckets[bucket_name], new_buckets[bucket_name]):
+                yield change
+
+
+def __diff_resource(project_id, bucket_name, old_resource, new_resource):
+    """
+    Compares the fields and IAM bindings of two versions of the same project or bucket.
+    """
+    for field in sorted(set(old_resource) | set(new_resource)):
+        # The Id of a project, or name of a bucket, is what the two versions were matched on.
+        if field in NESTED_FIELDS or field == ('projectId' if bucket_name is None else 'name'):
+            continue
+
+        if old_resource.get(field) != new_resource.get(field):
+            yield __change('modified', 'field', project_id, bucket_name, field=field,
+                           old=old_resource.get(field), new=new_resource.get(field))
+
+    # Errors reading the bindings, e.g. after losing access to a project, are reported as a change of field.
+    old_errors = __errors(old_resource.get('iam_bindings'))
+    new_errors = __errors(new_resource.get('iam_bindings'))
+    if old_errors != new_errors:
+        yield __change('modified', 'field', project_id, bucket_name, field='iam_bindings.error',
+                       old=old_errors, new=new_errors)
+
+    old_bindings = __binding_pairs(old_resource.get('iam_bindings'))
+    new_bindings = __binding_pairs(new_resource.get('iam_bindings'))
+    for role, member in sorted(new_bindings - old_bindings):
+        yield __change('added', 'binding', project_id, bucket_name, role=role, member=member)
+    for role, member in sorted(old_bindings - new_bindings):
+        yield __change('removed', 'binding', project_id, bucket_name, role=role, member=member)
+
+
+def __binding_pairs(iam_bindings):
+    if not isinstance(iam_bindings, list):
+        return set()
+
+    return set((binding['role'], member) for binding in iam_bindings for member in binding.get('members', []))
+
+
+def __errors(value):
+    if isinstance(value, dict):
+        return value.get('error')
+
+    return None
+
+
+def __list_errors(items):
+    return [item['error'] for item in items if 'error' in item] or None
+
+
+def __api_names(enabled_api):
+    return set(api['name'] for api in enabled_api if 'name' in api)
+
+
+def __buckets_by_name(buckets):
+    return dict((bucket['name'], bucket) for bucket in buckets if 'name' in bucket)
+
+
+def __change(change, resource, project_id, bucket_name=None, **details):
+    change_dict = {'change': change, 'resource': resource, 'project_id': project_id, 'bucket_name': bucket_name}
+    change_dict.update(details)
+    return change_dict
+
+
+def __find_project(line, project_id):
+    for project in json.loads(line.decode('utf-8'))['projects']:
+        if project['projectId'] == project_id:
+            return project
+
+
+def __read_lines(input_file_name):
+    """
+    :return: generator of (offset, line) of every non empty line in the file
+    """
+    with io.open(input_file_name, 'rb') as input_file:
+        offset = 0
+        for line in input_file:
+            if line.strip():
+                yield offset, line
+            offset += len(line)
@@ -0,0 +1,110 @@
+# Copyright 2019 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import json
+import os
+
+
+class InventoryJournal(object):
+    """
+    Records the progress of an inventory run in a local newline delimited JSON file, so that a run
+    that crashes or loses its credentials half way can be resumed rather than restarted.
+
+    Each line of the journal is one of:
+    {"inventory_time": ...}     written once, when the run starts.
+    {"project": {...}}          written as soon as the metadata about a project is collected.
+    {"next_page_token": ...}    written once all the projects in a page of projects().list are collected;
+                                null once the last page is done.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def start(self, inventory_time):
+        """
+        Starts a new journal, overwriting any previous one.
+
+        :param inventory_time: the timestamp of the inventory
+        :return: None
+        """
+        self._file = io.open(self.path, 'w', encoding='utf8')
+        self._append({'inventory_time': inventory_time})
+
+    def resume(self):
+        """
+        Reads the progress recorded in an existing journal and keeps appending to it.
+
+        :return: tuple of (inventory_time, list of collected projects, page token to continue listing projects from,
+        whether listing projects is done)
+        """
+        inventory_time = None
+        projects = []
+        page_token = None
+        listing_done = False
+
+        complete_length = 0
+        with io.open(self.path, 'rb') as journal_file:
+            for line in journal_file:
+                # The last line may be incomplete if the previous run died while writing it.
+                if not line.endswith(b'\n'):
+                    break
+
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    break
+
+                complete_length += len(line)
+
+                if 'inventory_time' in record:
+                    inventory_time = record['inventory_time']
+                elif 'project' in record:
+                    projects.append(record['project'])
+                elif 'next_page_token' in record:
+                    page_token = record['next_page_token']
+                    listing_done = page_token is None
+
+        # Drop any incomplete line, so that new records are appended after the last complete one.
+        with io.open(self.path, 'r+b') as journal_file:
+            journal_file.truncate(complete_length)
+
+        self._file = io.open(self.path, 'a', encoding='utf8')
+
+        return inventory_time, projects, page_token, listing_done
+
+    def record_project(self, project_dict):
+        self._append({'project': project_dict})
+
+    def record_page(self, next_page_token):
+        self._append({'next_page_token': next_page_token})
+
+    def remove(self):
+        """
+        Deletes the journal once the inventory is safely persisted.
+
+        :return: None
+        """
+        self._file.close()
+        os.remove(self.path)
+
+    def _append(self, record):
+        # Flush every record to disk, so that nothing collected so far is lost if the process dies.
+        self._file.write(u'{}\n'.format(json.dumps(record)))
+        self._file.flush()
+        os.fsync(self._file.fileno())
@@ -0,0 +1,115 @@
+# Copyright 2019 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Local inventory snapshots.
+
+A snapshot is a newline delimited JSON file where every line is an inventory document holding a single project:
+{"inventory_time": "2019-01-31 10:00", "projects": [{"projectId": ..., "iam_bindings": ..., "buckets": ...}]}
+
+Every line has the same schema as the inventory persisted in BigQuery, so a snapshot can be read one project
+at a time, and lines of the same snapshot can be concatenated back into a single inventory document.
+"""
+
+import hashlib
+import io
+import json
+
+
+def save_snapshot(inventory, output_file_name):
+    """
+    Writes the inventory into a local snapshot file, one project per line.
+    :param inventory: the inventory document, i.e. {'inventory_time': ..., 'projects': [...]}; projects may be any iterable
+    :param output_file_name: the file to be saved to
+    :return: None
+    """
+    with io.open(output_file_name, 'w', encoding='utf8') as output_file:
+        for project in inventory['projects']:
+            line = json.dumps({'inventory_time': inventory['inventory_time'], 'projects': [project]})
+            output_file.write(u'{}\n'.format(line))
+
+
+def read_snapshot(input_file_name):
+    """
+    Reads a local snapshot file one project at a time.
+    :param input_file_name: the snapshot file
+    :return: generator of (inventory_time, project dictionary) tuples
+    """
+    with io.open(input_file_name, encoding='utf8') as input_file:
+        for line in input_file:
+            if line.strip():
+                document = json.loads(line)
+                for project in document['projects']:
+                    yield document['inventory_time'], project
+
+
+def load_snapshot(input_file_name):
+    """
+    Reads a local snapshot file into a single inventory document.
+    :param input_file_name: the snapshot file
+    :return: the inventory document, i.e. {'inventory_time': ..., 'projects': [...]}
+    """
+    inventory = {'inventory_time': None, 'projects': []}
+    for inventory_time, project in read_snapshot(input_file_name):
+        inventory['inventory_time'] = inventory_time
+        inventory['projects'].append(project)
+
+    return inventory
+
+
+def merge_snapshots(input_file_names):
+    """
+    Merges the snapshots collected by the shards of a run into a single inventory document.
+    Shards start at slightly different times; the merged inventory takes the time of the earliest one.
+    :param input_file_names: the snapshot files of all the shards
+    :return: the inventory document, i.e. {'inventory_time': ..., 'projects': [...]}
+    """
+    inventory_times = set()
+    projects = []
+    project_ids = set()
+
+    for input_file_name in input_file_names:
+        for inventory_time, project in read_snapshot(input_file_name):
+            inventory_times.add(inventory_time)
+
+            # A project may appear twice if the same shard was collected twice; keep the first one.
+            if project['projectId'] not in project_ids:
+                project_ids.add(project['projectId'])
+                projects.append(project)
+
+    return {'inventory_time': min(inventory_times) if inventory_times else None, 'projects': projects}
+
+
+def parse_shard(shard):
+    """
+    Parses a shard specification.
+    :param shard: e.g. "2/8" for the third of eight shards
+    :return: e.g. (2, 8)
+    """
+    index, count = [int(number) for number in shard.split('/')]
+    if not 0 <= index < count:
+        raise ValueError('shard must be i/N with 0 <= i < N, e.g. 0/4')
+
+    return index, count
+
+
+def shard_of(project_id, shard_count):
+    """
+    Assigns a project to a shard by a hash of its Id. The hash is the same on any machine and across runs,
+    unlike Python's built-in hash(), so independent processes agree on which shard collects which project.
+    :param project_id: the project Id
+    :param shard_count: the total number of shards
+    :return: the index of the shard the project belongs to
+    """
+    return int(hashlib.md5(project_id.encode('utf-8')).hexdigest(), 16) % shard_count
@@ -0,0 +1,143 @@
+# Copyright 2019 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A local SQLite store of inventory snapshots, holding the same normalized tables as the Parquet export,
+indexed for "who can access what" lookups that don't cost a BigQuery scan each time.
+"""
+
+import sqlite3
+
+from inventory_columnar import TABLES, flatten_project
+from inventory_snapshot import read_snapshot
+
+INDEXES = [
+    ('bindings', ['member', 'inventory_time']),
+    ('bindings', ['role', 'inventory_time']),
+    ('bindings', ['project_id', 'bucket_name']),
+    ('bindings', ['bucket_name']),
+    ('buckets', ['bucket_name']),
+    ('enabled_api', ['name', 'inventory_time']),
+    ('labels', ['key', 'value']),
+] + [
+    # load_snapshots() replaces the rows of one project of one inventory at a time, in every table.
+    (table_name, ['project_id', 'inventory_time']) for table_name in sorted(TABLES)
+]
+
+
+def open_store(database_file_name):
+    """
+    Opens the store, creating its tables and indexes if they don't exist yet.
+    :param database_file_name: the SQLite database file
+    :return: sqlite3.Connection
+    """
+    connection = sqlite3.connect(database_file_name)
+
+    for table_name, schema in sorted(TABLES.items()):
+        connection.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(
+            table_name, ', '.join('{} TEXT'.format(column) for column, _ in schema)))
+
+    for table_name, columns in INDEXES:
+        connection.execute('CREATE INDEX IF NOT EXISTS {}_{} ON {} ({})'.format(
+            table_name, '_'.join(columns), table_name, ', '.join(columns)))
+
+    connection.commit()
+
+    return connection
+
+
+def load_snapshots(connection, input_file_names):
+    """
+    Loads snapshot files into the store, one project at a time. Projects already loaded for the same inventory_time
+    are replaced, so loading a snapshot twice, or the shards of a run alongside their merged snapshot, is harmless.
+    :param connection: the store, as returned by open_store()
+    :param input_file_names: the snapshot files, as saved by resource-inventory.py or merge-inventory.py with --output
+    :return: the number of projects loaded
+    """
+    inserts = dict((table_name, 'INSERT INTO {} ({}) VALUES ({})'.format(
+        table_name, ', '.join(column for column, _ in schema), ', '.join('?' for _ in schema)))
+        for table_name, schema in TABLES.items())
+
+    project_count = 0
+    with connection:
+        for input_file_name in input_file_names:
+            for inventory_time, project in read_snapshot(input_file_name):
+                for table_name in TABLES:
+                    connection.execute('DELETE FROM {} WHERE inventory_time = ? AND project_id = ?'.format(table_name),
+                                       (inventory_time, project['projectId']))
+
+                for table_name, rows in flatten_project(inventory_time, project).items():
+                    columns = [column for column, _ in TABLES[table_name]]
+                    connection.executemany(inserts[table_name],
+                                           [tuple(row.get(column) for column in columns) for row in rows])
+
+                project_count += 1
+
+    return project_count
+
+
+def latest_inventory_time(connection):
+    return connection.execute('SELECT MAX(inventory_time) FROM projects').fetchone()[0]
+
+
+def inventory_times(connection):
+    """
+    :return: list of (inventory_time, number of projects) of every inventory in the store, oldest first
+    """
+    return connection.execute('SELECT inventory_time, COUNT(*) FROM projects '
+                              'GROUP BY inventory_time ORDER BY inventory_time').fetchall()
+
+
+def buckets_of_member(connection, member, inventory_time=None):
+    """
+    :param member: e.g. user:jane@acme.com
+    :return: list of (project_id, bucket_name, role) for every bucket where the member has a role
+    """
+    return connection.execute('SELECT project_id, bucket_name, role FROM bindings '
+                              'WHERE member = ? AND inventory_time = ? AND bucket_name IS NOT NULL '
+                              'ORDER BY project_id, bucket_name, role',
+                              (member, inventory_time or latest_inventory_time(connection))).fetchall()
+
+
+def projects_of_member(connection, member, inventory_time=None):
+    """
+    :param member: e.g. user:jane@acme.com
+    :return: list of (project_id, role) for every project where the member has a role
+    """
+    return connection.execute('SELECT project_id, role FROM bindings '
+                              'WHERE member = ? AND inventory_time = ? AND bucket_name IS NULL '
+                              'ORDER BY project_id, role',
+                              (member, inventory_time or latest_inventory_time(connection))).fetchall()
+
+
+def members_of_role(connection, role, inventory_time=None):
+    """
+    :param role: e.g. roles/owner
+    :return: list of (project_id, bucket_name, member) for every binding of the role; bucket_name is None for projects
+    """
+    return connection.execute('SELECT project_id, bucket_name, member FROM bindings '
+                              'WHERE role = ? AND inventory_time = ? '
+                              'ORDER BY project_id, bucket_name, member',
+                              (role, inventory_time or latest_inventory_time(connection))).fetchall()
+
+
+def projects_with_api(connection, api, inventory_time=None):
+    """
+    :param api: e.g. bigquery-json.googleapis.com
+    :return: list of (project_id,) for every project where the API is enabled
+    """
+    return connection.execute('SELECT project_id FROM enabled_api '
+                              'WHERE name = ? AND inventory_time = ? '
+                              'ORDER BY project_id',
+                              (api, inventory_time or latest_inventory_time(connection))).fetchall()
@@ -0,0 +1,172 @@
+# Copyright 2019 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Timing of the API calls and stages of an inventory run.
+
+Every API call and stage is wrapped in a span. At the end of a run, the spans are summarized per name, i.e. per API
+method or stage, with a latency histogram, call and error counts, and response bytes; and optionally written into
+a trace file in the Chrome trace event format, which chrome://tracing, https://ui.perfetto.dev and other
+OpenTelemetry-compatible viewers open.
+"""
+
+import collections
+import contextlib
+import io
+import json
+import os
+import threading
+import time
+
+# Upper bounds, in milliseconds, of the buckets of the latency histograms.
+LATENCY_BUCKETS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf')]
+
+
+class SpanStats(object):
+
+    __slots__ = ('count', 'errors', 'total', 'max', 'bytes', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.bytes = 0
+        self.histogram = [0] * len(LATENCY_BUCKETS)
+
+    def add(self, duration, error, response_bytes):
+        self.count += 1
+        self.errors += 1 if error else 0
+        self.total += duration
+        self.max = max(self.max, duration)
+        self.bytes += response_bytes
+
+        milliseconds = duration * 1000
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if milliseconds <= bound:
+                self.histogram[i] += 1
+                break
+
+    def percentile(self, fraction):
+        """
+        :return: the upper bound, in milliseconds, of the histogram bucket the percentile falls into
+        """
+        rank = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.histogram):
+            seen += count
+            if seen >= rank:
+                return LATENCY_BUCKETS[i]
+
+        return LATENCY_BUCKETS[-1]
+
+
+class Tracer(object):
+
+    def __init__(self):
+        self.keep_events = False
+        self.stats = collections.defaultdict(SpanStats)
+        self.project_time = collections.Counter()
+        self._events = []
+        self._lock = threading.Lock()
+        self._origin = time.time()
+
+    @contextlib.contextmanager
+    def span(self, name, category='stage', project=None, **args):
+        """
+        Times the enclosed block. The block may set span['bytes'] to the size of the response it received.
+        :param name: the API method or stage, e.g. storage.buckets.getIamPolicy
+        :param category: the API host, or stage
+        :param project: the project Id the work is done for, if any
+        :param args: any other detail to keep in the trace file, e.g. the name of a bucket
+        """
+        span = {'bytes': 0}
+        start = time.time()
+        error = False
+        try:
+            yield span
+        except Exception:
+            error = True
+            raise
+        finally:
+            duration = time.time() - start
+            with self._lock:
+                self.stats[name].add(duration, error, span['bytes'])
+                if project is not None and category != 'stage':
+                    self.project_time[project] += duration
+
+                if self.keep_events:
+                    if project is not None:
+                        args['project'] = project
+                    if error:
+                        args['error'] = True
+                    self._events.append({'name': name, 'cat': category, 'ph': 'X',
+                                         'ts': int((start - self._origin) * 1000000), 'dur': int(duration * 1000000),
+                                         'pid': os.getpid(), 'tid': threading.current_thread().ident,
+                                         'args': dict(args, bytes=span['bytes'])})
+
+    def execute(self, request, name, project=None, num_retries=0, **args):
+        """
+        Executes an API request within a span.
+        :param request: googleapiclient.http.HttpRequest
+        :param name: the API method, e.g. storage.buckets.getIamPolicy
+        :param num_retries: how many times the request is retried on rate limiting and server errors
+        :return: the response
+        """
+        with self.span(name, name.split('.')[0], project, **args) as span:
+            response = request.execute(num_retries=num_retries)
+            # The size of the response as JSON; close to, though not exactly, the bytes received.
+            span['bytes'] = len(json.dumps(response))
+
+        return response
+
+    def print_summary(self, slowest_projects=5):
+        print('')
+        print('{:<45} {:>7} {:>6} {:>9} {:>7} {:>7} {:>7} {:>8} {:>12}'.format(
+            'span', 'calls', 'errors', 'total s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'bytes'))
+
+        for name, stats in sorted(self.stats.items(), key=lambda item: -item[1].total):
+            print('{:<45} {:>7} {:>6} {:>9.1f} {:>7} {:>7} {:>7} {:>8.0f} {:>12}'.format(
+                name, stats.count, stats.errors, stats.total, format_bound(stats.percentile(0.5)),
+                format_bound(stats.percentile(0.9)), format_bound(stats.percentile(0.99)),
+                stats.max * 1000, stats.bytes))
+
+        print('')
+        print('latency histograms, calls per bucket in ms:')
+        print('{:<45} {}'.format('', ' '.join('{:>6}'.format(format_bound(bound)) for bound in LATENCY_BUCKETS)))
+        for name, stats in sorted(self.stats.items()):
+            print('{:<45} {}'.format(name, ' '.join('{:>6}'.format(count) for count in stats.histogram)))
+
+        if self.project_time:
+            print('')
+            print('slowest projects, by time spent in API calls:')
+            for project, duration in self.project_time.most_common(slowest_projects):
+                print('{:<45} {:>9.1f} s'.format(project, duration))
+
+    def write_trace(self, output_file_name):
+        """
+        Writes the spans into a file in the Chrome trace event format.
+        :param output_file_name: the file to be saved to
+        :return: None
+        """
+        with io.open(output_file_name, 'w', encoding='utf8') as output_file:
+            output_file.write(u'{}'.format(json.dumps({'traceEvents': self._events, 'displayTimeUnit': 'ms'})))
+
+
+def format_bound(bound):
+    return 'inf' if bound == float('inf') else '{}'.format(bound)
+
+
+# The tracer of the run.
+TRACER = Tracer()
@@ -0,0 +1,88 @@
+# Copyright 2019 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+
+sys.path.append('../')
+
+import argparse
+
+from utils import persist_JSON
+from inventory_snapshot import merge_snapshots, save_snapshot
+from inventory_columnar import PARQUET_DIRECTORY, persist_parquet, save_parquet
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        prog='python merge-inventory.py',
+        description='Merges the snapshots collected by the shards of resource-inventory.py into a single inventory.')
+    parser.add_argument('snapshots', metavar='[shard snapshot]', nargs='+',
+                        help='the snapshot files saved by the shards with --output')
+    parser.add_argument('--bigquery', metavar=('DATASET_ID', 'TABLE_ID'), nargs=2,
+                        help='persist the merged inventory into this BigQuery dataset and table')
+    parser.add_argument('--output', metavar='FILE',
+                        help='save the merged inventory into a local snapshot file')
+    parser.add_argument('--format', choices=['json', 'parquet'], default='json',
+                        help='json: a single row of nested JSON (default); parquet: normalized tables, '
+                             'in which case --output is a directory')
+
+    args = parser.parse_args()
+
+    if args.bigquery is None and args.output is None:
+        parser.error('either --bigquery or --output is required')
+
+    return args
+
+
+def main():
+    """
+    This is how you execute this script:
+
+    python merge-inventory.py [shard snapshot] [shard snapshot] ... [--bigquery DATASET_ID TABLE_ID] [--output FILE]
+                             [--format json|parquet]
+
+    For example, to collect an organization in four shards, possibly on four different machines:
+
+    python resource-inventory.py [project filter] --shard 0/4 --output shard0.json
+    ...
+    python resource-inventory.py [project filter] --shard 3/4 --output shard3.json
+
+    and then merge them into one inventory, with one inventory_time, in BigQuery:
+
+    python merge-inventory.py shard0.json shard1.json shard2.json shard3.json --bigquery [dataset Id] [table Id]
+    """
+
+    args = parse_arguments()
+
+    inventory = merge_snapshots(args.snapshots)
+    print('merged {} projects from {} snapshots as the inventory of {}...'
+          .format(len(inventory['projects']), len(args.snapshots), inventory['inventory_time']))
+
+    if args.output is not None:
+        if args.format == 'parquet':
+            save_parquet(inventory, args.output)
+        else:
+            save_snapshot(inventory, args.output)
+
+    if args.bigquery is not None and len(inventory['projects']) > 0:
+        dataset_id, table_id = args.bigquery
+        print('persisting metadata to BigQuery dataset:{} table:{}...'.format(dataset_id, table_id))
+        if args.format == 'parquet':
+            persist_parquet(inventory, dataset_id, table_id, PARQUET_DIRECTORY)
+        else:
+            persist_JSON(inventory, dataset_id, table_id)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# Copyright 2019 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import time
+
+import inventory_store
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        prog='python query-inventory.py',
+        description='Loads inventory snapshots into a local SQLite store and answers "who can access what" questions.')
+    parser.add_argument('--db', default='inventory.db',
+                        help='the SQLite database file of the store (default: inventory.db)')
+    parser.add_argument('--inventory-time', metavar='TIME',
+                        help='the inventory to query, e.g. "2019-01-31 10:00" (default: the latest one)')
+
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    subparsers.required = True
+
+    load = subparsers.add_parser('load', help='load snapshot files saved with --output into the store')
+    load.add_argument('snapshots', metavar='[snapshot]', nargs='+')
+
+    subparsers.add_parser('inventories', help='list the inventories in the store')
+
+    buckets = subparsers.add_parser('buckets', help='list the buckets where a member has any role')
+    buckets.add_argument('member', help='e.g. user:jane@acme.com')
+
+    projects = subparsers.add_parser('projects', help='list the projects where a member has any role')
+    projects.add_argument('member', help='e.g. user:jane@acme.com')
+
+    role = subparsers.add_parser('role', help='list the members of a role across projects and buckets')
+    role.add_argument('role', help='e.g. roles/owner')
+
+    api = subparsers.add_parser('api', help='list the projects where an API is enabled')
+    api.add_argument('api', help='e.g. bigquery-json.googleapis.com')
+
+    return parser.parse_args()
+
+
+def main():
+    """
+    This is how you execute this script:
+
+    python query-inventory.py [--db FILE] load [snapshot] [snapshot] ...
+    python query-inventory.py [--db FILE] [--inventory-time TIME] buckets|projects [member]
+    python query-inventory.py [--db FILE] [--inventory-time TIME] role [role]
+    python query-inventory.py [--db FILE] [--inventory-time TIME] api [api]
+    python query-inventory.py [--db FILE] inventories
+
+    For example:
+
+    python resource-inventory.py [project filter] --output inventory.json
+    python query-inventory.py load inventory.json
+    python query-inventory.py buckets user:jane@acme.com
+    python query-inventory.py api bigquery-json.googleapis.com
+    """
+
+    args = parse_arguments()
+
+    connection = inventory_store.open_store(args.db)
+
+    start_time = time.time()
+
+    if args.command == 'load':
+        project_count = inventory_store.load_snapshots(connection, args.snapshots)
+        print('loaded {} projects into {}.'.format(project_count, args.db))
+        return
+
+    if args.command == 'inventories':
+        rows = inventory_store.inventory_times(connection)
+    elif args.command == 'buckets':
+        rows = inventory_store.buckets_of_member(connection, args.member, args.inventory_time)
+    elif args.command == 'projects':
+        rows = inventory_store.projects_of_member(connection, args.member, args.inventory_time)
+    elif args.command == 'role':
+        rows = inventory_store.members_of_role(connection, args.role, args.inventory_time)
+    else:
+        rows = inventory_store.projects_with_api(connection, args.api, args.inventory_time)
+
+    for row in rows:
+        print('\t'.join('' if value is None else str(value) for value in row))
+
+    print('{} rows in {:.0f} ms.'.format(len(rows), (time.time() - start_time) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -16,12 +16,58 @@ import sys
 
 sys.path.append('../')
 
-from googleapiclient import discovery
-from oauth2client.client import GoogleCredentials
-
+import argparse
 import datetime
+import json
+import os
+
+from utils import key_value_pairs, persist_JSON
+from inventory_journal import InventoryJournal
+from inventory_snapshot import parse_shard, save_snapshot, shard_of
+from inventory_columnar import PARQUET_DIRECTORY, persist_parquet, save_parquet
+from inventory_bindings import BindingTable, expand_project
+from inventory_trace import TRACER
+from inventory_assets import read_asset_export
+
+# When set, e.g. to http://localhost:8080 for the fake server in fake_gcp_server.py, every API call is sent to
+# [endpoint]/[API name]/ rather than Google, without credentials.
+API_ENDPOINT = os.environ.get('INVENTORY_API_ENDPOINT')
+
+# How many times a request is retried, with exponential backoff, when rate limited (429) or on server errors.
+NUM_RETRIES = 5
+
+
+def build_service(name, version, credentials, project_id=None):
+    """
+    Builds the client of an API, or of its fake when INVENTORY_API_ENDPOINT is set.
+    :param name: the API name, e.g. storage
+    :param version: the API version, e.g. v1
+    :param credentials: credentials to be used when making API calls
+    :param project_id: the project the client is built for, if any; only used to trace the time it takes
+    :return: the service
+    """
 
-from utils import *
+    from googleapiclient import discovery
+    import httplib2
+
+    with TRACER.span('discovery.build.{}'.format(name), 'discovery', project_id):
+        if API_ENDPOINT is None:
+            return discovery.build(name, version, credentials=credentials)
+
+        return discovery.build(name, version, http=httplib2.Http(),
+                               client_options={'api_endpoint': '{}/{}/'.format(API_ENDPOINT.rstrip('/'), name)})
+
+
+def execute(request, name, project_id=None, **args):
+    """
+    Executes an API request, retrying it if rate limited, and traces the time it takes.
+    :param request: the request
+    :param name: the API method, e.g. storage.buckets.getIamPolicy
+    :param project_id: the project the request is made for, if any
+    :return: the response
+    """
+
+    return TRACER.execute(request, name, project_id, num_retries=NUM_RETRIES, **args)
 
 
 def get_error_messages(http_error):
@@ -55,14 +101,16 @@ def get_enabled_api(projectId, credentials):
     :return: list of API that are enabled for the specified project.
     """
 
+    from googleapiclient.errors import HttpError
+
     print ('getting list of enabled api for the project {}...'.format(projectId))
 
     api_list = []
     try:
-        service = discovery.build('serviceusage', 'v1', credentials=credentials)
+        service = build_service('serviceusage', 'v1', credentials, projectId)
         request = service.services().list(parent='projects/{}'.format(projectId), filter='state:ENABLED')
 
-        response = request.execute()
+        response = execute(request, 'serviceusage.services.list', projectId)
         if 'services' in response:
             for service in response['services']:
                 api_dict = {}
@@ -75,20 +123,24 @@ def get_enabled_api(projectId, credentials):
 
                 api_list.append(api_dict)
 
-    except discovery.HttpError as http_error:
+    except HttpError as http_error:
+        raise_if_unauthorized(http_error)
         api_list.append({'error': get_error_messages(http_error)})
 
     return api_list
 
 
-def get_buckets(projectId, credentials):
+def get_buckets(projectId, credentials, binding_table):
     """
     Calls https://www.googleapis.com/storage/v1/b?project=[PROJECT_NAME]
     :param projectId: project Id in question
     :param credentials: credentials to be used when making API calls
+    :param binding_table: the BindingTable the IAM bindings of the buckets are interned in
     :return: list of buckets under the specified project which the specified credential has access to.
     """
 
+    from googleapiclient.errors import HttpError
+
     print('getting list of buckets for the project {}...'.format(projectId))
 
     bucket_list = []
@@ -96,10 +148,10 @@ def get_buckets(projectId, credentials):
     try:
         # Try reading list of buckets in the project.
         # If the caller doesn't have proper rights, this will throw an exception.
-        service = discovery.build('storage', 'v1', credentials=credentials)
+        service = build_service('storage', 'v1', credentials, projectId)
         request = service.buckets().list(project=projectId)
 
-        response = request.execute()
+        response = execute(request, 'storage.buckets.list', projectId)
 
         if 'items' in response:
             for item in response['items']:
@@ -119,114 +171,284 @@ def get_buckets(projectId, credentials):
                     # Try getting IAM policy bindings for the bucket.
                     # if the caller doesn't have proper rights, this will throw an exception.
                     iam_request = service.buckets().getIamPolicy(bucket=item['name'])
-                    iam_response = iam_request.execute()
-                    bucket_dict['iam_bindings'] = iam_response['bindings']
+                    iam_response = execute(iam_request, 'storage.buckets.getIamPolicy', projectId,
+                                           bucket=item['name'])
+                    bucket_dict['iam_bindings'] = binding_table.policy(iam_response['bindings'])
 
-                except discovery.HttpError as http_error:
+                except HttpError as http_error:
+                    raise_if_unauthorized(http_error)
                     bucket_dict['iam_bindings'] = {'error': get_error_messages(http_error)}
 
                 bucket_list.append(bucket_dict)
 
-    except discovery.HttpError as http_error:
+    except HttpError as http_error:
+        raise_if_unauthorized(http_error)
         bucket_list.append({'error': get_error_messages(http_error)})
 
     return bucket_list
 
 
-def usage():
-    print(
-        '\nusage: python resource_inventory.py [project filter] [existing BigQuery dataset Id] [new or existing BigQuery table Id]\n')
+def raise_if_unauthorized(http_error):
+    """
+    Lets authentication errors, e.g. expired credentials, interrupt the run rather than be recorded as
+    inventory errors; an interrupted run can be resumed with --resume once the credentials are renewed.
+    :param http_error:
+    :return: None
+    """
 
+    if http_error.resp.status == 401:
+        raise http_error
 
-def main():
+
+def get_project_metadata(project, service, credentials, binding_table):
+    """
+    Collects the metadata about a project.
+    :param project: the project as listed by https://cloudresourcemanager.googleapis.com/v1/projects
+    :param service: the cloudresourcemanager service
+    :param credentials: credentials to be used when making API calls
+    :param binding_table: the BindingTable the IAM bindings of the project and its buckets are interned in
+    :return: the project dictionary, including its IAM bindings, enabled API and buckets.
     """
-    This is how you execute this script:
 
-    python resource_inventory.py [project filter] [BigQuery dataset Id] [BigQuery table Id]
+    from googleapiclient.errors import HttpError
 
-    [project filter]: Wildcard string to specify which projects to inventory. For example,
-    to inventory projects with names starting with PROD, you'd pass _name:PROD*_ as project filter.
+    print('getting metadata about project {}...'.format(project['projectId']))
 
-    [BigQuery dataset Id]: The Id for an existing BiqQuery dataset. The authenticated user must
-    have rights to create or update the specified table.
+    project_dict = project
 
-    [BigQuery table Id]: The Id for the table in the specified dataset where the inventory is persisted to.
-    If the table doesn't exist, it will be created. Otherwise, new inventory is appended to previous records.
-    If appending to an existing table, it has to have the same schema.
+    if 'labels' in project_dict:
+        # Labels are free form and cause errors persisting the json.
+        # We need to convert them into an array of key-value pairs to keep the schema consistent.
+        project_dict['labels'] = key_value_pairs(project_dict['labels'])
 
-    It does the following:
+    try:
+        # 2. get iam bindings at the project level.
+        # if the caller doesn't have proper rights, this will throw an exception.
 
-     1) If it cannot find a default application credential, it prompts you to log in.
-     2) Retrieves some metadata about all the projects which the authenticated user has access to.
-     3) For each project, retrieves:
-        - List of enabled API
-        - Metadata about all the cloud storage buckets which the authenticated user has access to
-     4) Compiles all the metadata about projects and buckets into a single JSON object and persists it in a BigQuery table.
-    """
+        iam_request = service.projects().getIamPolicy(resource=project['projectId'])
+        iam_response = execute(iam_request, 'cloudresourcemanager.projects.getIamPolicy', project['projectId'])
+        project_dict['iam_bindings'] = binding_table.policy(iam_response['bindings'])
+
+    except HttpError as http_error:
+        raise_if_unauthorized(http_error)
+        project_dict['iam_bindings'] = {'error': get_error_messages(http_error)}
+
+    # 3. get list of enabled API for the project
+    project_dict['enabled_api'] = get_enabled_api(project['projectId'], credentials)
+
+    # 4. get list of buckets for the project
+    project_dict['buckets'] = get_buckets(project['projectId'], credentials, binding_table)
 
-    if len(sys.argv) != 4:
-        # Remember sys.argv[0] is always the name of the script. In this case: "resource-inventory.py"
-        # We are interested in 3 more arguments besides the script name -> total 4.
-        usage()
-        return
+    return project_dict
 
-    project_filter = sys.argv[1]
-    dataset_Id = sys.argv[2]
-    table_id = sys.argv[3]
+
+def collect_projects(args, binding_table):
+    """
+    Collects the metadata about all the projects the user has access to, and that match the project filter,
+    from the API. The progress is recorded in a journal as it goes.
+    :param args: the parsed command line arguments
+    :param binding_table: the BindingTable the IAM bindings of the projects and buckets are interned in
+    :return: tuple of (inventory time, list of project dictionaries, journal)
+    """
+
+    # The client libraries are only imported once they are needed, so that --help and usage errors come back quickly.
+    from oauth2client.client import GoogleCredentials
 
     # 0. get the user to login to obtain a google credential
-    credentials = GoogleCredentials.get_application_default()
+    credentials = None if API_ENDPOINT is not None else GoogleCredentials.get_application_default()
 
-    # 0. start the inventory dictionary with a timestamp
-    inventory = {'inventory_time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M')}
+    # 0. start the inventory dictionary with a timestamp, or pick up where the interrupted run left off
+    journal = InventoryJournal(args.journal)
 
-    # 1. get all the projects the user has access to where they match the specified filter
-    service = discovery.build('cloudresourcemanager', 'v1', credentials=credentials)
-    request = service.projects().list(filter=project_filter)
+    if args.resume and journal.exists():
+        inventory_time, projects, page_token, listing_done = journal.resume()
+        projects = [binding_table.compact_project(project) for project in projects]
+        print('resuming the inventory of {} with {} projects already collected...'
+              .format(inventory_time, len(projects)))
+    else:
+        if args.resume:
+            print('found no journal at {}; starting a new inventory...'.format(args.journal))
+
+        inventory_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M')
+        projects, page_token, listing_done = [], None, False
+        journal.start(inventory_time)
 
-    projects = []
+    collected_ids = set(project['projectId'] for project in projects)
+
+    # 1. get all the projects the user has access to where they match the specified filter
+    service = build_service('cloudresourcemanager', 'v1', credentials)
+    request = None if listing_done else service.projects().list(filter=args.project_filter, pageToken=page_token)
 
     while request is not None:
-        response = request.execute()
+        response = execute(request, 'cloudresourcemanager.projects.list')
 
-        if 'projects' in response:
-            for project in response['projects']:
-                print('getting metadata about project {}...'.format(project['projectId']))
+        for project in response.get('projects', []):
+            if project['projectId'] in collected_ids:
+                continue
 
-                project_dict = project
+            if args.shard is not None and shard_of(project['projectId'], args.shard[1]) != args.shard[0]:
+                continue
 
-                if 'labels' in project_dict:
-                    # Labels are free form and cause errors persisting the json.
-                    # We need to convert them into an array of key-value pairs to keep the schema consistent.
-                    project_dict['labels'] = key_value_pairs(project_dict['labels'])
+            with TRACER.span('collect project', project=project['projectId']):
+                project_dict = get_project_metadata(project, service, credentials, binding_table)
 
-                try:
-                    # 2. get iam bindings at the project level.
-                    # if the caller doesn't have proper rights, this will throw an exception.
+            journal.record_project(expand_project(project_dict))
+            projects.append(project_dict)
 
-                    iam_request = service.projects().getIamPolicy(resource=project['projectId'])
-                    iam_response = iam_request.execute()
-                    project_dict['iam_bindings'] = iam_response['bindings']
+        journal.record_page(response.get('nextPageToken'))
 
-                except discovery.HttpError as http_error:
-                    project_dict['iam_bindings'] = {'error': get_error_messages(http_error)}
+        request = service.projects().list_next(previous_request=request, previous_response=response)
 
-                # 3. get list of enabled API for the project
-                project_dict['enabled_api'] = get_enabled_api(project['projectId'], credentials)
+    return inventory_time, projects, journal
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        prog='python resource-inventory.py',
+        description='Inventories the projects and storage buckets you have access to into a BigQuery table.')
+    parser.add_argument('project_filter', metavar='[project filter]',
+                        help='wildcard string to specify which projects to inventory, e.g. name:PROD*')
+    parser.add_argument('dataset_id', metavar='[BigQuery dataset Id]', nargs='?',
+                        help='the Id for an existing BigQuery dataset')
+    parser.add_argument('table_id', metavar='[BigQuery table Id]', nargs='?',
+                        help='the Id for a new or existing table in the dataset, where the inventory is persisted to')
+    parser.add_argument('--resume', action='store_true',
+                        help='resume an interrupted run from its journal, skipping the projects it already collected')
+    parser.add_argument('--journal',
+                        help='the file where the progress of the run is recorded (default: inventory_journal.json, '
+                             'or inventory_journal_[i]of[N].json for a shard)')
+    parser.add_argument('--shard', metavar='i/N', type=parse_shard,
+                        help='only collect the i-th of N shards of the projects, e.g. 0/4; '
+                             'run each shard with --output and combine them with merge-inventory.py')
+    parser.add_argument('--output', metavar='FILE',
+                        help='save the inventory into a local snapshot file rather than BigQuery')
+    parser.add_argument('--asset-export', metavar='FILE', nargs='+',
+                        help='read the projects and buckets from local copies of a Cloud Asset Inventory export, '
+                             'resource and IAM policy files alike, rather than the API')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='save the timing of every API call and stage into a trace file, '
+                             'to be opened in chrome://tracing or https://ui.perfetto.dev')
+    parser.add_argument('--format', choices=['json', 'parquet'], default='json',
+                        help='json: a single row of nested JSON per inventory (default); '
+                             'parquet: normalized tables of projects, bindings, buckets, enabled_api, labels and errors. '
+                             'With parquet, --output is a directory')
+
+    args = parser.parse_args()
+
+    if args.output is None and args.table_id is None:
+        parser.error('either [BigQuery dataset Id] [BigQuery table Id] or --output is required')
+
+    if args.journal is None:
+        args.journal = 'inventory_journal.json' if args.shard is None else \
+            'inventory_journal_{}of{}.json'.format(*args.shard)
+
+    return args
 
-                # 4. get list of buckets for the project
-                project_dict['buckets'] = get_buckets(project['projectId'], credentials)
 
-                projects.append(project_dict)
-        else:
-            print ('found no projects matching "{}"!'.format(project_filter))
+def main():
+    """
+    This is how you execute this script:
 
-        request = service.projects().list_next(previous_request=request, previous_response=response)
+    python resource_inventory.py [project filter] [BigQuery dataset Id] [BigQuery table Id] [--resume] [--journal FILE]
+                                 [--shard i/N] [--output FILE] [--format json|parquet]
+                                 [--trace FILE] [--asset-export FILE [FILE ...]]
+
+    [project filter]: Wildcard string to specify which projects to inventory. For example,
+    to inventory projects with names starting with PROD, you'd pass _name:PROD*_ as project filter.
+
+    [BigQuery dataset Id]: The Id for an existing BiqQuery dataset. The authenticated user must
+    have rights to create or update the specified table.
+
+    [BigQuery table Id]: The Id for the table in the specified dataset where the inventory is persisted to.
+    If the table doesn't exist, it will be created. Otherwise, new inventory is appended to previous records.
+    If appending to an existing table, it has to have the same schema.
+
+    [--resume]: Resumes a run that was interrupted, e.g. by a crash or expired credentials. The projects already
+    collected are read back from the journal, and listing projects continues from the page it stopped at.
+
+    [--journal FILE]: The file where the progress of the run is recorded as it goes; inventory_journal.json by default.
+    It is deleted once the inventory is persisted.
+
+    [--shard i/N]: Only collects the projects that fall into the i-th of N shards by a hash of their Id, so that
+    N processes or machines can each collect a part of a large organization at the same time.
+
+    [--output FILE]: Saves the inventory into a local snapshot file rather than BigQuery; the BigQuery dataset Id and
+    table Id can then be left out. The snapshots of all shards are combined with merge-inventory.py.
+
+    [--format json|parquet]: json persists the inventory as a single row of nested JSON, as always. parquet flattens it
+    into normalized tables, i.e. projects, bindings, buckets, enabled_api, labels and errors, each persisted into its own
+    BigQuery table named [BigQuery table Id]_[table], or saved as [table].parquet in the --output directory.
+
+    [--asset-export FILE [FILE ...]]: Reads all the projects and buckets from local copies of the resource and
+    IAM policy files of a Cloud Asset Inventory export of the organization, rather than calling the API for every
+    project and bucket. Only projects that match the project filter are read; see inventory_assets.matches_filter().
+
+    [--trace FILE]: Saves the timing of every API call and stage into a trace file in the Chrome trace event format.
+    A summary of the timings, per API method and stage, is printed at the end of every run regardless.
+
+    It does the following:
+
+     1) If it cannot find a default application credential, it prompts you to log in.
+     2) Retrieves some metadata about all the projects which the authenticated user has access to.
+     3) For each project, retrieves:
+        - List of enabled API
+        - Metadata about all the cloud storage buckets which the authenticated user has access to
+     4) Compiles all the metadata about projects and buckets into a single JSON object and persists it in a BigQuery table.
+    """
 
-    if len(projects) > 0:
+    args = parse_arguments()
+
+    TRACER.keep_events = args.trace is not None
+
+    project_filter = args.project_filter
+    dataset_Id = args.dataset_id
+    table_id = args.table_id
+
+    # The IAM bindings of all the projects and buckets are kept interned in here, and only expanded back into JSON
+    # as each project is written out.
+    binding_table = BindingTable()
+
+    if args.asset_export is not None:
+        # 1-4. read all the projects and buckets from a Cloud Asset Inventory export, without any API call
+        print('reading projects matching "{}" from {}...'.format(project_filter, ', '.join(args.asset_export)))
+        inventory_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M')
+        with TRACER.span('read asset export'):
+            projects = read_asset_export(args.asset_export, binding_table, project_filter, args.shard)
+        journal = None
+    else:
+        inventory_time, projects, journal = collect_projects(args, binding_table)
+
+    inventory = {'inventory_time': inventory_time}
+
+    # Snapshots and Parquet files are written one project at a time, so projects are expanded as they are written.
+    inventory['projects'] = (expand_project(project) for project in projects)
+
+    if args.output is not None:
+        # An empty snapshot is still saved, so that merging the shards doesn't miss one.
+        print('saving metadata about {} projects to {}...'.format(len(projects), args.output))
+        with TRACER.span('save {}'.format(args.format)):
+            if args.format == 'parquet':
+                save_parquet(inventory, args.output)
+            else:
+                save_snapshot(inventory, args.output)
+    elif len(projects) > 0:
         print('persisting metadata to BigQuery dataset:{} table:{}...'.format(dataset_Id, table_id))
-        inventory['projects'] = projects
-        persist_JSON(inventory, dataset_Id, table_id)
+        with TRACER.span('bigquery load {}'.format(args.format)):
+            if args.format == 'parquet':
+                persist_parquet(inventory, dataset_Id, table_id, PARQUET_DIRECTORY)
+            else:
+                inventory['projects'] = list(inventory['projects'])
+                persist_JSON(inventory, dataset_Id, table_id)
+    else:
+        print ('found no projects matching "{}"!'.format(project_filter))
+
+    if journal is not None:
+        journal.remove()
+
+    TRACER.print_summary()
+    if args.trace is not None:
+        TRACER.write_trace(args.trace)
+        print('saved the trace of the run to {}.'.format(args.trace))
 
 
 if __name__ == '__main__':
@@ -32,13 +32,16 @@ def run_command(cmd, safe_message_indicator='', interrupt_on_error=True, chatty=
     osstdout = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
                                 stderr=subprocess.STDOUT, close_fds=True)
 
+    # The output is bytes on Python 3, so decode it there; on Python 2 it stays a str, as callers expect.
     message = osstdout.communicate()[0].strip()
+    if not isinstance(message, str):
+        message = message.decode('utf-8', 'replace')
     if chatty:
         print('>>>message: ' + message)
 
-    if osstdout.returncode is not 0:
+    if osstdout.returncode != 0:
         if interrupt_on_error:
-            if not safe_message_indicator or message.find(safe_message_indicator) is -1:
+            if not safe_message_indicator or message.find(safe_message_indicator) == -1:
                 raise Exception(message)
 
     return message
@@ -67,6 +70,82 @@ def save_pretty_JSON(jsonDict, outputFileName):
         outputFile.write(to_unicode(str_))
 
 
+def save_JSON(jsonDict, outputFileName):
+    """
+    Writes the provided dictionary into the output file in compact JSON format.
+    :param jsonDict: the dictionary to be saved
+    :param outputFileName: the file to be saved to
+    :return: None
+    """
+    with io.open(outputFileName, 'w', encoding='utf8') as outputFile:
+        outputFile.write(to_unicode(json.dumps(jsonDict, ensure_ascii=False)))
+
+
+def save_string(text, outputFileName):
+    """
+    Writes the provided string into the output file.
+    :param text: the string to be saved
+    :param outputFileName: the file to be saved to
+    :return: None
+    """
+    with io.open(outputFileName, 'w', encoding='utf8') as outputFile:
+        outputFile.write(to_unicode(text))
+
+
+def try_command(cmd):
+    """
+    Runs the provided shell command quietly, without printing or raising.
+
+    :param cmd: a shell command to execute
+
+    :return: the message that was communicated by the shell command,
+    or None if the command didn't finish with 0 as the return code.
+    """
+    process = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, close_fds=True)
+
+    message = process.communicate()[0].strip()
+    if process.returncode != 0:
+        return None
+
+    return message.decode('utf-8') if isinstance(message, bytes) else message
+
+
+def wait_for(condition, description, timeout=300, initial_delay=1, max_delay=30):
+    """
+    Polls the provided condition until it is met, doubling the delay between polls each time.
+
+    :param condition: a function with no parameters that returns a truthy value once the condition is met.
+
+    :param description: what is being waited for; used in messages.
+
+    :param timeout: the number of seconds after which to give up.
+
+    :param initial_delay: the number of seconds to wait after the first failed poll.
+
+    :param max_delay: the upper limit for the number of seconds between two polls.
+
+    :return: the truthy value returned by the condition.
+
+    Note: If the condition isn't met within timeout seconds, an exception is raised.
+    """
+    import time
+
+    deadline = time.time() + timeout
+    delay = initial_delay
+    while True:
+        result = condition()
+        if result:
+            return result
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise Exception('Timed out after {} seconds waiting for {}.'.format(timeout, description))
+
+        time.sleep(min(delay, max_delay, remaining))
+        delay *= 2
+
+
 def key_value_pairs(input_dict):
     """
     Coverts a dictionary into a flat list of key-value pairs.